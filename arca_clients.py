@@ -0,0 +1,242 @@
+"""
+Process-wide registry of zeep clients for the ARCA web services (WSAA and WSFEv1).
+
+Building a zeep.Client downloads and parses the WSDL and all its XSDs, which is the
+largest CPU cost of a request after the network wait. Clients are built once per
+(WSDL URL, settings) and shared by every caller in the process.
+
+Two layers keep cold starts cheap:
+    - A persistent on-disk cache (zeep SqliteCache) of the downloaded WSDL/XSD documents.
+      Entries never expire unless ARCA_WSDL_CACHE_TIMEOUT is set, so the worker can start
+      across restarts and while ARCA is unreachable.
+    - An optional pre-parsed WSDL snapshot (requires the optional 'cloudpickle' package).
+      When present, the parsed zeep Document is unpickled instead of being parsed. Snapshots
+      can be shipped with a deployment by running this module once: python arca_clients.py
+
+Environment Variables:
+    - ARCA_WSFE_WSDL: WSFEv1 WSDL URL (default: homologation)
+    - ARCA_WSAA_WSDL: WSAA WSDL URL (default: homologation)
+    - ARCA_WSDL_CACHE_DIR: Directory for the WSDL cache and snapshots (default: ./wsdl_cache)
+    - ARCA_WSDL_CACHE_TIMEOUT: Seconds before a cached document is re-downloaded (default: never)
+    - ARCA_WSDL_SNAPSHOTS: Set to 0 to disable pre-parsed WSDL snapshots (default: 1)
+"""
+
+import hashlib
+import os
+import threading
+
+from requests import Session
+from requests.auth import HTTPBasicAuth
+from zeep import AsyncClient, Client, Settings, __version__ as zeep_version
+from zeep.cache import SqliteCache
+from zeep.transports import AsyncTransport, Transport
+
+from metrics import STAGE_SECONDS
+
+try:
+    import cloudpickle
+except ImportError:  # Snapshots are optional
+    cloudpickle = None
+
+# Point these at fake_arca.py (or production) without touching the code
+WSFE_WSDL = os.environ.get("ARCA_WSFE_WSDL", "https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL")
+WSAA_WSDL = os.environ.get("ARCA_WSAA_WSDL", "https://wsaahomo.afip.gov.ar/ws/services/LoginCms?WSDL")
+
+WSDL_CACHE_DIR = os.environ.get(
+    "ARCA_WSDL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "wsdl_cache")
+)
+WSDL_CACHE_TIMEOUT = int(os.environ["ARCA_WSDL_CACHE_TIMEOUT"]) if os.environ.get("ARCA_WSDL_CACHE_TIMEOUT") else None
+WSDL_SNAPSHOTS = os.environ.get("ARCA_WSDL_SNAPSHOTS", "1") != "0"
+
+_clients = {}
+_clients_lock = threading.Lock()
+_wsdl_cache = None
+
+
+def get_wsdl_cache():
+    """
+    Returns the process-wide persistent WSDL/XSD document cache.
+    """
+    global _wsdl_cache
+    if _wsdl_cache is None:
+        os.makedirs(WSDL_CACHE_DIR, exist_ok=True)
+        _wsdl_cache = SqliteCache(path=os.path.join(WSDL_CACHE_DIR, "wsdl.db"), timeout=WSDL_CACHE_TIMEOUT)
+    return _wsdl_cache
+
+
+def create_transport(basic_auth=None, operation_timeout=None):
+    """
+    Creates a zeep Transport with its own requests.Session and the shared WSDL cache.
+
+    Args:
+        basic_auth (tuple): Optional (user, password) for HTTP basic authentication.
+        operation_timeout (float): Timeout in seconds for the SOAP calls.
+
+    Returns:
+        zeep.transports.Transport: The transport.
+    """
+    session = Session()
+    if basic_auth:
+        session.auth = HTTPBasicAuth(*basic_auth)
+    return Transport(session=session, cache=get_wsdl_cache(), operation_timeout=operation_timeout)
+
+
+def get_client(wsdl_url, strict=False, xml_huge_tree=True, basic_auth=None, operation_timeout=None):
+    """
+    Returns the shared zeep Client for the given WSDL URL and settings, building it on first use.
+
+    Args:
+        wsdl_url (str): The URL of the WSDL file.
+        strict (bool): zeep strict mode.
+        xml_huge_tree (bool): Allow huge XML trees in responses.
+        basic_auth (tuple): Optional (user, password) for HTTP basic authentication.
+        operation_timeout (float): Timeout in seconds for the SOAP calls.
+
+    Returns:
+        zeep.Client: The client.
+    """
+    key = (wsdl_url, strict, xml_huge_tree, basic_auth, operation_timeout)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            settings = Settings(strict=strict, xml_huge_tree=xml_huge_tree)
+            transport = create_transport(basic_auth, operation_timeout)
+            with STAGE_SECONDS.labels("wsdl_load").time():
+                client = Client(_load_wsdl(wsdl_url, settings, transport), settings=settings, transport=transport)
+            _clients[key] = client
+        return client
+
+
+def get_async_client(wsdl_url, strict=False, xml_huge_tree=True, basic_auth=None, operation_timeout=None,
+                     max_connections=100):
+    """
+    Returns the shared zeep AsyncClient for the given WSDL URL and settings, building it on first use.
+
+    Operations are sent through a pooled httpx.AsyncClient so they do not block the event loop.
+    The WSDL itself is still loaded synchronously (from the cache or snapshot when available),
+    so the first call should be made before the worker starts consuming.
+
+    Args:
+        wsdl_url (str): The URL of the WSDL file.
+        strict (bool): zeep strict mode.
+        xml_huge_tree (bool): Allow huge XML trees in responses.
+        basic_auth (tuple): Optional (user, password) for HTTP basic authentication.
+        operation_timeout (float): Timeout in seconds for the SOAP calls.
+        max_connections (int): Size of the HTTP connection pool.
+
+    Returns:
+        zeep.AsyncClient: The client.
+    """
+    key = ("async", wsdl_url, strict, xml_huge_tree, basic_auth, operation_timeout, max_connections)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    import httpx
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            settings = Settings(strict=strict, xml_huge_tree=xml_huge_tree)
+            http_client = httpx.AsyncClient(
+                auth=basic_auth,
+                timeout=operation_timeout,
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            )
+            transport = AsyncTransport(client=http_client, cache=get_wsdl_cache(), operation_timeout=operation_timeout)
+            with STAGE_SECONDS.labels("wsdl_load").time():
+                client = AsyncClient(_load_wsdl(wsdl_url, settings, transport), settings=settings, transport=transport)
+            _clients[key] = client
+        return client
+
+
+def clear_clients():
+    """Drops every cached client, e.g. after ARCA publishes a new WSDL."""
+    with _clients_lock:
+        _clients.clear()
+
+
+def _snapshot_path(wsdl_url, settings):
+    # The snapshot depends on the zeep version and on the settings used to parse it
+    digest = hashlib.sha256(
+        f"{zeep_version}|{wsdl_url}|{settings.strict}|{settings.xml_huge_tree}".encode()
+    ).hexdigest()[:16]
+    return os.path.join(WSDL_CACHE_DIR, f"snapshot-{digest}.pickle")
+
+
+def _load_wsdl(wsdl_url, settings, transport):
+    """
+    Returns the parsed WSDL for a URL, from its pre-parsed snapshot when available.
+
+    Falls back to parsing the WSDL (documents come from the on-disk cache when present)
+    and writes a new snapshot for the next start.
+    """
+    if not (WSDL_SNAPSHOTS and cloudpickle):
+        return wsdl_url
+
+    path = _snapshot_path(wsdl_url, settings)
+    try:
+        with open(path, "rb") as f:
+            return _SnapshotUnpickler(f, settings, transport).load()
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Ignoring unusable WSDL snapshot {path}: {e}")
+
+    document = Client(wsdl_url, settings=settings, transport=transport).wsdl
+    try:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            _SnapshotPickler(f).dump(document)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Could not write WSDL snapshot {path}: {e}")
+    return document
+
+
+if cloudpickle is not None:
+    import copyreg
+    import pickle
+
+    from lxml import etree
+
+    class _SnapshotPickler(cloudpickle.Pickler):
+        """
+        Pickles a parsed zeep Document.
+
+        Settings and Transport hold thread locals and sessions, so they are stored as
+        references and replaced by the live ones when the snapshot is loaded.
+        """
+
+        dispatch_table = copyreg.dispatch_table.copy()
+        dispatch_table[etree.QName] = lambda qname: (etree.QName, (qname.text,))
+        dispatch_table[etree._Element] = lambda element: (etree.fromstring, (etree.tostring(element),))
+
+        def __init__(self, file):
+            super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        def persistent_id(self, obj):
+            if isinstance(obj, Settings):
+                return "settings"
+            if isinstance(obj, Transport):
+                return "transport"
+            return None
+
+    class _SnapshotUnpickler(pickle.Unpickler):
+        def __init__(self, file, settings, transport):
+            super().__init__(file)
+            self._persistent = {"settings": settings, "transport": transport}
+
+        def persistent_load(self, pid):
+            return self._persistent[pid]
+
+
+if __name__ == "__main__":
+    # Warm the WSDL cache and write the snapshots, e.g. when building a deployment image
+    get_client(WSFE_WSDL, basic_auth=("user", "pass"))
+    get_client(WSAA_WSDL, strict=True, xml_huge_tree=False)
+    print(f"Cached {WSFE_WSDL} and {WSAA_WSDL} in {WSDL_CACHE_DIR}")
@@ -0,0 +1,608 @@
+"""
+asyncio worker mode for the ARCA gateway.
+
+Consumes the request queues ('arca' and 'arca.authorize', see lanes.py) with aio-pika and
+processes up to ARCA_CONCURRENCY messages of each at the same time, so a slow ARCA response
+does not stall the rest of the queue. The
+SOAP calls go through zeep's AsyncTransport (httpx) and never block the event loop.
+Each delivery is replied to and acknowledged individually once its request finishes.
+
+Start it with:
+    ARCA_WORKER_MODE=async python merry_go_round.py
+or directly:
+    python async_worker.py
+
+Environment Variables:
+    - RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASSWORD: as in merry_go_round.py
+    - ARCA_PREFETCH: basic_qos prefetch count of each lane (default: 20)
+    - ARCA_CONCURRENCY: Maximum number of messages of each lane processed at once (default: ARCA_PREFETCH)
+    - ARCA_LANE_*: Prefetch and concurrency of the authorize and query lanes (see lanes.py)
+    - ARCA_SHARDS: Number of per-(cuit, pto_vta) shard queues, as in merry_go_round.py
+    - ARCA_COALESCE_WINDOW_MS: Set to 0 to stop concurrent identical last_invoice requests
+      from sharing one ARCA call (default: 5)
+    - ARCA_METRICS_PORT: Port of the Prometheus /metrics endpoint, 0 disables it (default: 9464)
+    - ARCA_RETRY_ATTEMPTS: Delayed retries of transient failures, as in merry_go_round.py
+    - ARCA_BREAKER_*, ARCA_LIMIT_*: Circuit breaker and adaptive concurrency limit of the ARCA
+      calls (see upstream_guard.py). The limit caps the concurrent calls below ARCA_CONCURRENCY.
+    - ARCA_IDEMPOTENCY_*: Stored replies of redelivered and duplicate requests, as in merry_go_round.py
+    - ARCA_BULK_*: Parallelism and chunking of bulk_query requests (see bulk_query.py)
+    - ARCA_SEQUENCE_LOCK_THREADS: Threads waiting for invoice sequence locks held by other
+      processes, one per key (default: 4)
+
+SIGUSR1 samples the stacks of every thread for ARCA_PROFILE_WINDOW seconds (see profiler.py).
+Per-message profiling (ARCA_PROFILE_EVERY) is only available in blocking mode.
+"""
+
+import asyncio
+import functools
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import aio_pika
+
+from encoders import encode, negotiate, to_builtin
+from merry_go_round import RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASSWORD, error_reply, parse_request
+from solicitud_ultimo_comprobante import solicitar_ultimo_comprobante_async
+from solicitud_factura_a import solicitar_cae_async
+from solicitud_consulta_comprobante import consultar_comprobante_async
+from last_invoice_cache import cache_key, last_invoice_cache
+from coalesce import AsyncSingleFlight
+from invoice_batcher import BATCH_WINDOW, InvoiceBatcher, number_invoices, split_batch_response
+from invoice_sequencer import InvoiceSequencer, rejected_for_numbering
+from login_arca import login_ARCA
+from upstream_guard import DEFER, UpstreamUnavailable
+import bulk_query
+import idempotency
+import lanes
+import metrics
+import profiler
+import retry_queues
+import shards
+
+PREFETCH = int(os.environ.get("ARCA_PREFETCH", 20))
+CONCURRENCY = int(os.environ.get("ARCA_CONCURRENCY", PREFETCH))
+COALESCE = os.environ.get("ARCA_COALESCE_WINDOW_MS", "5") != "0"
+SEQUENCE_LOCK_THREADS = int(os.environ.get("ARCA_SEQUENCE_LOCK_THREADS", 4))
+
+# Authorization requests have their own queue, prefetch and concurrency budget (see lanes.py),
+# and with ARCA_SHARDS each owned shard queue is a lane processed one message at a time (see shards.py)
+LANES = lanes.lanes(PREFETCH, CONCURRENCY) + shards.lanes(PREFETCH)
+
+# Concurrent identical last_invoice queries share one ARCA call
+flights = AsyncSingleFlight()
+
+# Open invoice batches, waiters are futures resolved with each invoice's response
+batcher = InvoiceBatcher()
+# Batches of the same key are authorized one at a time so their numbers do not overlap
+batch_locks = {}
+batch_tasks = set()
+
+# Requeues scheduled by nack_later, referenced until they run
+deferred_nacks = set()
+
+# Last authorized number per (cuit, pto_vta, cbte_tipo), shared by every worker on the host
+sequencer = InvoiceSequencer()
+# Threads waiting for the sequence lock of a key held by another process
+lock_executor = ThreadPoolExecutor(max_workers=SEQUENCE_LOCK_THREADS, thread_name_prefix="sequence-lock")
+
+
+async def send_reply(channel, message, payload):
+    """
+    Publishes a reply to the reply_to queue of a request, if it has one, in the format
+    negotiated from the request (see encoders.py).
+
+    Args:
+        channel (aio_pika.abc.AbstractChannel): The channel to publish on
+        message (aio_pika.abc.AbstractIncomingMessage): The request
+        payload (dict): The reply body
+
+    Returns:
+        bool: True if the reply was published
+    """
+    if not message.reply_to:
+        print("No reply_to property in request, response not sent")
+        return False
+    try:
+        content_type = negotiate(message.content_type, message.headers)
+        body = encode(payload, content_type)
+        with metrics.STAGE_SECONDS.labels("publish").time():
+            await channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=body,
+                    correlation_id=message.correlation_id,
+                    content_type=content_type,
+                ),
+                routing_key=str(message.reply_to),
+            )
+        metrics.record_reply(payload)
+        return True
+    except Exception as pub_error:
+        print(f"Error sending response: {pub_error}")
+        return False
+
+
+async def get_token_and_sign(cuit):
+    """The TA of the cuit is cached, so this only blocks (in a worker thread) when WSAA must be called."""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(login_ARCA, cuit=cuit))
+
+
+async def last_invoice(data):
+    """Non-blocking version of merry_go_round.last_invoice."""
+    key = cache_key(data["cuit"], data["pto_vta"], data["cbte_tipo"])
+    cached = last_invoice_cache.get(key)
+    if cached is not None:
+        return cached
+    if COALESCE:
+        return await flights.do(key, lambda: fetch_last_invoice(data))
+    return await fetch_last_invoice(data)
+
+
+async def fetch_last_invoice(data):
+    """Non-blocking version of merry_go_round.fetch_last_invoice."""
+    key = cache_key(data["cuit"], data["pto_vta"], data["cbte_tipo"])
+    token, sign = await get_token_and_sign(data["cuit"])
+    response = await solicitar_ultimo_comprobante_async(token, sign, data["cuit"], data["pto_vta"], data["cbte_tipo"])
+    response_dict = to_builtin(response)
+    last_invoice_cache.put(key, response_dict)
+    return response_dict
+
+
+async def authorize(data, concurrency=CONCURRENCY):
+    """
+    Non-blocking version of merry_go_round.authorize. `concurrency` is the budget of the
+    lane the request came from, which bounds how many invoices can join its batch.
+    """
+    key = cache_key(data["cuit"], data["pto_vta"], data["cbte_tipo"])
+    if "CbteDesde" not in data["invoice"]:
+        return await batch_authorization(key, data["invoice"], concurrency)
+
+    token, sign = await get_token_and_sign(data["cuit"])
+    try:
+        response = await solicitar_cae_async(token, sign, data["cuit"], data["pto_vta"], data["cbte_tipo"], [data["invoice"]])
+    except UpstreamUnavailable:
+        raise
+    except Exception:
+        # The invoice may or may not have been authorized
+        last_invoice_cache.invalidate(key)
+        raise
+    response_dict = to_builtin(response)
+    last_invoice_cache.note_authorization(key, response_dict)
+    return response_dict
+
+
+async def batch_authorization(key, invoice, concurrency=CONCURRENCY):
+    """
+    Adds an unnumbered invoice to the open batch of its key and waits for its own response.
+
+    With a concurrency of 1 in its lane (a shard) no other invoice can join, so the batch
+    is flushed right away instead of after BATCH_WINDOW.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    opened, full = batcher.add(key, invoice, future)
+    if full or concurrency <= 1:
+        flush_batch(key)
+    elif opened:
+        loop.call_later(BATCH_WINDOW, flush_batch, key)
+    return await future
+
+
+def flush_batch(key):
+    """Closes the open batch of a key and authorizes it in the background."""
+    batch = batcher.take(key)
+    if batch:
+        task = asyncio.create_task(run_batch(key, batch))
+        batch_tasks.add(task)
+        task.add_done_callback(batch_tasks.discard)
+
+
+async def run_batch(key, batch):
+    """Authorizes a closed batch and resolves the future of each of its invoices."""
+    lock = batch_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        try:
+            responses = await authorize_batch(key, [invoice for invoice, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+    for (_, future), response in zip(batch, responses):
+        if not future.done():
+            future.set_result(response)
+
+
+async def authorize_batch(key, invoices):
+    """Non-blocking version of merry_go_round.authorize_batch."""
+    cuit, pto_vta, cbte_tipo = key
+    token, sign = await get_token_and_sign(cuit)
+
+    # Other processes may hold the key for the duration of their FECAESolicitar
+    key_lock = await acquire_sequence_lock(key)
+    responses = [None] * len(invoices)
+    pending = list(range(len(invoices)))
+    try:
+        while pending:
+            last = sequencer.last_number(key)
+            seeded = last is None
+            if seeded:
+                last = await seed_sequence(key)
+            numbered = number_invoices([invoices[position] for position in pending], last + 1)
+
+            try:
+                response = await solicitar_cae_async(token, sign, cuit, pto_vta, cbte_tipo, numbered)
+            except UpstreamUnavailable:
+                raise
+            except Exception:
+                sequencer.reset(key)
+                last_invoice_cache.invalidate(key)
+                raise
+            response_dict = to_builtin(response)
+            sequencer.commit(key, last, response_dict)
+            last_invoice_cache.note_authorization(key, response_dict)
+            # Approved invoices keep their response, only those rejected for their number are retried
+            for position, split in zip(pending, split_batch_response(response_dict, numbered)):
+                responses[position] = split
+            retry = [] if seeded else rejected_for_numbering(response_dict, numbered)
+            pending = [pending[index] for index in retry]
+            if pending:
+                metrics.RETRIES.labels("numbering").inc()
+        return responses
+    finally:
+        key_lock.release()
+
+
+async def acquire_sequence_lock(key):
+    """
+    Takes the cross-process lock of a key's sequence in a thread of lock_executor, so
+    waiting for another process neither blocks the event loop nor takes the threads
+    of login_ARCA.
+
+    Returns:
+        The acquired lock, to release
+    """
+    key_lock = sequencer.lock(key)
+    acquiring = lock_executor.submit(key_lock.acquire)
+    try:
+        await asyncio.wrap_future(acquiring)
+    except asyncio.CancelledError:
+        # The thread may still get the lock after the task is gone: give it back then
+        acquiring.add_done_callback(lambda done: None if done.cancelled() or done.exception() else key_lock.release())
+        raise
+    return key_lock
+
+
+async def seed_sequence(key):
+    """Non-blocking version of merry_go_round.seed_sequence."""
+    cuit, pto_vta, cbte_tipo = key
+    last = await fetch_last_invoice({"cuit": cuit, "pto_vta": pto_vta, "cbte_tipo": cbte_tipo})
+    if last.get("Errors"):
+        raise ValueError(f"Could not get the last authorized invoice: {last['Errors']}")
+    return last.get("CbteNro") or 0
+
+
+async def stream_bulk_query(channel, message, data, queue):
+    """Non-blocking version of merry_go_round.stream_bulk_query, acknowledged by process_message."""
+    cuit, pto_vta, cbte_tipo = data["cuit"], data["pto_vta"], data["cbte_tipo"]
+
+    async def fetch(cbte_nro):
+        token, sign = await get_token_and_sign(cuit)
+        return to_builtin(await consultar_comprobante_async(token, sign, cuit, pto_vta, cbte_tipo, cbte_nro))
+
+    def on_error(error):
+        print(f"Bulk query of {cuit} {pto_vta} {cbte_tipo} interrupted: {error}")
+        return error_reply(error)
+
+    if await bulk_query.stream_async(data, fetch, functools.partial(send_reply, channel, message), on_error):
+        rest = bulk_query.continuation(data)
+        if rest is None:
+            print(f"Bulk query of {data['from']} to {data['to']} streamed.")
+        elif not await continue_bulk_query(channel, message, rest, queue):
+            await send_reply(channel, message, bulk_query.interrupted_reply(
+                {"error": "Could not queue the rest of the range"}, rest["from_chunk"]
+            ))
+
+
+async def continue_bulk_query(channel, message, rest, queue):
+    """Non-blocking version of merry_go_round.continue_bulk_query."""
+    body = encode(rest, negotiate(message.content_type))
+    try:
+        await channel.default_exchange.publish(
+            aio_pika.Message(
+                body=body,
+                headers=message.headers,
+                content_type=message.content_type,
+                correlation_id=message.correlation_id,
+                reply_to=message.reply_to,
+                delivery_mode=message.delivery_mode,
+            ),
+            routing_key=queue,
+        )
+        return True
+    except Exception as pub_error:
+        print(f"Error republishing request to {queue}: {pub_error}")
+        return False
+
+
+async def handle_request(data, concurrency=CONCURRENCY):
+    """Non-blocking version of merry_go_round.handle_request."""
+    if data["operation"] == "authorize":
+        return await authorize(data, concurrency)
+    if data["operation"] == "cache_stats":
+        return last_invoice_cache.stats()
+    return await last_invoice(data)
+
+
+async def process_message(channel, message, queue=retry_queues.REQUEST_QUEUE):
+    """
+    Processes one 'arca' request and replies to it, like merry_go_round.process_message.
+
+    Args:
+        channel (aio_pika.abc.AbstractChannel): The channel to reply on
+        message (aio_pika.abc.AbstractIncomingMessage): The request
+        queue (str): The queue it was consumed from, where its retries go back to
+
+    Returns:
+        float: Seconds after which a request of a shard that failed or was deferred must be
+            processed again, in place (see retry_queues.in_place), else None
+    """
+    operation = None
+    key = None
+    try:
+        try:
+            data = parse_request(message.body, message.content_type)
+        except ValueError:
+            metrics.MESSAGES.labels("invalid").inc()
+            raise
+        operation = data["operation"]
+        metrics.MESSAGES.labels(operation).inc()
+        key = idempotency_key(message, operation)
+        if key is not None:
+            state, payload = idempotency.replies.begin(key, idempotency.may_replay(message.headers, message.redelivered))
+            if state == idempotency.DONE:
+                metrics.DUPLICATES.labels("replayed").inc()
+                await send_reply(channel, message, payload)
+                await message.ack()
+                return
+            if state == idempotency.BUSY:
+                # Another delivery of the request is being processed
+                metrics.DUPLICATES.labels("busy").inc()
+                return await defer(channel, message, queue, idempotency.BUSY_DELAY,
+                                   idempotency.deferred_headers(message.headers, message.correlation_id))
+        if operation == "bulk_query":
+            # Replied to with a stream of chunks, the rest of the range in a new message
+            await stream_bulk_query(channel, message, data, queue)
+            await message.ack()
+            return
+        response_dict = await handle_request(data, lane_concurrency(queue))
+
+    except Exception as e:
+        print(f"Error processing message: {e}")
+        if key is not None:
+            idempotency.replies.abandon(key)
+        if DEFER and isinstance(e, UpstreamUnavailable):
+            # Back when it is worth retrying, without holding a slot of the lane meanwhile
+            return await defer(channel, message, queue, max(e.retry_after, 1), message.headers)
+        if retry_queues.retryable(operation, e):
+            hop = retry_queues.next_hop(message.headers, e, queue)
+            if not hop.parked and retry_queues.in_place(queue):
+                metrics.RETRIES.labels("delayed").inc()
+                message.headers = hop.headers
+                return retry_queues.hop_delay(hop)
+            published = await republish(channel, message, hop)
+            if published and not hop.parked:
+                metrics.RETRIES.labels("delayed").inc()
+                await message.ack()
+                return
+            if published:
+                metrics.PARKED.inc()
+        await send_reply(channel, message, error_reply(e))
+        await message.ack()
+        return
+
+    payload = {"response": response_dict}
+    if key is not None:
+        # Stored before replying, so a redelivery after a crash is never processed again
+        idempotency.replies.finish(key, payload)
+    if await send_reply(channel, message, payload):
+        print("Message processed and response sent.")
+    await message.ack()
+
+
+def lane_concurrency(queue):
+    """Returns the concurrency budget of the lane of a queue (see merry_go_round.lane_prefetch)."""
+    for lane in LANES:
+        if lane.queue == queue:
+            return lane.concurrency
+    return CONCURRENCY
+
+
+def idempotency_key(message, operation):
+    """Returns the key a request is deduplicated by (see idempotency.py), or None if it is not."""
+    if idempotency.replies is None or operation not in idempotency.OPERATIONS:
+        return None
+    return idempotency.request_key(message.headers, message.correlation_id, message.body)
+
+
+async def defer(channel, message, queue, delay, headers):
+    """
+    Brings a request back to its queue after about `delay` seconds, through a delay queue
+    (see retry_queues.deferral), or without delay queues with a requeue scheduled outside
+    the concurrency budget of its lane. Either way it holds no slot of the lane meanwhile.
+    A request of a shard is instead held in place, and keeps the only slot of its shard.
+
+    Args:
+        channel (aio_pika.abc.AbstractChannel): The channel to republish on
+        message (aio_pika.abc.AbstractIncomingMessage): The request
+        queue (str): The queue it was consumed from
+        delay (float): Seconds to wait
+        headers (dict): Headers to republish it with
+
+    Returns:
+        float: `delay` if the request is held in place and must be processed again then
+    """
+    if retry_queues.in_place(queue):
+        message.headers = headers
+        return delay
+    hop = retry_queues.deferral(headers, delay, queue)
+    if hop is not None and await republish(channel, message, hop):
+        await message.ack()
+        return
+    nack_later(message, delay)
+
+
+def nack_later(message, delay):
+    """Requeues a message `delay` seconds from now, from a task of its own."""
+    async def nack():
+        await asyncio.sleep(delay)
+        try:
+            await message.nack(requeue=True)
+        except Exception as e:
+            # The channel closed meanwhile, which requeued it anyway
+            print(f"Could not requeue a deferred request: {e}")
+
+    task = asyncio.create_task(nack())
+    deferred_nacks.add(task)
+    task.add_done_callback(deferred_nacks.discard)
+
+
+async def republish(channel, message, hop):
+    """
+    Publishes a failed request to its delay queue or to the parking lot (see retry_queues.py).
+
+    Returns:
+        bool: True if the request was published
+    """
+    try:
+        await channel.default_exchange.publish(
+            aio_pika.Message(
+                body=message.body,
+                headers=hop.headers,
+                content_type=message.content_type,
+                correlation_id=message.correlation_id,
+                reply_to=message.reply_to,
+                delivery_mode=message.delivery_mode,
+                expiration=int(hop.expiration) / 1000 if hop.expiration else None,
+            ),
+            routing_key=hop.queue,
+        )
+        return True
+    except Exception as pub_error:
+        print(f"Error republishing request to {hop.queue}: {pub_error}")
+        return False
+
+
+async def declare_shards(channel):
+    """Non-blocking version of merry_go_round.declare_shards."""
+    if shards.SHARDS <= 0:
+        return
+    exchange = None
+    if shards.SHARD_ROUTING == "exchange":
+        exchange = await channel.declare_exchange(shards.SHARD_EXCHANGE, "x-consistent-hash", durable=True)
+    for name in shards.shard_queues():
+        queue = await channel.declare_queue(name, arguments=shards.SHARD_QUEUE_ARGUMENTS)
+        if exchange is not None:
+            await queue.bind(exchange, routing_key="1")
+
+
+async def sample_queue_depth(channel):
+    """Samples the number of messages ready in each request queue every ARCA_METRICS_QUEUE_INTERVAL."""
+    while True:
+        try:
+            for lane in LANES:
+                queue = await channel.declare_queue(lane.queue, passive=True)
+                metrics.QUEUE_DEPTH.labels(lane.queue).set(queue.declaration_result.message_count)
+        except Exception as e:
+            print(f"Could not sample the queue depth: {e}")
+        await asyncio.sleep(metrics.QUEUE_INTERVAL)
+
+
+async def main():
+    """
+    Connects to RabbitMQ and consumes the request queue of every lane concurrently, each
+    with its own prefetch and concurrency budget, so queries cannot hold back authorizations.
+
+    On SIGTERM the worker stops taking deliveries, waits for the messages in flight to be
+    replied to and acknowledged and closes the channel, which requeues the rest.
+    """
+    connection = await aio_pika.connect_robust(
+        host=RABBITMQ_HOST, port=RABBITMQ_PORT, login=RABBITMQ_USER, password=RABBITMQ_PASSWORD
+    )
+    async with connection:
+        channel = await connection.channel()
+
+        await channel.declare_queue('response')  # For responses, if needed.
+        for name, arguments in retry_queues.delay_queues():
+            await channel.declare_queue(name, arguments=arguments)
+        await channel.declare_queue(retry_queues.PARKING_QUEUE)
+        await declare_shards(channel)
+
+        in_flight = set()
+        stopping = False
+
+        async def handle(message, lane, semaphore):
+            try:
+                async with semaphore:
+                    if stopping and retry_queues.in_place(lane.queue):
+                        # Behind a request held in place: requeued in order when the channel closes
+                        return
+                    # Requests of a shard are held in place, so the rest of the shard waits
+                    delay = await process_message(channel, message, lane.queue)
+                    while delay is not None:
+                        await asyncio.sleep(delay)
+                        if stopping:
+                            # Left unacknowledged, ahead of the rest of its shard
+                            return
+                        delay = await process_message(channel, message, lane.queue)
+            finally:
+                metrics.IN_FLIGHT.dec()
+
+        def on_message(lane, semaphore):
+            async def callback(message):
+                if stopping:
+                    # Left unacknowledged, requeued when the channel closes
+                    return
+                metrics.IN_FLIGHT.inc()
+                task = asyncio.create_task(handle(message, lane, semaphore))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            return callback
+
+        for lane in LANES:
+            queue = await channel.declare_queue(lane.queue, arguments=lane.arguments)
+            # Without global_, the prefetch applies to each consumer created afterwards
+            await channel.set_qos(prefetch_count=lane.prefetch)
+            await queue.consume(on_message(lane, asyncio.Semaphore(lane.concurrency)))
+        metrics.start_server()
+        profiler.install(per_message=False)
+        sampler = asyncio.create_task(sample_queue_depth(channel)) if metrics.QUEUE_INTERVAL > 0 else None
+
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+
+        budgets = ", ".join(f"{lane.name}: prefetch={lane.prefetch} concurrency={lane.concurrency}" for lane in LANES)
+        print(f' [*] Waiting for messages ({budgets}). To exit press CTRL+C')
+        await stop.wait()
+
+        print(f' [*] SIGTERM received, draining {len(in_flight)} messages in flight')
+        stopping = True
+        if sampler is not None:
+            sampler.cancel()
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        # Closing without cancelling the consumers first requeues the deliveries that were
+        # not processed before the next single active consumer of a shard gets any message
+        await channel.close()
+
+
+def run():
+    """Runs the asyncio worker until interrupted."""
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print('Interrupted')
+
+
+if __name__ == '__main__':
+    run()
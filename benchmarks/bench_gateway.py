@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the blocking worker (merry_go_round.py) against the fake ARCA server.
+
+Requests are sent closed-loop: at most --window requests are awaiting a reply at any time,
+and every reply lets the next request go. Each run reports messages/sec, end-to-end latency
+percentiles (publish to reply), per-stage latency percentiles and memory, for every
+combination of --concurrency, --items and --backend-latency.
+
+Brokers:
+    - fake (default): an in-process stand-in for the RabbitMQ channel, with prefetch, acks
+      and connection timers, driven by one thread per worker. No RabbitMQ needed.
+    - rabbitmq: a local RabbitMQ (RABBITMQ_HOST, ...); one worker process per unit of
+      concurrency, requests sent through direct reply-to. Purges the 'arca' queue.
+
+ARCA is fake_arca.py, started in-process on a free port with the given latency, so WSAA
+logins, the TA cache and the sequencer run for real against a throwaway certificate.
+
+Stages (seconds): login_ARCA, FECompUltimoAutorizado, FECAESolicitar, to_builtin, encode,
+basic_publish (fake broker only). RSS is the benchmark process in fake mode and the sum of
+the worker processes in rabbitmq mode.
+
+Usage:
+    python benchmarks/bench_gateway.py [--broker fake|rabbitmq] [--operation last_invoice|authorize|mixed]
+        [--concurrency 1,4,16] [--items 1,20] [--backend-latency fixed:20 --backend-latency lognormal:80,0.5]
+        [--messages 2000] [--json]
+"""
+
+import argparse
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "ssl"))
+
+import pika
+
+import fake_arca
+
+STAGES = ("login_ARCA", "FECompUltimoAutorizado", "FECAESolicitar", "to_builtin", "encode", "basic_publish")
+
+
+def percentiles(samples):
+    """Returns count, mean, p50, p90, p99 and max of a list of seconds, in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50": rank(0.50),
+        "p90": rank(0.90),
+        "p99": rank(0.99),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def rss_mb(pid="self"):
+    """Current resident set size of a process in MB, from /proc."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+    except OSError:
+        return None
+
+
+def make_certificate(directory):
+    """Writes a throwaway self-signed certificate and key for logging in to the fake WSAA."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "bench_gateway")])
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(x509.random_serial_number()).not_valid_before(now).not_valid_after(now + timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    cert_path, key_path = os.path.join(directory, "bench.pem"), os.path.join(directory, "bench.key")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+def make_requests(operation, items, keys):
+    """Endless iterator of request bodies for a workload."""
+    for n in itertools.count():
+        cuit, pto_vta, cbte_tipo = "20111111112", str(1 + n % keys), "1"
+        if operation == "last_invoice" or (operation == "mixed" and n % 2):
+            yield {"cuit": cuit, "pto_vta": pto_vta, "cbte_tipo": cbte_tipo}
+            continue
+        tributos = [{"Id": 99, "Desc": f"Tributo {i}", "BaseImp": 100.0, "Alic": 1.0, "Importe": 1.0} for i in range(items)]
+        yield {
+            "operation": "authorize", "cuit": cuit, "pto_vta": pto_vta, "cbte_tipo": cbte_tipo,
+            "invoice": {
+                "Concepto": 1, "DocTipo": 80, "DocNro": 30678186445, "CbteFch": datetime.now().strftime("%Y%m%d"),
+                "ImpTotal": 121.0 + items, "ImpTotConc": 0, "ImpNeto": 100.0, "ImpOpEx": 0, "ImpTrib": float(items),
+                "ImpIVA": 21.0, "MonId": "PES", "MonCotiz": 1, "CondicionIVAReceptorId": 1,
+                "Tributos": {"Tributo": tributos} if tributos else None,
+                "Iva": {"AlicIva": [{"Id": 5, "BaseImp": 100.0, "Importe": 21.0}]},
+            },
+        }
+
+
+def instrument(worker, stages, login):
+    """
+    Times the stages of a merry_go_round module into `stages` and replaces its login_ARCA.
+    """
+    def timed(stage, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stages[stage].append(time.perf_counter() - start)
+        return wrapper
+
+    # Every cuit of the benchmark logs in with the throwaway certificate
+    worker.login_ARCA = timed("login_ARCA", lambda *args, **kwargs: login())
+    worker.solicitar_ultimo_comprobante = timed("FECompUltimoAutorizado", worker.solicitar_ultimo_comprobante)
+    worker.solicitar_cae = timed("FECAESolicitar", worker.solicitar_cae)
+    worker.to_builtin = timed("to_builtin", worker.to_builtin)
+    worker.encode = timed("encode", worker.encode)
+
+
+class FakeBroker:
+    """
+    In-process stand-in for the 'arca' queue: deliveries honour each worker's prefetch and
+    are released by basic_ack, replies are matched to requests by correlation_id.
+    """
+
+    def __init__(self, prefetch, window, stages):
+        self.prefetch = max(prefetch, 1)
+        self.stages = stages
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.owners = {}  # delivery_tag -> FakeChannel
+        self.sent = {}  # correlation_id -> publish time
+        self.latencies = []
+        self.errors = 0
+        self.window = threading.Semaphore(window)
+        self.stopped = False
+        self._tags = itertools.count(1)
+
+    def publish(self, body):
+        self.window.acquire()
+        correlation_id = str(uuid.uuid4())
+        properties = pika.BasicProperties(reply_to="bench", correlation_id=correlation_id, content_type="application/json")
+        with self.cond:
+            self.sent[correlation_id] = time.perf_counter()
+            self.queue.append((next(self._tags), properties, json.dumps(body).encode()))
+            self.cond.notify()
+
+    def requeue(self, properties, body, delay):
+        """Puts a request back on the queue after `delay` seconds, like a delay queue's dead-lettering."""
+        def expire():
+            with self.cond:
+                self.queue.append((next(self._tags), properties, body))
+                self.cond.notify()
+        timer = threading.Timer(delay, expire)
+        timer.daemon = True
+        timer.start()
+
+    def reply(self, properties, body):
+        start = self.sent.pop(properties.correlation_id, None)
+        if start is None:
+            return
+        self.latencies.append(time.perf_counter() - start)
+        if b'"error"' in body[:10]:
+            self.errors += 1
+        self.window.release()
+
+    def ack(self, delivery_tag):
+        with self.cond:
+            owner = self.owners.pop(delivery_tag, None)
+            if owner is not None:
+                owner.unacked -= 1
+                self.cond.notify_all()
+
+
+class FakeChannel:
+    """The subset of pika's BlockingChannel and BlockingConnection used by merry_go_round."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.connection = self
+        self.unacked = 0
+        self._timers = []
+        self._sequence = itertools.count()
+
+    def call_later(self, delay, callback):
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._sequence), callback))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if ".retry." in routing_key:
+            self.broker.requeue(properties, body, int(properties.expiration) / 1000)
+            return
+        if routing_key == "arca.parking":
+            return
+        start = time.perf_counter()
+        self.broker.reply(properties, body)
+        self.broker.stages["basic_publish"].append(time.perf_counter() - start)
+
+    def basic_ack(self, delivery_tag=0):
+        self.broker.ack(delivery_tag)
+
+    def _next_delivery(self):
+        broker = self.broker
+        with broker.cond:
+            while not broker.stopped:
+                if broker.queue and self.unacked < broker.prefetch:
+                    delivery = broker.queue.popleft()
+                    broker.owners[delivery[0]] = self
+                    self.unacked += 1
+                    return delivery
+                timeout = self._timers[0][0] - time.monotonic() if self._timers else 0.05
+                if timeout <= 0:
+                    return None
+                broker.cond.wait(timeout)
+        return None
+
+    def consume(self, on_message_callback):
+        while not (self.broker.stopped and not self._timers):
+            delivery = self._next_delivery()
+            while self._timers and self._timers[0][0] <= time.monotonic():
+                heapq.heappop(self._timers)[2]()
+            if delivery is not None:
+                delivery_tag, properties, body = delivery
+                on_message_callback(self, SimpleNamespace(delivery_tag=delivery_tag), properties, body)
+
+
+def drive(send, messages, requests, done):
+    """Sends `messages` requests through send() (which blocks while the window is full) and waits for done()."""
+    start = time.perf_counter()
+    for _ in range(messages):
+        send(next(requests))
+    while not done():
+        time.sleep(0.001)
+    return time.perf_counter() - start
+
+
+def run_fake(worker, args, concurrency, requests, stages):
+    broker = FakeBroker(args.prefetch, args.window or concurrency * max(args.prefetch, 1) * 2, stages)
+    worker.PREFETCH = args.prefetch
+    channels = [FakeChannel(broker) for _ in range(concurrency)]
+    threads = [threading.Thread(target=channel.consume, args=(worker.process_message,), daemon=True) for channel in channels]
+    for thread in threads:
+        thread.start()
+
+    drive(broker.publish, args.warmup, requests, lambda: not broker.sent)
+    broker.latencies.clear()
+    broker.errors = 0
+    for samples in stages.values():
+        samples.clear()
+
+    elapsed = drive(broker.publish, args.messages, requests, lambda: not broker.sent)
+    with broker.cond:
+        broker.stopped = True
+        broker.cond.notify_all()
+    for thread in threads:
+        thread.join()
+    return elapsed, broker.latencies, broker.errors, {"rss_mb": rss_mb(), "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def run_rabbitmq(args, concurrency, requests, env, stages):
+    from request_last_invoice import ArcaRpcClient
+
+    host, port = os.environ.get("RABBITMQ_HOST", "localhost"), int(os.environ.get("RABBITMQ_PORT", 5672))
+    user, password = os.environ.get("RABBITMQ_USER", "guest"), os.environ.get("RABBITMQ_PASSWORD", "guest")
+    client = ArcaRpcClient(host, port, user, password)
+    client.channel.queue_declare(queue="arca")
+    client.channel.queue_purge(queue="arca")
+
+    stats_dir = tempfile.mkdtemp(prefix="bench-stats-")
+    workers = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker-process", os.path.join(stats_dir, f"{n}.json")],
+            env=dict(env, ARCA_PREFETCH=str(args.prefetch)),
+            stdout=subprocess.DEVNULL,
+        )
+        for n in range(concurrency)
+    ]
+    while client.channel.queue_declare(queue="arca", passive=True).method.consumer_count < concurrency:
+        time.sleep(0.1)
+
+    window = args.window or concurrency * max(args.prefetch, 1) * 2
+    latencies, errors, in_flight = [], [0], [0]
+
+    def send(body):
+        while in_flight[0] >= window:
+            client.connection.process_data_events(time_limit=0.01)
+        in_flight[0] += 1
+        start = time.perf_counter()
+        future = client.send(body, timeout=300)
+
+        def on_done(future):
+            in_flight[0] -= 1
+            latencies.append(time.perf_counter() - start)
+            if future.exception() is not None or "error" in future.result():
+                errors[0] += 1
+        future.add_done_callback(on_done)
+
+    def done():
+        client.connection.process_data_events(time_limit=0.01)
+        return in_flight[0] == 0
+
+    try:
+        drive(send, args.warmup, requests, done)
+        latencies.clear()
+        errors[0] = 0
+        elapsed = drive(send, args.messages, requests, done)
+        memory = {"rss_mb": round(sum(rss_mb(worker.pid) or 0 for worker in workers), 1)}
+    finally:
+        for worker in workers:
+            worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            worker.wait()
+        client.close()
+
+    # Stage samples written by each worker on exit, warmup included
+    for n in range(concurrency):
+        try:
+            with open(os.path.join(stats_dir, f"{n}.json")) as f:
+                for stage, samples in json.load(f).items():
+                    stages[stage].extend(samples)
+        except OSError:
+            pass
+    return elapsed, latencies, errors[0], memory
+
+
+def worker_process(stats_path):
+    """Entry point of a worker process in rabbitmq mode: an instrumented merry_go_round.main()."""
+    import merry_go_round
+    from login_arca import TicketCache
+
+    stages = defaultdict(list)
+    ssl_dir = os.environ["BENCH_SSL_DIR"]
+    cache = TicketCache(os.path.join(ssl_dir, "bench.pem"), os.path.join(ssl_dir, "bench.key"), "wsfe",
+                        os.environ["ARCA_WSAA_WSDL"], ssl_dir)
+    instrument(merry_go_round, stages, cache.get)
+    try:
+        merry_go_round.main()
+    finally:
+        with open(stats_path, "w") as f:
+            json.dump(stages, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", choices=("fake", "rabbitmq"), default="fake")
+    parser.add_argument("--operation", choices=("last_invoice", "authorize", "mixed"), default="last_invoice")
+    parser.add_argument("--concurrency", default="1,4", help="Comma separated worker counts")
+    parser.add_argument("--items", default="1", help="Comma separated Tributo counts per authorized invoice")
+    parser.add_argument("--backend-latency", action="append", default=[], metavar="SPEC",
+                        help="fake_arca.py latency spec of every ARCA call, repeatable (default: fixed:20)")
+    parser.add_argument("--prefetch", type=int, default=1, help="ARCA_PREFETCH of the workers")
+    parser.add_argument("--window", type=int, default=0, help="Requests awaiting a reply (default: 2 x workers x prefetch)")
+    parser.add_argument("--keys", type=int, default=10, help="Distinct (cuit, pto_vta, cbte_tipo) keys")
+    parser.add_argument("--cache-ttl", default="0", help="ARCA_LAST_INVOICE_CACHE_TTL of the workers")
+    parser.add_argument("--messages", type=int, default=1000, help="Measured requests per run")
+    parser.add_argument("--warmup", type=int, default=50, help="Requests sent before measuring")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable JSON")
+    parser.add_argument("--worker-process", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_process:
+        worker_process(args.worker_process)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bench-gateway-")
+    cert_path, key_path = make_certificate(workdir)
+    arca = fake_arca.FakeArca()
+    server = fake_arca.make_server(arca, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    # Read by the gateway modules at import time, and inherited by the worker processes
+    env = dict(
+        os.environ,
+        ARCA_WSAA_WSDL=f"{base_url}{fake_arca.WSAA_PATH}?WSDL",
+        ARCA_WSFE_WSDL=f"{base_url}{fake_arca.WSFE_PATH}?WSDL",
+        ARCA_WSDL_CACHE_DIR=os.path.join(workdir, "wsdl_cache"),
+        ARCA_SEQUENCE_DIR=os.path.join(workdir, "sequences"),
+        ARCA_IDEMPOTENCY_DB=os.path.join(workdir, "idempotency", "replies.db"),
+        ARCA_LAST_INVOICE_CACHE_TTL=args.cache_ttl,
+        ARCA_COALESCE_WINDOW_MS=os.environ.get("ARCA_COALESCE_WINDOW_MS", "5"),
+        BENCH_SSL_DIR=workdir,
+    )
+    os.environ.update(env)
+
+    worker = None
+    stages = defaultdict(list)
+    if args.broker == "fake":
+        import merry_go_round as worker
+        from login_arca import TicketCache
+        # Quiet the per-message prints of the worker
+        worker.print = lambda *a, **k: None
+        cache = TicketCache(cert_path, key_path, "wsfe", env["ARCA_WSAA_WSDL"], workdir)
+        with contextlib.redirect_stdout(sys.stderr):
+            # The first login prints the loginTicketResponse
+            cache.get()
+        instrument(worker, stages, cache.get)
+
+    results = []
+    latencies_specs = args.backend_latency or ["fixed:20"]
+    for concurrency, items, latency_spec in itertools.product(
+        [int(value) for value in args.concurrency.split(",")],
+        [int(value) for value in args.items.split(",")],
+        latencies_specs,
+    ):
+        arca.latency = {None: fake_arca.parse_latency(latency_spec)}
+        # Every run starts from fresh sequences, so numbers are seeded from the fake ARCA again
+        env["ARCA_SEQUENCE_DIR"] = os.environ["ARCA_SEQUENCE_DIR"] = tempfile.mkdtemp(dir=workdir)
+        if worker is not None:
+            worker.sequencer.directory = env["ARCA_SEQUENCE_DIR"]
+            for samples in stages.values():
+                samples.clear()
+        requests = make_requests(args.operation, items, args.keys)
+
+        if args.broker == "fake":
+            elapsed, latencies, errors, memory = run_fake(worker, args, concurrency, requests, stages)
+        else:
+            stages = defaultdict(list)
+            elapsed, latencies, errors, memory = run_rabbitmq(args, concurrency, requests, env, stages)
+
+        result = {
+            "broker": args.broker,
+            "operation": args.operation,
+            "concurrency": concurrency,
+            "prefetch": args.prefetch,
+            "items": items,
+            "backend_latency": latency_spec,
+            "messages": args.messages,
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "msgs_per_sec": round(args.messages / elapsed, 1),
+            "latency_ms": percentiles(latencies),
+            "stages_ms": {stage: percentiles(stages[stage]) for stage in STAGES if stages.get(stage)},
+            **memory,
+        }
+        results.append(result)
+        if not args.json:
+            latency = result["latency_ms"]
+            print(f"{args.operation:>12} x{concurrency:<3} items={items:<4} {latency_spec:<20} "
+                  f"{result['msgs_per_sec']:>9.1f} msg/s  p50 {latency.get('p50', 0):>8.2f} ms  "
+                  f"p99 {latency.get('p99', 0):>8.2f} ms  errors {errors}  rss {result['rss_mb']} MB")
+
+    server.shutdown()
+    if args.json:
+        print(json.dumps({"python": sys.version.split()[0], "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+Benchmark of reply serialization: the original path (zeep.helpers.serialize_object +
+json.dumps) against encoders.py (to_builtin + the fastest installed backend).
+
+Builds zeep objects shaped like a FECAESolicitar response with N invoice details and
+times both paths. The original path cannot encode the Decimal amounts and dates that
+WSFE returns, so for it those fields are replaced with strings (its best case).
+
+Usage:
+    python benchmarks/bench_serialization.py [--details 1,50,250] [--repeat 2000] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+from decimal import Decimal
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zeep import xsd
+from zeep.helpers import serialize_object
+
+import encoders
+
+NS = "http://ar.gov.afip.dif.FEV1/"
+
+
+def _complex(name, fields):
+    return xsd.Element(
+        f"{{{NS}}}{name}",
+        xsd.ComplexType(xsd.Sequence([xsd.Element(f"{{{NS}}}{field}", kind) for field, kind in fields])),
+    )
+
+
+def build_response(details, typed=True):
+    """
+    Builds a zeep FECAESolicitarResult-like object with `details` FECAEDetResponse entries.
+
+    Args:
+        details (int): Number of invoice results
+        typed (bool): Use Decimal/datetime values like WSFE does, or plain strings
+    """
+    obs = _complex("Obs", [("Code", xsd.Integer()), ("Msg", xsd.String())])
+    observaciones = xsd.Element(f"{{{NS}}}Observaciones", xsd.ComplexType(xsd.Sequence([
+        xsd.Element(f"{{{NS}}}Obs", obs.type, max_occurs="unbounded"),
+    ])))
+    detail = xsd.Element(f"{{{NS}}}FECAEDetResponse", xsd.ComplexType(xsd.Sequence([
+        xsd.Element(f"{{{NS}}}Concepto", xsd.Integer()),
+        xsd.Element(f"{{{NS}}}DocTipo", xsd.Integer()),
+        xsd.Element(f"{{{NS}}}DocNro", xsd.Long()),
+        xsd.Element(f"{{{NS}}}CbteDesde", xsd.Long()),
+        xsd.Element(f"{{{NS}}}CbteHasta", xsd.Long()),
+        xsd.Element(f"{{{NS}}}CbteFch", xsd.String()),
+        xsd.Element(f"{{{NS}}}Resultado", xsd.String()),
+        xsd.Element(f"{{{NS}}}ImpTotal", xsd.Decimal() if typed else xsd.String()),
+        observaciones,
+        xsd.Element(f"{{{NS}}}CAE", xsd.String()),
+        xsd.Element(f"{{{NS}}}CAEFchVto", xsd.String()),
+    ])))
+    fe_det_resp = xsd.Element(f"{{{NS}}}FeDetResp", xsd.ComplexType(xsd.Sequence([
+        xsd.Element(f"{{{NS}}}FECAEDetResponse", detail.type, max_occurs="unbounded"),
+    ])))
+    cab = _complex("FeCabResp", [
+        ("Cuit", xsd.Long()), ("PtoVta", xsd.Integer()), ("CbteTipo", xsd.Integer()),
+        ("FchProceso", xsd.DateTime() if typed else xsd.String()), ("CantReg", xsd.Integer()),
+        ("Resultado", xsd.String()), ("Reproceso", xsd.String()),
+    ])
+    result = xsd.Element(f"{{{NS}}}FECAESolicitarResult", xsd.ComplexType(xsd.Sequence([
+        cab, fe_det_resp,
+    ])))
+
+    processed = datetime(2025, 3, 10, 12, 30, 5) if typed else "20250310123005"
+    return result(
+        FeCabResp=cab(Cuit=23146234399, PtoVta=1, CbteTipo=1, FchProceso=processed, CantReg=details,
+                      Resultado="A", Reproceso="N"),
+        FeDetResp=fe_det_resp(FECAEDetResponse=[
+            detail(
+                Concepto=1, DocTipo=80, DocNro=30678186445, CbteDesde=number, CbteHasta=number,
+                CbteFch="20250310", Resultado="A",
+                ImpTotal=Decimal("184.05") if typed else "184.05",
+                Observaciones=observaciones(Obs=[obs(Code=10217, Msg="Observacion de prueba")]),
+                CAE="75103123456789", CAEFchVto="20250320",
+            )
+            for number in range(1, details + 1)
+        ]),
+    )
+
+
+def original_path(response):
+    return json.dumps({"response": serialize_object(response)}).encode()
+
+
+def encoders_path(response, content_type=encoders.JSON):
+    return encoders.encode({"response": encoders.to_builtin(response)}, content_type)
+
+
+def run(detail_counts, repeat):
+    results = []
+    for details in detail_counts:
+        typed = build_response(details, typed=True)
+        untyped = build_response(details, typed=False)
+        cases = [
+            ("serialize_object+json.dumps", lambda: original_path(untyped)),
+            ("to_builtin+encode(json)", lambda: encoders_path(typed)),
+        ]
+        if encoders.negotiate(encoders.MSGPACK) == encoders.MSGPACK:
+            cases.append(("to_builtin+encode(msgpack)", lambda: encoders_path(typed, encoders.MSGPACK)))
+        for name, call in cases:
+            seconds = min(timeit.repeat(call, number=repeat, repeat=3)) / repeat
+            results.append({
+                "path": name,
+                "details": details,
+                "us_per_reply": round(seconds * 1e6, 2),
+                "bytes": len(call()),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--details", default="1,50,250", help="Comma separated FECAEDetResponse counts")
+    parser.add_argument("--repeat", type=int, default=2000, help="Replies encoded per measurement")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable JSON")
+    args = parser.parse_args()
+
+    results = run([int(n) for n in args.details.split(",")], args.repeat)
+    if args.json:
+        print(json.dumps({"json_backend": _backend(), "results": results}, indent=2))
+        return
+    print(f"JSON backend: {_backend()}")
+    for result in results:
+        print(f"{result['path']:<30} details={result['details']:<4} {result['us_per_reply']:>10.2f} us/reply  {result['bytes']:>7} bytes")
+
+
+def _backend():
+    if encoders.orjson is not None:
+        return "orjson"
+    if encoders.msgspec is not None:
+        return "msgspec"
+    return "json"
+
+
+if __name__ == "__main__":
+    main()
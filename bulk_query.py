@@ -0,0 +1,198 @@
+"""
+Streaming of every invoice in a number range (bulk_query requests).
+
+Reconciliation jobs need every invoice of a cuit, pto_vta and cbte_tipo between two numbers,
+often tens of thousands of them, while WSFEv1 only returns one per FECompConsultar call. A
+bulk_query request names the range:
+
+    {"operation": "bulk_query", "cuit": "20123456789", "pto_vta": 1, "cbte_tipo": 1,
+     "from": 1, "to": 50000, "chunk_size": 100, "from_chunk": 0}
+
+and is answered with a stream of replies to its reply_to, all with its correlation_id:
+    - One per chunk of chunk_size consecutive numbers, in order:
+      {"chunk": n, "from": first, "to": last, "response": [FECompConsultarResult, ...]},
+      one result per number of the chunk (numbers never authorized come with Errors)
+    - A final end-of-stream marker, {"end": true, "response": {"chunks": total, "from", "to"}}
+    - Or, if the stream is interrupted (e.g. ARCA fails or the circuit breaker opens),
+      {"end": true, "error": ..., "resume_chunk": n}, with the first chunk not sent
+
+Chunk n always covers the numbers from + n * chunk_size onwards, so a client resumes an
+interrupted stream by sending the same request with "from_chunk" set to the chunk after the
+last one it received. A request redelivered after a worker crash streams its chunks again
+from from_chunk, which clients skip by their number.
+
+A worker streams at most ARCA_BULK_CHUNKS_PER_MESSAGE chunks per message. It then publishes
+the same request with from_chunk set to the next chunk back to its queue and acknowledges
+the one it served, so a large range neither holds the worker (and, in the blocking worker,
+every other lane) for its whole duration nor outlives the broker's consumer_timeout, and a
+redelivery only repeats the chunks of one message.
+
+The numbers are fetched by at most ARCA_BULK_PARALLELISM calls at a time, in order: a
+window of calls slides over the range and each chunk is published as soon as its numbers
+are in, so at most one chunk and the window are held in memory however large the range.
+
+Environment Variables:
+    - ARCA_BULK_PARALLELISM: FECompConsultar calls in flight per bulk query (default: 8)
+    - ARCA_BULK_CHUNK_SIZE: Invoices per chunk when the request does not say (default: 100)
+    - ARCA_BULK_MAX_CHUNK_SIZE: Largest chunk_size a request may ask for (default: 1000)
+    - ARCA_BULK_MAX_RANGE: Largest number of invoices in one request (default: 100000)
+    - ARCA_BULK_CHUNKS_PER_MESSAGE: Chunks streamed before the rest of the range is
+      republished as a new message (default: 5)
+"""
+
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+PARALLELISM = int(os.environ.get("ARCA_BULK_PARALLELISM", 8))
+CHUNK_SIZE = int(os.environ.get("ARCA_BULK_CHUNK_SIZE", 100))
+MAX_CHUNK_SIZE = int(os.environ.get("ARCA_BULK_MAX_CHUNK_SIZE", 1000))
+MAX_RANGE = int(os.environ.get("ARCA_BULK_MAX_RANGE", 100000))
+CHUNKS_PER_MESSAGE = max(int(os.environ.get("ARCA_BULK_CHUNKS_PER_MESSAGE", 5)), 1)
+
+
+def _integer(data, name, default=None):
+    value = data.get(name, default)
+    if value is None:
+        raise ValueError(f"Missing required parameter in message: {name}")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {name}: {value!r}") from None
+
+
+def validate(data):
+    """
+    Checks the range of a bulk_query request and sets its from, to, chunk_size and
+    from_chunk to ints.
+
+    Raises:
+        ValueError: If the range is missing, empty, too large or has no chunk left to send
+    """
+    first = data["from"] = _integer(data, "from")
+    last = data["to"] = _integer(data, "to")
+    chunk_size = data["chunk_size"] = _integer(data, "chunk_size", CHUNK_SIZE)
+    from_chunk = data["from_chunk"] = _integer(data, "from_chunk", 0)
+    if first < 1 or last < first:
+        raise ValueError(f"Invalid invoice range: {first} to {last}")
+    if last - first + 1 > MAX_RANGE:
+        raise ValueError(f"At most {MAX_RANGE} invoices per bulk query")
+    if not 1 <= chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError(f"chunk_size must be between 1 and {MAX_CHUNK_SIZE}")
+    if not 0 <= from_chunk <= chunk_count(data):
+        raise ValueError(f"from_chunk must be between 0 and {chunk_count(data)}")
+
+
+def chunk_count(data):
+    """Returns the number of chunks of the range of a validated request."""
+    return -(-(data["to"] - data["from"] + 1) // data["chunk_size"])
+
+
+def chunk_bounds(data, chunk):
+    """Returns the first and last number of a chunk of a validated request."""
+    first = data["from"] + chunk * data["chunk_size"]
+    return first, min(first + data["chunk_size"] - 1, data["to"])
+
+
+def chunk_reply(data, chunk, results):
+    first, last = chunk_bounds(data, chunk)
+    return {"chunk": chunk, "from": first, "to": last, "response": results}
+
+
+def end_reply(data):
+    return {"end": True, "response": {"chunks": chunk_count(data), "from": data["from"], "to": data["to"]}}
+
+
+def interrupted_reply(error_payload, chunk):
+    """The last reply of a stream that failed before sending chunk (see merry_go_round.error_reply)."""
+    return dict(error_payload, end=True, resume_chunk=chunk)
+
+
+def continuation(data, max_chunks=CHUNKS_PER_MESSAGE):
+    """
+    Returns the request for the chunks left after a message streams max_chunks of them,
+    or None if the message reaches the end of the range.
+    """
+    next_chunk = data["from_chunk"] + max_chunks
+    if next_chunk >= chunk_count(data):
+        return None
+    return dict(data, from_chunk=next_chunk)
+
+
+def _numbers(data, max_chunks):
+    last_chunk = min(data["from_chunk"] + max_chunks, chunk_count(data)) - 1
+    return range(chunk_bounds(data, data["from_chunk"])[0], chunk_bounds(data, last_chunk)[1] + 1)
+
+
+def _ends(data, max_chunks):
+    return continuation(data, max_chunks) is None
+
+
+def stream(data, fetch, publish, on_error, parallelism=PARALLELISM, max_chunks=CHUNKS_PER_MESSAGE):
+    """
+    Fetches up to max_chunks chunks of the range of a validated bulk_query request and
+    publishes them, from the calling thread, with up to `parallelism` fetches running in
+    worker threads. The end marker is only sent with the last chunk of the range; the
+    caller republishes continuation(data, max_chunks) for the rest.
+
+    Args:
+        data (dict): The request
+        fetch (callable): fetch(cbte_nro) returns the result of one number
+        publish (callable): publish(payload) sends a reply and returns True if it was sent
+        on_error (callable): on_error(exception) returns the error reply of a failed fetch
+        max_chunks (int): Chunks to stream from from_chunk
+
+    Returns:
+        bool: True if every chunk (and the end marker, if due) was sent
+    """
+    chunk, results = data["from_chunk"], []
+    with ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="bulk-query") as pool:
+        numbers = iter(_numbers(data, max_chunks))
+        window = deque(pool.submit(fetch, number) for number in islice(numbers, parallelism))
+        try:
+            while window:
+                results.append(window.popleft().result())
+                number = next(numbers, None)
+                if number is not None:
+                    window.append(pool.submit(fetch, number))
+                if len(results) == data["chunk_size"] or not window:
+                    if not publish(chunk_reply(data, chunk, results)):
+                        return False
+                    chunk, results = chunk + 1, []
+        except Exception as e:
+            publish(interrupted_reply(on_error(e), chunk))
+            return False
+        finally:
+            # Only waits for the fetches already running
+            for future in window:
+                future.cancel()
+    return publish(end_reply(data)) if _ends(data, max_chunks) else True
+
+
+async def stream_async(data, fetch, publish, on_error, parallelism=PARALLELISM, max_chunks=CHUNKS_PER_MESSAGE):
+    """
+    Non-blocking version of stream(): fetch and publish are coroutine functions, and up to
+    `parallelism` fetches run as tasks.
+    """
+    chunk, results = data["from_chunk"], []
+    numbers = iter(_numbers(data, max_chunks))
+    window = deque(asyncio.ensure_future(fetch(number)) for number in islice(numbers, parallelism))
+    try:
+        while window:
+            results.append(await window.popleft())
+            number = next(numbers, None)
+            if number is not None:
+                window.append(asyncio.ensure_future(fetch(number)))
+            if len(results) == data["chunk_size"] or not window:
+                if not await publish(chunk_reply(data, chunk, results)):
+                    return False
+                chunk, results = chunk + 1, []
+    except Exception as e:
+        await publish(interrupted_reply(on_error(e), chunk))
+        return False
+    finally:
+        for task in window:
+            task.cancel()
+    return await publish(end_reply(data)) if _ends(data, max_chunks) else True
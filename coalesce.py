@@ -0,0 +1,112 @@
+"""
+In-flight request coalescing ("single flight") for idempotent ARCA queries.
+
+When a burst of identical requests arrives, only the first one (the leader) calls
+ARCA; the others wait for its result, which is then fanned out to every waiting
+requester. Only read operations (FECompUltimoAutorizado) should be coalesced.
+
+Two flavours are provided:
+    - SingleFlight: callback style, for the blocking worker. Waiters are opaque values
+      (e.g. the properties and delivery tag of a message) collected under a key until
+      the leader completes the flight.
+    - AsyncSingleFlight: for the asyncio worker. Concurrent callers of do() with the
+      same key await the same upstream call. If the leader is cancelled, the others
+      fail with FlightAbandoned instead of being cancelled with it.
+"""
+
+import asyncio
+import threading
+
+
+class FlightAbandoned(ConnectionError):
+    """
+    The leader of a flight was cancelled (worker shutdown, timeout) before the upstream
+    call answered. Transient (see retry_queues.is_transient), so the request can be retried.
+    """
+
+
+class SingleFlight:
+    """
+    Groups waiters by key while the leader's upstream call for that key is pending.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, waiter):
+        """
+        Adds a waiter to the flight of a key, starting the flight if there is none.
+
+        Args:
+            key (hashable): Identifies identical requests
+            waiter: Value returned by complete() for this request
+
+        Returns:
+            bool: True if the caller is the leader and must make the upstream call
+        """
+        with self._lock:
+            waiters = self._flights.get(key)
+            if waiters is None:
+                self._flights[key] = [waiter]
+                return True
+            waiters.append(waiter)
+            return False
+
+    def complete(self, key):
+        """
+        Ends the flight of a key.
+
+        Returns:
+            list: Every waiter that joined the flight, the leader first
+        """
+        with self._lock:
+            return self._flights.pop(key, [])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._flights)
+
+
+class AsyncSingleFlight:
+    """
+    Shares one pending upstream call among concurrent asyncio callers with the same key.
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    async def do(self, key, call):
+        """
+        Returns the result of call(), or of the identical call already in flight.
+
+        Args:
+            key (hashable): Identifies identical requests
+            call (callable): Coroutine function making the upstream call
+
+        Returns:
+            The result of the upstream call (exceptions are raised to every caller, except
+            the cancellation of the leader, which the others get as FlightAbandoned)
+        """
+        future = self._flights.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._flights[key] = future
+            try:
+                future.set_result(await call())
+            except asyncio.CancelledError:
+                # Only the leader is cancelled, the others see an ordinary failure
+                future.set_exception(FlightAbandoned(f"The upstream call for {key} was cancelled"))
+                future.exception()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # Mark the exception as retrieved in case nobody else was waiting
+                future.exception()
+            finally:
+                del self._flights[key]
+        # shield() keeps a cancelled follower from cancelling the shared result
+        return await asyncio.shield(future)
+
+    def __len__(self):
+        return len(self._flights)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules of the gateway are imported by name, as the workers do
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "ssl")]
@@ -0,0 +1,203 @@
+"""
+Registry of the certificates the gateway logs in to ARCA with, one per represented CUIT.
+
+Every CUIT the gateway invoices for may have its own certificate, key and WSN. The
+registry is a JSON file mapping CUITs to them, with an optional "default" entry for the
+CUITs not listed (e.g. represented through a single certificate with delegated access):
+
+    {
+        "default": {"certificate": "certificado_generado.pem", "private_key": "MiClavePrivadaTest.key"},
+        "20123456789": {"certificate": "acme.pem", "private_key": "acme.key", "service": "wsfe"},
+        "30712345678": {"certificate": "/etc/arca/other.pem", "private_key": "/etc/arca/other.key",
+                        "key_password": "..."}
+    }
+
+Relative paths are relative to the registry file. Without a registry file every CUIT uses
+ssl/ssl_files/certificado_generado.pem and MiClavePrivadaTest.key, as before.
+
+Certificates and keys are parsed once and kept in memory, so logging in does not touch
+the disk and a message only costs a dictionary lookup. Every ARCA_CREDENTIALS_RELOAD_S
+seconds the next lookup checks the modification time of the registry and of the
+certificate and key files, and reloads what changed. A file that fails to load keeps the
+previous credential in use.
+
+Environment Variables:
+    - ARCA_CREDENTIALS: Path of the registry file (default: ssl/ssl_files/credentials.json)
+    - ARCA_CREDENTIALS_RELOAD_S: Seconds between checks for changed files, 0 disables reloading (default: 30)
+"""
+
+import json
+import os
+import threading
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.x509 import load_pem_x509_certificate
+
+from ta_store import certificate_ticket_key
+
+SSL_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ssl", "ssl_files")
+CREDENTIALS_PATH = os.environ.get("ARCA_CREDENTIALS", os.path.join(SSL_FILES_DIR, "credentials.json"))
+RELOAD_INTERVAL = float(os.environ.get("ARCA_CREDENTIALS_RELOAD_S", 30))
+
+DEFAULT = "default"
+DEFAULT_CERTIFICATE = "certificado_generado.pem"
+DEFAULT_PRIVATE_KEY = "MiClavePrivadaTest.key"
+DEFAULT_SERVICE = "wsfe"
+
+
+class UnknownCuit(ValueError):
+    """No credential is registered for a CUIT and there is no default one."""
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Credential:
+    """
+    The parsed certificate and private key of a CUIT and the WSN they log in to.
+
+    Raises:
+        OSError: If a file cannot be read
+        ValueError: If a file is not a valid PEM certificate or key
+    """
+
+    def __init__(self, certificate_path, private_key_path, service_id=DEFAULT_SERVICE, key_password=None):
+        self.certificate_path = certificate_path
+        self.private_key_path = private_key_path
+        self.service_id = service_id
+        self.key_password = key_password
+        # Taken before reading, so a change while loading is picked up by the next check
+        self.mtimes = (_mtime(certificate_path), _mtime(private_key_path))
+        with open(certificate_path, 'rb') as f:
+            certificate_pem = f.read()
+        with open(private_key_path, 'rb') as f:
+            private_key_pem = f.read()
+        self.certificate = load_pem_x509_certificate(certificate_pem)
+        self.private_key = serialization.load_pem_private_key(
+            private_key_pem, password=key_password.encode() if key_password else None
+        )
+        self.ticket_key = certificate_ticket_key(certificate_pem, service_id)
+
+    def spec(self):
+        """What the credential was loaded from, to tell whether a registry entry changed."""
+        return self.certificate_path, self.private_key_path, self.service_id, self.key_password
+
+    def changed(self):
+        """Tells whether the certificate or key file changed since they were loaded."""
+        return (_mtime(self.certificate_path), _mtime(self.private_key_path)) != self.mtimes
+
+    def __repr__(self):
+        return f"Credential({self.certificate_path!r}, service={self.service_id!r})"
+
+
+def _parse_entry(entry, base_dir):
+    def path(name):
+        return os.path.join(base_dir, os.path.expanduser(entry[name]))
+
+    return path("certificate"), path("private_key"), entry.get("service", DEFAULT_SERVICE), entry.get("key_password")
+
+
+class CredentialRegistry:
+    """
+    CUIT -> Credential, loaded from a registry file and reloaded when the files change.
+
+    Args:
+        path (str): The registry file. If it does not exist, every CUIT uses the default
+            certificate and key of ssl/ssl_files.
+        reload_interval (float): Seconds between checks for changed files, 0 never checks.
+    """
+
+    def __init__(self, path=CREDENTIALS_PATH, reload_interval=RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._credentials = {}
+        self._registry_mtime = None
+        self._failed = False
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self, cuit):
+        """
+        Returns the credential of a CUIT.
+
+        Raises:
+            UnknownCuit: If the CUIT has no credential and there is no default one
+        """
+        now = time.monotonic()
+        if self._checked_at is None or (self.reload_interval > 0 and now - self._checked_at >= self.reload_interval):
+            with self._lock:
+                if self._checked_at is None or now - self._checked_at >= self.reload_interval:
+                    self._refresh(initial=self._checked_at is None)
+                    self._checked_at = now
+        credentials = self._credentials
+        credential = credentials.get(str(cuit)) or credentials.get(DEFAULT)
+        if credential is None:
+            raise UnknownCuit(f"No ARCA credentials registered for CUIT {cuit}")
+        return credential
+
+    def credentials(self):
+        """Returns every credential currently registered."""
+        return list(self._credentials.values())
+
+    def _read_entries(self):
+        """Returns the entries of the registry file as {cuit: (certificate, key, service, password)}."""
+        if self._registry_mtime is None:
+            return {DEFAULT: (
+                os.path.join(SSL_FILES_DIR, DEFAULT_CERTIFICATE),
+                os.path.join(SSL_FILES_DIR, DEFAULT_PRIVATE_KEY),
+                DEFAULT_SERVICE,
+                None,
+            )}
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(self.path))
+        return {str(cuit): _parse_entry(entry, base_dir) for cuit, entry in data.items()}
+
+    def _refresh(self, initial):
+        """
+        Reloads the registry file and the credentials whose files changed, or failed to load.
+        A registry file that fails to load is raised on the first load; afterwards the
+        previous credentials stay in use.
+        """
+        registry_mtime = _mtime(self.path)
+        if not (initial or self._failed or registry_mtime != self._registry_mtime
+                or any(credential.changed() for credential in self._credentials.values())):
+            return
+
+        previous_mtime, self._registry_mtime = self._registry_mtime, registry_mtime
+        try:
+            entries = self._read_entries()
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            if initial:
+                raise
+            self._registry_mtime = previous_mtime
+            print(f"Could not reload the ARCA credentials from {self.path}: {e}")
+            return
+
+        credentials = {}
+        self._failed = False
+        for cuit, spec in entries.items():
+            current = self._credentials.get(cuit)
+            if current is not None and current.spec() == spec and not current.changed():
+                credentials[cuit] = current
+                continue
+            try:
+                credentials[cuit] = Credential(*spec)
+            except (OSError, ValueError, TypeError) as e:
+                print(f"Could not load the ARCA credentials of {cuit}: {e}")
+                self._failed = True
+                if current is not None:
+                    # Keep serving with the previous files, e.g. caught halfway through being replaced
+                    credentials[cuit] = current
+                continue
+            if not initial:
+                print(f" [*] Loaded the ARCA credentials of {cuit} from {spec[0]}")
+        self._credentials = credentials
+
+
+registry = CredentialRegistry()
@@ -0,0 +1,191 @@
+"""
+Encoding of gateway replies.
+
+zeep responses are converted straight to plain Python types (to_builtin) and then
+encoded with the fastest backend installed:
+    - JSON: orjson, then msgspec, then the standard library json module
+    - MessagePack: msgspec, then msgpack
+
+WSFE responses (FECAESolicitar, FECompConsultar) carry Decimal and datetime values that the
+standard json encoder rejects: Decimal amounts are encoded as strings, exactly as ARCA sent
+them (a float would round ImpTotal, ImpIVA or MonCotiz), and dates and datetimes as
+ISO 8601 strings.
+
+The reply format is negotiated through AMQP properties: a request asks for a format with an
+"accept" header or, failing that, gets replies in its own content_type. Anything not
+supported falls back to JSON. Request bodies may be sent in either format.
+"""
+
+import base64
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from zeep.xsd.valueobjects import AnyObject, CompoundValue
+
+from metrics import STAGE_SECONDS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+# Content types accepted as MessagePack
+_MSGPACK_TYPES = {MSGPACK, "application/x-msgpack", "application/vnd.msgpack"}
+
+# Types that need no conversion
+_PLAIN = frozenset((str, int, float, bool, type(None)))
+
+_to_builtin_seconds = STAGE_SECONDS.labels("to_builtin")
+_encode_seconds = STAGE_SECONDS.labels("encode")
+
+
+def to_builtin(obj):
+    """
+    Converts a zeep response into dicts, lists and scalars in a single pass.
+
+    Unlike zeep.helpers.serialize_object followed by json.dumps, this does not build
+    an intermediate OrderedDict copy and also converts the values JSON cannot encode.
+
+    Args:
+        obj: A zeep object, or any nesting of dicts and lists of them
+
+    Returns:
+        The equivalent structure made of dict, list, str, int, float, bool and None,
+        with Decimal amounts as strings
+    """
+    with _to_builtin_seconds.time():
+        return _to_builtin(obj)
+
+
+def _to_builtin(obj):
+    # Leaves are checked inline to avoid a call per scalar, which dominates the cost
+    if type(obj) in _PLAIN:
+        return obj
+    if isinstance(obj, CompoundValue):
+        return {key: value if type(value) in _PLAIN else _to_builtin(value) for key, value in obj.__values__.items()}
+    if isinstance(obj, dict):
+        return {key: value if type(value) in _PLAIN else _to_builtin(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [value if type(value) in _PLAIN else _to_builtin(value) for value in obj]
+    if isinstance(obj, (str, int, float)):
+        # Subclasses of the plain types
+        return obj
+    return _convert_scalar(obj)
+
+
+def _convert_scalar(obj):
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode('ascii')
+    if isinstance(obj, AnyObject):
+        return _to_builtin(obj.value)
+    raise TypeError(f"Cannot encode object of type {type(obj).__name__}")
+
+
+def _json_default(obj):
+    # Fallback for values left in payloads that did not go through to_builtin
+    if isinstance(obj, CompoundValue):
+        return _to_builtin(obj)
+    return _convert_scalar(obj)
+
+
+if orjson is not None:
+    def _encode_json(payload):
+        return orjson.dumps(payload, default=_json_default)
+elif msgspec is not None:
+    _msgspec_json = msgspec.json.Encoder(enc_hook=_json_default)
+
+    def _encode_json(payload):
+        return _msgspec_json.encode(payload)
+else:
+    def _encode_json(payload):
+        return json.dumps(payload, separators=(',', ':'), default=_json_default).encode()
+
+
+if msgspec is not None:
+    _msgspec_msgpack = msgspec.msgpack.Encoder(enc_hook=_json_default)
+
+    def _encode_msgpack(payload):
+        return _msgspec_msgpack.encode(payload)
+
+    _decode_msgpack = msgspec.msgpack.decode
+elif msgpack is not None:
+    def _encode_msgpack(payload):
+        return msgpack.packb(payload, default=_json_default)
+
+    def _decode_msgpack(body):
+        return msgpack.unpackb(body)
+else:
+    _encode_msgpack = None
+    _decode_msgpack = None
+
+
+def negotiate(content_type=None, headers=None):
+    """
+    Returns the content type of the reply to a request.
+
+    Args:
+        content_type (str): content_type property of the request
+        headers (dict): headers of the request, possibly with an "accept" entry
+
+    Returns:
+        str: JSON or MSGPACK
+    """
+    wanted = (headers or {}).get("accept") or content_type
+    if wanted and wanted.split(';')[0].strip().lower() in _MSGPACK_TYPES and _encode_msgpack is not None:
+        return MSGPACK
+    return JSON
+
+
+def encode(payload, content_type=JSON):
+    """
+    Encodes a reply payload.
+
+    Args:
+        payload: Builtin types, ideally already converted with to_builtin
+        content_type (str): JSON or MSGPACK, as returned by negotiate()
+
+    Returns:
+        bytes: The encoded payload
+    """
+    with _encode_seconds.time():
+        if content_type == MSGPACK:
+            return _encode_msgpack(payload)
+        return _encode_json(payload)
+
+
+def decode(body, content_type=None):
+    """
+    Decodes a request body sent as JSON or MessagePack.
+
+    Raises:
+        ValueError: If the body cannot be decoded
+    """
+    if content_type and content_type.split(';')[0].strip().lower() in _MSGPACK_TYPES:
+        if _decode_msgpack is None:
+            raise ValueError("MessagePack requests need msgspec or msgpack installed")
+        try:
+            return _decode_msgpack(body)
+        except Exception as e:
+            raise ValueError(f"Invalid MessagePack in message body: {e}")
+    try:
+        return json.loads(body)
+    except json.JSONDecodeError:
+        raise ValueError(f"Invalid JSON in message body: {body}")
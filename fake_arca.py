@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+"""
+Offline stand-in for the ARCA web services (WSAA and WSFEv1) for load and regression tests.
+
+Implements WSAA loginCms and the WSFEv1 operations FECompUltimoAutorizado, FECAESolicitar
+and FECompConsultar over HTTP, serving its own WSDLs so zeep can use it as well:
+    - loginCms issues a TA per (certificate, service) and answers with the
+      "El CEE ya posee un TA valido para el acceso al WSN solicitado" fault while it is valid
+    - Invoices are numbered per (cuit, pto_vta, cbte_tipo): numbers out of sequence are
+      rejected with observation 10016, approved ones get a CAE and can be read back with
+      FECompConsultar
+    - Latency, error and fault rates and a rate limit are configurable, so production
+      latency profiles can be reproduced on a laptop
+
+Latency specs (milliseconds) are given per operation or as a default for all of them:
+    fixed:MS | uniform:MIN,MAX | normal:MEAN,STDDEV | lognormal:MEDIAN,SIGMA
+
+State lives in memory and is lost on restart. CMS signatures and tokens are not verified.
+
+Usage:
+    python fake_arca.py [--port 8080] [--latency lognormal:120,0.4]
+        [--latency FECAESolicitar=lognormal:350,0.6] [--error-rate 0.01] [--fault-rate 0.001]
+        [--rate-limit 50]
+
+Then point the gateway at it:
+    export ARCA_WSAA_WSDL=http://localhost:8080/ws/services/LoginCms?WSDL
+    export ARCA_WSFE_WSDL=http://localhost:8080/wsfev1/service.asmx?WSDL
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+from cryptography.hazmat.primitives.serialization import pkcs7
+
+WSAA_PATH = "/ws/services/LoginCms"
+WSFE_PATH = "/wsfev1/service.asmx"
+WSAA_NS = "http://wsaa.view.sua.dvadac.desein.afip.gov"
+WSFE_NS = "http://ar.gov.afip.dif.FEV1/"
+SOAP_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+
+TA_ALREADY_VALID_ERROR = "El CEE ya posee un TA valido para el acceso al WSN solicitado"
+
+# Request elements that are always lists
+LIST_TAGS = {"FECAEDetRequest", "CbteAsoc", "Tributo", "AlicIva", "Opcional", "Comprador", "Actividad"}
+
+OBS_NUMBERING = (10016, "El numero o fecha del comprobante no se corresponde con el proximo a autorizar. "
+                        "Consultar metodo FECompUltimoAutorizado.")
+OBS_TOTAL = (10048, "El campo 'Importe Total' ImpTotal, debe ser igual a la suma de ImpTotConc + ImpNeto + "
+                    "ImpOpEx + ImpTrib + ImpIVA.")
+ERR_AUTH = (600, "ValidacionDeToken: No validaron las firmas digitales")
+ERR_CANT_REG = (10001, "La cantidad de registros (CantReg) no coincide con los comprobantes informados")
+ERR_NOT_FOUND = (602, "No existen datos en nuestros registros para los parametros ingresados.")
+ERR_INTERNAL = (501, "Error interno de base de datos")
+
+
+def parse_latency(spec):
+    """
+    Parses a latency spec into a function returning a delay in seconds.
+
+    Args:
+        spec (str): fixed:MS, uniform:MIN,MAX, normal:MEAN,STDDEV or lognormal:MEDIAN,SIGMA
+
+    Raises:
+        ValueError: If the spec is not valid
+    """
+    kind, _, params = spec.partition(":")
+    try:
+        values = [float(value) for value in params.split(",")] if params else []
+    except ValueError:
+        raise ValueError(f"Invalid latency spec: {spec}")
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0] / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(*values) / 1000
+    if kind == "normal" and len(values) == 2:
+        return lambda: max(random.gauss(*values), 0) / 1000
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        return lambda: median * random.lognormvariate(0, sigma) / 1000
+    raise ValueError(f"Invalid latency spec: {spec}")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` requests per second with bursts of `rate`.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Returns True if a request may proceed."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Fault(Exception):
+    """A SOAP fault to return to the caller."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _xml(name, value):
+    """Renders a value as XML: dicts as children, lists as repeated elements, None omitted."""
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return "".join(_xml(name, item) for item in value)
+    if isinstance(value, dict):
+        return f"<{name}>{''.join(_xml(key, item) for key, item in value.items())}</{name}>"
+    return f"<{name}>{escape(str(value))}</{name}>"
+
+
+def _to_dict(element):
+    """Converts a request element into dicts, lists and strings, ignoring namespaces."""
+    children = list(element)
+    if not children:
+        return element.text
+    result = {}
+    for child in children:
+        tag = child.tag.rpartition("}")[2]
+        if tag in LIST_TAGS:
+            result.setdefault(tag, []).append(_to_dict(child))
+        else:
+            result[tag] = _to_dict(child)
+    return result
+
+
+def _messages(kind, items):
+    return {kind: [{"Code": code, "Msg": msg} for code, msg in items]} if items else None
+
+
+def _number(value, default=0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class FakeArca:
+    """
+    State and behaviour of the fake services.
+
+    Args:
+        latency (dict): Operation name (or None for the default) -> latency function
+        error_rate (float): Probability of answering a WSFEv1 call with error 501
+        fault_rate (float): Probability of answering a WSFEv1 call with a SOAP fault
+        rate_limit (float): WSFEv1 calls per second allowed, 0 for no limit
+        ta_lifetime (timedelta): Lifetime of the issued TAs
+    """
+
+    def __init__(self, latency=None, error_rate=0.0, fault_rate=0.0, rate_limit=0, ta_lifetime=timedelta(hours=12)):
+        self.latency = latency or {}
+        self.error_rate = error_rate
+        self.fault_rate = fault_rate
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.ta_lifetime = ta_lifetime
+        self._lock = threading.Lock()
+        self._tickets = {}  # (certificate subject, service) -> expiration
+        self._last = {}  # (cuit, pto_vta, cbte_tipo) -> last authorized number
+        self._invoices = {}  # (cuit, pto_vta, cbte_tipo, number) -> ResultGet
+        self.stats = {}
+
+    def count(self, operation, outcome):
+        with self._lock:
+            counters = self.stats.setdefault(operation, {})
+            counters[outcome] = counters.get(outcome, 0) + 1
+
+    def delay(self, operation):
+        latency = self.latency.get(operation) or self.latency.get(None)
+        if latency is not None:
+            time.sleep(latency())
+
+    # WSAA
+
+    def login_cms(self, cms_base64):
+        """
+        Issues a TA for the service requested in a signed loginTicketRequest.
+
+        Returns:
+            str: The loginTicketResponse XML
+
+        Raises:
+            Fault: If the CMS cannot be read or a TA for it is still valid
+        """
+        try:
+            cms = base64.b64decode(cms_base64 or "", validate=True)
+        except ValueError:
+            raise Fault("ns1:cms.bad.base64", "No se ha podido decodificar el BASE64")
+        match = re.search(rb"<service>([^<]+)</service>", cms)
+        if match is None:
+            raise Fault("ns1:cms.bad", "El CMS no es valido")
+        service = match.group(1).decode()
+        try:
+            subject = pkcs7.load_der_pkcs7_certificates(cms)[0].subject.rfc4514_string()
+        except (ValueError, IndexError):
+            subject = "CN=unknown"
+
+        now = datetime.now().astimezone().replace(microsecond=0)
+        with self._lock:
+            expiration = self._tickets.get((subject, service))
+            if expiration is not None and expiration > now:
+                raise Fault("ns1:coe.alreadyAuthenticated", TA_ALREADY_VALID_ERROR)
+            expiration = now + self.ta_lifetime
+            self._tickets[(subject, service)] = expiration
+
+        token = base64.b64encode(os.urandom(600)).decode()
+        sign = base64.b64encode(os.urandom(128)).decode()
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<loginTicketResponse version="1.0"><header>'
+            '<source>CN=wsaahomo, O=AFIP, C=AR, SERIALNUMBER=CUIT 33693450239</source>'
+            f'<destination>{escape(subject)}</destination>'
+            f'<uniqueId>{random.randint(1, 2 ** 31)}</uniqueId>'
+            f'<generationTime>{now.isoformat()}</generationTime>'
+            f'<expirationTime>{expiration.isoformat()}</expirationTime>'
+            f'</header><credentials><token>{token}</token><sign>{sign}</sign></credentials>'
+            '</loginTicketResponse>'
+        )
+
+    # WSFEv1
+
+    @staticmethod
+    def _auth_errors(request):
+        auth = request.get("Auth") or {}
+        if not (auth.get("Token") and auth.get("Sign") and auth.get("Cuit")):
+            return [ERR_AUTH]
+        return []
+
+    def ultimo_autorizado(self, request):
+        errors = self._auth_errors(request)
+        cuit = (request.get("Auth") or {}).get("Cuit")
+        pto_vta, cbte_tipo = int(request.get("PtoVta") or 0), int(request.get("CbteTipo") or 0)
+        with self._lock:
+            last = self._last.get((cuit, pto_vta, cbte_tipo), 0)
+        return {
+            "PtoVta": pto_vta,
+            "CbteTipo": cbte_tipo,
+            "CbteNro": None if errors else last,
+            "Errors": _messages("Err", errors),
+        }
+
+    def cae_solicitar(self, request):
+        cuit = (request.get("Auth") or {}).get("Cuit")
+        fe_cae_req = request.get("FeCAEReq") or {}
+        header = fe_cae_req.get("FeCabReq") or {}
+        details = (fe_cae_req.get("FeDetReq") or {}).get("FECAEDetRequest") or []
+        pto_vta, cbte_tipo = int(header.get("PtoVta") or 0), int(header.get("CbteTipo") or 0)
+        cant_reg = int(header.get("CantReg") or 0)
+        now = datetime.now()
+        cab_resp = {
+            "Cuit": cuit, "PtoVta": pto_vta, "CbteTipo": cbte_tipo, "FchProceso": now.strftime("%Y%m%d%H%M%S"),
+            "CantReg": cant_reg, "Resultado": "R", "Reproceso": "N",
+        }
+
+        errors = self._auth_errors(request)
+        if not errors and cant_reg != len(details):
+            errors = [ERR_CANT_REG]
+        if errors:
+            return {"FeCabResp": cab_resp, "Errors": _messages("Err", errors)}
+
+        key = (cuit, pto_vta, cbte_tipo)
+        results = []
+        with self._lock:
+            for detail in details:
+                number = int(detail.get("CbteDesde") or 0)
+                observations = []
+                if number != self._last.get(key, 0) + 1 or int(detail.get("CbteHasta") or 0) != number:
+                    observations.append(OBS_NUMBERING)
+                parts = sum(_number(detail.get(field)) for field in ("ImpTotConc", "ImpNeto", "ImpOpEx", "ImpTrib", "ImpIVA"))
+                if abs(_number(detail.get("ImpTotal")) - parts) > 0.01:
+                    observations.append(OBS_TOTAL)
+
+                result = {
+                    "Concepto": detail.get("Concepto"), "DocTipo": detail.get("DocTipo"), "DocNro": detail.get("DocNro"),
+                    "CbteDesde": number, "CbteHasta": detail.get("CbteHasta"), "CbteFch": detail.get("CbteFch") or now.strftime("%Y%m%d"),
+                    "Resultado": "R" if observations else "A",
+                    "Observaciones": _messages("Obs", observations),
+                    "CAE": None, "CAEFchVto": None,
+                }
+                if not observations:
+                    result["CAE"] = str(random.randint(10 ** 13, 10 ** 14 - 1))
+                    result["CAEFchVto"] = (now + timedelta(days=10)).strftime("%Y%m%d")
+                    self._last[key] = number
+                    self._invoices[key + (number,)] = dict(
+                        detail, Resultado="A", CodAutorizacion=result["CAE"], EmisionTipo="CAE",
+                        FchVto=result["CAEFchVto"], FchProceso=cab_resp["FchProceso"], PtoVta=pto_vta, CbteTipo=cbte_tipo,
+                    )
+                results.append(result)
+
+        approved = sum(1 for result in results if result["Resultado"] == "A")
+        cab_resp["Resultado"] = "A" if approved == len(results) else "R" if approved == 0 else "P"
+        return {"FeCabResp": cab_resp, "FeDetResp": {"FECAEDetResponse": results}}
+
+    def comp_consultar(self, request):
+        errors = self._auth_errors(request)
+        if errors:
+            return {"Errors": _messages("Err", errors)}
+        cuit = (request.get("Auth") or {}).get("Cuit")
+        query = request.get("FeCompConsReq") or {}
+        key = (cuit, int(query.get("PtoVta") or 0), int(query.get("CbteTipo") or 0), int(query.get("CbteNro") or 0))
+        with self._lock:
+            invoice = self._invoices.get(key)
+        if invoice is None:
+            return {"Errors": _messages("Err", [ERR_NOT_FOUND])}
+        return {"ResultGet": _result_get(invoice)}
+
+
+def _result_get(invoice):
+    # Same element order as the FECompConsResponse type of the WSDL
+    ordered = {name: invoice.get(name) for name, _ in FECAE_DET_REQUEST}
+    for name, _ in FECOMP_CONS_RESPONSE_EXTRA:
+        ordered[name] = invoice.get(name)
+    return ordered
+
+
+OPERATIONS = {
+    "FECompUltimoAutorizado": FakeArca.ultimo_autorizado,
+    "FECAESolicitar": FakeArca.cae_solicitar,
+    "FECompConsultar": FakeArca.comp_consultar,
+}
+
+
+# WSDLs. Types are declared as (element, type) sequences; "*" marks repeated elements.
+
+FECAE_DET_REQUEST = [
+    ("Concepto", "int"), ("DocTipo", "int"), ("DocNro", "long"), ("CbteDesde", "long"), ("CbteHasta", "long"),
+    ("CbteFch", "string"), ("ImpTotal", "double"), ("ImpTotConc", "double"), ("ImpNeto", "double"),
+    ("ImpOpEx", "double"), ("ImpTrib", "double"), ("ImpIVA", "double"), ("FchServDesde", "string"),
+    ("FchServHasta", "string"), ("FchVtoPago", "string"), ("MonId", "string"), ("MonCotiz", "double"),
+    ("CanMisMonExt", "string"), ("CondicionIVAReceptorId", "int"), ("CbtesAsoc", "ArrayOfCbteAsoc"),
+    ("Tributos", "ArrayOfTributo"), ("Iva", "ArrayOfAlicIva"), ("Opcionales", "ArrayOfOpcional"),
+    ("Compradores", "ArrayOfComprador"), ("PeriodoAsoc", "Periodo"), ("Actividades", "ArrayOfActividad"),
+]
+FECOMP_CONS_RESPONSE_EXTRA = [
+    ("Resultado", "string"), ("CodAutorizacion", "string"), ("EmisionTipo", "string"), ("FchVto", "string"),
+    ("FchProceso", "string"), ("Observaciones", "ArrayOfObs"), ("PtoVta", "int"), ("CbteTipo", "int"),
+]
+WSFE_TYPES = {
+    "FEAuthRequest": [("Token", "string"), ("Sign", "string"), ("Cuit", "long")],
+    "FECAERequest": [("FeCabReq", "FECAECabRequest"), ("FeDetReq", "ArrayOfFECAEDetRequest")],
+    "FECAECabRequest": [("CantReg", "int"), ("PtoVta", "int"), ("CbteTipo", "int")],
+    "ArrayOfFECAEDetRequest": [("*FECAEDetRequest", "FECAEDetRequest")],
+    "FECAEDetRequest": FECAE_DET_REQUEST,
+    "ArrayOfCbteAsoc": [("*CbteAsoc", "CbteAsoc")],
+    "CbteAsoc": [("Tipo", "int"), ("PtoVta", "int"), ("Nro", "long"), ("Cuit", "string"), ("CbteFch", "string")],
+    "ArrayOfTributo": [("*Tributo", "Tributo")],
+    "Tributo": [("Id", "short"), ("Desc", "string"), ("BaseImp", "double"), ("Alic", "double"), ("Importe", "double")],
+    "ArrayOfAlicIva": [("*AlicIva", "AlicIva")],
+    "AlicIva": [("Id", "int"), ("BaseImp", "double"), ("Importe", "double")],
+    "ArrayOfOpcional": [("*Opcional", "Opcional")],
+    "Opcional": [("Id", "string"), ("Valor", "string")],
+    "ArrayOfComprador": [("*Comprador", "Comprador")],
+    "Comprador": [("DocTipo", "int"), ("DocNro", "long"), ("Porcentaje", "double")],
+    "Periodo": [("FchDesde", "string"), ("FchHasta", "string")],
+    "ArrayOfActividad": [("*Actividad", "Actividad")],
+    "Actividad": [("Id", "long")],
+    "FECAEResponse": [("FeCabResp", "FECAECabResponse"), ("FeDetResp", "ArrayOfFECAEDetResponse"),
+                      ("Events", "ArrayOfEvt"), ("Errors", "ArrayOfErr")],
+    "FECAECabResponse": [("Cuit", "long"), ("PtoVta", "int"), ("CbteTipo", "int"), ("FchProceso", "string"),
+                         ("CantReg", "int"), ("Resultado", "string"), ("Reproceso", "string")],
+    "ArrayOfFECAEDetResponse": [("*FECAEDetResponse", "FECAEDetResponse")],
+    "FECAEDetResponse": [("Concepto", "int"), ("DocTipo", "int"), ("DocNro", "long"), ("CbteDesde", "long"),
+                         ("CbteHasta", "long"), ("CbteFch", "string"), ("Resultado", "string"),
+                         ("Observaciones", "ArrayOfObs"), ("CAE", "string"), ("CAEFchVto", "string")],
+    "ArrayOfObs": [("*Obs", "Obs")],
+    "Obs": [("Code", "int"), ("Msg", "string")],
+    "ArrayOfErr": [("*Err", "Err")],
+    "Err": [("Code", "int"), ("Msg", "string")],
+    "ArrayOfEvt": [("*Evt", "Evt")],
+    "Evt": [("Code", "int"), ("Msg", "string")],
+    "FERecuperaLastCbteResponse": [("PtoVta", "int"), ("CbteTipo", "int"), ("CbteNro", "int"),
+                                   ("Errors", "ArrayOfErr"), ("Events", "ArrayOfEvt")],
+    "FECompConsultaReq": [("CbteTipo", "int"), ("CbteNro", "long"), ("PtoVta", "int")],
+    "FECompConsultaResponse": [("ResultGet", "FECompConsResponse"), ("Errors", "ArrayOfErr"), ("Events", "ArrayOfEvt")],
+    "FECompConsResponse": FECAE_DET_REQUEST + FECOMP_CONS_RESPONSE_EXTRA,
+}
+WSFE_ELEMENTS = {
+    "FECompUltimoAutorizado": [("Auth", "FEAuthRequest"), ("PtoVta", "int"), ("CbteTipo", "int")],
+    "FECompUltimoAutorizadoResponse": [("FECompUltimoAutorizadoResult", "FERecuperaLastCbteResponse")],
+    "FECAESolicitar": [("Auth", "FEAuthRequest"), ("FeCAEReq", "FECAERequest")],
+    "FECAESolicitarResponse": [("FECAESolicitarResult", "FECAEResponse")],
+    "FECompConsultar": [("Auth", "FEAuthRequest"), ("FeCompConsReq", "FECompConsultaReq")],
+    "FECompConsultarResponse": [("FECompConsultarResult", "FECompConsultaResponse")],
+}
+WSAA_ELEMENTS = {
+    "loginCms": [("in0", "string")],
+    "loginCmsResponse": [("loginCmsReturn", "string")],
+}
+
+
+def _sequence(fields):
+    parts = []
+    for name, type_name in fields:
+        prefix = "xsd" if type_name in ("string", "int", "long", "short", "double") else "tns"
+        occurs = ' minOccurs="0" maxOccurs="unbounded"' if name.startswith("*") else ' minOccurs="0"'
+        parts.append(f'<xsd:element name="{name.lstrip("*")}" type="{prefix}:{type_name}"{occurs}/>')
+    return f"<xsd:sequence>{''.join(parts)}</xsd:sequence>"
+
+
+def build_wsdl(namespace, service, elements, types, location):
+    """
+    Renders a document/literal WSDL with one operation per request element.
+
+    Args:
+        namespace (str): Target namespace
+        service (str): Service name
+        elements (dict): Operation and response element name -> fields
+        types (dict): Complex type name -> fields
+        location (str): Endpoint URL
+
+    Returns:
+        bytes: The WSDL
+    """
+    schema = "".join(f'<xsd:complexType name="{name}">{_sequence(fields)}</xsd:complexType>' for name, fields in types.items())
+    schema += "".join(
+        f'<xsd:element name="{name}"><xsd:complexType>{_sequence(fields)}</xsd:complexType></xsd:element>'
+        for name, fields in elements.items()
+    )
+    operations = [name for name in elements if not name.endswith("Response")]
+    messages = "".join(
+        f'<wsdl:message name="{name}"><wsdl:part name="parameters" element="tns:{name}"/></wsdl:message>'
+        f'<wsdl:message name="{name}Response"><wsdl:part name="parameters" element="tns:{name}Response"/></wsdl:message>'
+        for name in operations
+    )
+    port_type = "".join(
+        f'<wsdl:operation name="{name}"><wsdl:input message="tns:{name}"/><wsdl:output message="tns:{name}Response"/></wsdl:operation>'
+        for name in operations
+    )
+    binding = "".join(
+        f'<wsdl:operation name="{name}"><soap:operation soapAction="{namespace.rstrip("/")}/{name}" style="document"/>'
+        '<wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>'
+        for name in operations
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        f'<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+        f'xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:tns="{namespace}" targetNamespace="{namespace}">'
+        f'<wsdl:types><xsd:schema elementFormDefault="qualified" targetNamespace="{namespace}">{schema}</xsd:schema></wsdl:types>'
+        f'{messages}<wsdl:portType name="{service}PortType">{port_type}</wsdl:portType>'
+        f'<wsdl:binding name="{service}Binding" type="tns:{service}PortType">'
+        f'<soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>{binding}</wsdl:binding>'
+        f'<wsdl:service name="{service}"><wsdl:port name="{service}Port" binding="tns:{service}Binding">'
+        f'<soap:address location="{escape(location)}"/></wsdl:port></wsdl:service></wsdl:definitions>'
+    ).encode("utf-8")
+
+
+def _envelope(body):
+    return (
+        f'<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="{SOAP_NS}"><soap:Body>{body}</soap:Body></soap:Envelope>'
+    ).encode("utf-8")
+
+
+def _fault(code, message):
+    return _envelope(f"<soap:Fault><faultcode>{escape(code)}</faultcode><faultstring>{escape(message)}</faultstring></soap:Fault>")
+
+
+class FakeArcaHandler(BaseHTTPRequestHandler):
+    """HTTP/1.1 keep-alive handler; `server.arca` is the FakeArca instance."""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes: without TCP_NODELAY every reply waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="text/xml; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        location = f"http://{self.headers.get('Host', '%s:%s' % self.server.server_address[:2])}{path}"
+        if path == WSAA_PATH:
+            self._send(200, build_wsdl(WSAA_NS, "LoginCMSService", WSAA_ELEMENTS, {}, location))
+        elif path == WSFE_PATH:
+            self._send(200, build_wsdl(WSFE_NS, "Service", WSFE_ELEMENTS, WSFE_TYPES, location))
+        elif path == "/stats":
+            self._send(200, json.dumps(self.server.arca.stats).encode(), "application/json")
+        else:
+            self._send(404, b"Not Found", "text/plain")
+
+    def do_POST(self):
+        arca = self.server.arca
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        path = self.path.split("?", 1)[0]
+        try:
+            soap_body = ET.fromstring(body).find(f"{{{SOAP_NS}}}Body")
+            request = soap_body[0]
+        except (ET.ParseError, TypeError, IndexError):
+            self._send(400, _fault("soap:Client", "Invalid SOAP request"))
+            return
+        operation = request.tag.rpartition("}")[2]
+
+        if path == WSAA_PATH and operation == "loginCms":
+            arca.delay(operation)
+            try:
+                ticket = arca.login_cms(_to_dict(request).get("in0") if len(request) else None)
+            except Fault as e:
+                arca.count(operation, "fault")
+                self._send(500, _fault(e.code, e.message))
+                return
+            arca.count(operation, "ok")
+            self._send(200, _envelope(
+                f'<loginCmsResponse xmlns="{WSAA_NS}"><loginCmsReturn>{escape(ticket)}</loginCmsReturn></loginCmsResponse>'
+            ))
+            return
+
+        handler = OPERATIONS.get(operation) if path == WSFE_PATH else None
+        if handler is None:
+            self._send(500, _fault("soap:Client", f"Unknown operation {operation}"))
+            return
+        if arca.rate_limiter is not None and not arca.rate_limiter.acquire():
+            arca.count(operation, "throttled")
+            self._send(503, b"Service Unavailable", "text/plain", {"Retry-After": "1"})
+            return
+        arca.delay(operation)
+        if random.random() < arca.fault_rate:
+            arca.count(operation, "fault")
+            self._send(500, _fault("soap:Server", "Server was unable to process request."))
+            return
+        if random.random() < arca.error_rate:
+            arca.count(operation, "error")
+            result = {"Errors": _messages("Err", [ERR_INTERNAL])}
+        else:
+            arca.count(operation, "ok")
+            result = handler(arca, _to_dict(request) or {})
+        self._send(200, _envelope(
+            f'<{operation}Response xmlns="{WSFE_NS}">{_xml(f"{operation}Result", result)}</{operation}Response>'
+        ))
+
+
+def make_server(arca, host="127.0.0.1", port=8080):
+    """
+    Creates the HTTP server of a FakeArca, not yet serving. Use port 0 for a free port.
+
+    Returns:
+        ThreadingHTTPServer: Call serve_forever() (e.g. in a thread) and shutdown() when done
+    """
+    server = ThreadingHTTPServer((host, port), FakeArcaHandler)
+    server.daemon_threads = True
+    server.arca = arca
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--latency", action="append", default=[], metavar="[OPERATION=]SPEC",
+                        help="Latency of an operation (loginCms, FECAESolicitar, ...) or of all of them")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of WSFEv1 calls answered with error 501")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="Fraction of WSFEv1 calls answered with a SOAP fault")
+    parser.add_argument("--rate-limit", type=float, default=0, help="WSFEv1 calls per second, 0 for no limit")
+    parser.add_argument("--ta-lifetime", type=float, default=12 * 60, help="Lifetime of the issued TAs in minutes")
+    args = parser.parse_args()
+
+    latency = {}
+    for value in args.latency:
+        operation, _, spec = value.rpartition("=")
+        try:
+            latency[operation or None] = parse_latency(spec)
+        except ValueError as e:
+            parser.error(str(e))
+
+    arca = FakeArca(latency, args.error_rate, args.fault_rate, args.rate_limit, timedelta(minutes=args.ta_lifetime))
+    server = make_server(arca, args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"Fake ARCA listening on http://{host}:{port}")
+    print(f"    export ARCA_WSAA_WSDL=http://{host}:{port}{WSAA_PATH}?WSDL")
+    print(f"    export ARCA_WSFE_WSDL=http://{host}:{port}{WSFE_PATH}?WSDL")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
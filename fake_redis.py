@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Offline stand-in for a Redis server, to run the redis TA store (ta_store.py) without one.
+
+Speaks RESP2 and implements the commands the gateway uses: PING, AUTH, SELECT, GET,
+SET (EX, PX, NX, XX), DEL, INCR, EXISTS, PTTL, WATCH, UNWATCH, MULTI, EXEC, DISCARD and
+FLUSHALL. Keys expire like in Redis, and EXEC aborts when a watched key was modified,
+expired or deleted since WATCH, so the lease and fencing logic behaves as against Redis.
+
+State lives in memory, in a single database, and is lost on restart. AUTH accepts any password.
+
+Usage:
+    python fake_redis.py [--port 6379]
+
+Then point the gateway at it:
+    export ARCA_TA_STORE=redis
+    export ARCA_TA_STORE_URL=redis://localhost:6379/0
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+
+
+class FakeRedis:
+    """The keyspace: values, expirations and a version per key for WATCH."""
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}  # key -> monotonic deadline
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def _touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _expire(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and time.monotonic() >= deadline:
+            del self.values[key]
+            del self.expires[key]
+            self._touch(key)
+
+    def get(self, key):
+        self._expire(key)
+        return self.values.get(key)
+
+    def version(self, key):
+        self._expire(key)
+        return self.versions.get(key, 0)
+
+    def set(self, key, value, ttl=None):
+        self.values[key] = value
+        if ttl is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = time.monotonic() + ttl
+        self._touch(key)
+
+    def delete(self, key):
+        self._expire(key)
+        if key not in self.values:
+            return 0
+        del self.values[key]
+        self.expires.pop(key, None)
+        self._touch(key)
+        return 1
+
+    def run(self, name, args):
+        """
+        Runs a data command. Must hold self.lock.
+
+        Returns:
+            The reply: str (status), bytes (bulk), int, None (nil) or an Exception (error)
+        """
+        if name == "PING":
+            return "PONG"
+        if name in ("AUTH", "SELECT"):
+            return "OK"
+        if name == "GET":
+            return self.get(args[0])
+        if name == "SET":
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            ttl = None
+            for unit, scale in ((b"EX", 1), (b"PX", 0.001)):
+                if unit in options:
+                    ttl = int(args[2 + options.index(unit) + 1]) * scale
+            exists = self.get(key) is not None
+            if (b"NX" in options and exists) or (b"XX" in options and not exists):
+                return None
+            self.set(key, value, ttl)
+            return "OK"
+        if name == "DEL":
+            return sum(self.delete(key) for key in args)
+        if name == "EXISTS":
+            return sum(self.get(key) is not None for key in args)
+        if name == "INCR":
+            try:
+                value = int(self.get(args[0]) or 0) + 1
+            except ValueError:
+                return Exception("ERR value is not an integer or out of range")
+            ttl = self.expires.get(args[0])
+            self.set(args[0], str(value).encode(), None if ttl is None else ttl - time.monotonic())
+            return value
+        if name == "PTTL":
+            if self.get(args[0]) is None:
+                return -2
+            deadline = self.expires.get(args[0])
+            return -1 if deadline is None else int((deadline - time.monotonic()) * 1000)
+        if name == "FLUSHALL":
+            for key in list(self.values):
+                self.delete(key)
+            return "OK"
+        return Exception(f"ERR unknown command '{name}'")
+
+
+# Reply of an EXEC aborted because a watched key changed (nil array)
+ABORTED = object()
+
+
+def encode(reply):
+    if reply is ABORTED:
+        return b"*-1\r\n"
+    if isinstance(reply, Exception):
+        return b"-%s\r\n" % str(reply).encode()
+    if isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode()
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(encode(item) for item in reply)
+    return b"$-1\r\n"
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """One client connection, with its own WATCH and MULTI state."""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline command, e.g. from telnet
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        redis = self.server.redis
+        watched = {}  # key -> version at WATCH
+        queued = None  # commands of an open MULTI
+        while True:
+            try:
+                args = self.read_command()
+            except (OSError, ValueError):
+                return
+            if args is None:
+                return
+            if not args:
+                continue
+            name, args = args[0].decode().upper(), args[1:]
+            with redis.lock:
+                if name == "MULTI":
+                    reply = Exception("ERR MULTI calls can not be nested") if queued is not None else "OK"
+                    if queued is None:
+                        queued = []
+                elif name == "DISCARD":
+                    reply = "OK" if queued is not None else Exception("ERR DISCARD without MULTI")
+                    queued, watched = None, {}
+                elif name == "EXEC":
+                    if queued is None:
+                        reply = Exception("ERR EXEC without MULTI")
+                    elif any(redis.version(key) != version for key, version in watched.items()):
+                        reply = ABORTED
+                    else:
+                        reply = [redis.run(command, command_args) for command, command_args in queued]
+                    queued, watched = None, {}
+                elif name == "WATCH":
+                    if queued is not None:
+                        reply = Exception("ERR WATCH inside MULTI is not allowed")
+                    else:
+                        for key in args:
+                            watched.setdefault(key, redis.version(key))
+                        reply = "OK"
+                elif name == "UNWATCH":
+                    watched = {}
+                    reply = "OK"
+                elif queued is not None:
+                    queued.append((name, args))
+                    reply = "QUEUED"
+                else:
+                    reply = redis.run(name, args)
+            self.wfile.write(encode(reply))
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, redis=None):
+        super().__init__(address, FakeRedisHandler)
+        self.redis = redis or FakeRedis()
+
+
+def make_server(host="127.0.0.1", port=6379):
+    """Returns a FakeRedisServer bound to host:port (port 0 picks a free one)."""
+    return FakeRedisServer((host, port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port)
+    print(f" [*] Fake Redis listening on {args.host}:{server.server_address[1]}. To exit press CTRL+C")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
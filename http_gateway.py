@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+HTTP front-end of the ARCA gateway, for callers that cannot speak AMQP.
+
+Translates REST calls into requests on the 'arca' queues and answers them with the
+worker's reply:
+    - GET /last-invoice/{cuit}/{pto_vta}/{cbte_tipo}: last authorized invoice number
+    - POST /invoices: CAE of an invoice, {"cuit", "pto_vta", "cbte_tipo", "invoice"}, or of
+      a JSON array of them, answered with the array of their replies in the same order
+    - GET /invoices/{cuit}/{pto_vta}/{cbte_tipo}?from=&to=[&chunk_size=&from_chunk=]: every
+      invoice of a number range (bulk_query, see bulk_query.py), streamed as it arrives in
+      newline-delimited JSON, one chunk per line and the end-of-stream marker last
+    - GET /health: connection state and requests in flight
+
+Every HTTP request is forwarded through one long-lived AsyncArcaClient (see
+arca_async_client.py): a single AMQP connection with a pool of ARCA_HTTP_CHANNELS channels,
+publisher confirms and direct reply-to, whose replies are matched to the waiting HTTP
+request by correlation_id. Nothing blocks the event loop, so a process holds thousands of
+concurrent HTTP clients, bounded by ARCA_HTTP_MAX_IN_FLIGHT requests awaiting a reply.
+Connections are kept alive between requests for ARCA_HTTP_KEEPALIVE seconds.
+
+The invoices of an array are published at once and batched by the worker into
+FECAESolicitar calls like any other (see invoice_batcher.py). An Idempotency-Key header is
+passed on as x-idempotency-key (see idempotency.py), suffixed with ":<index>" for the
+invoices of an array, so a client retrying a POST never authorizes its invoices twice.
+
+Replies:
+    - 200 with the worker's reply ({"response": ...}, or an array of replies)
+    - 400 if the request is invalid
+    - 502 if the worker replied with an error
+    - 503 with Retry-After if ARCA calls are being rejected (circuit breaker or concurrency
+      limit, see upstream_guard.py) or the broker is unreachable
+    - 504 if no reply arrived within ARCA_HTTP_TIMEOUT seconds
+An array of invoices is always answered with 200; the status of each invoice is told by
+the "error" and "code" of its reply. So is a range once its first chunk is sent: an
+interrupted stream ends with an error line carrying the resume_chunk to pass as from_chunk.
+
+Usage:
+    python http_gateway.py
+
+Environment Variables:
+    - RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASSWORD: as in merry_go_round.py
+    - ARCA_HTTP_HOST: Address to listen on (default: 0.0.0.0)
+    - ARCA_HTTP_PORT: Port to listen on (default: 8000)
+    - ARCA_HTTP_CHANNELS: AMQP channels requests are spread over (default: 4)
+    - ARCA_HTTP_MAX_IN_FLIGHT: Requests awaiting a reply at the same time (default: 5000)
+    - ARCA_HTTP_TIMEOUT: Seconds to wait for a reply (default: 30)
+    - ARCA_HTTP_KEEPALIVE: Seconds an idle connection is kept open (default: 75)
+    - ARCA_HTTP_MAX_BATCH: Maximum invoices in one POST /invoices (default: 1000)
+"""
+
+import asyncio
+import math
+import os
+from urllib.parse import quote
+
+import aio_pika
+from aiohttp import web
+
+from arca_async_client import AsyncArcaClient
+from encoders import JSON, encode
+import bulk_query
+
+RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
+RABBITMQ_PORT = int(os.environ.get("RABBITMQ_PORT", 5672))
+RABBITMQ_USER = os.environ.get("RABBITMQ_USER", "guest")
+RABBITMQ_PASSWORD = os.environ.get("RABBITMQ_PASSWORD", "guest")
+
+HOST = os.environ.get("ARCA_HTTP_HOST", "0.0.0.0")
+PORT = int(os.environ.get("ARCA_HTTP_PORT", 8000))
+CHANNELS = int(os.environ.get("ARCA_HTTP_CHANNELS", 4))
+MAX_IN_FLIGHT = int(os.environ.get("ARCA_HTTP_MAX_IN_FLIGHT", 5000))
+TIMEOUT = float(os.environ.get("ARCA_HTTP_TIMEOUT", 30))
+KEEPALIVE = float(os.environ.get("ARCA_HTTP_KEEPALIVE", 75))
+MAX_BATCH = int(os.environ.get("ARCA_HTTP_MAX_BATCH", 1000))
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+NDJSON = "application/x-ndjson"
+
+# Error codes of requests rejected without calling ARCA (see upstream_guard.py) or not published
+UNAVAILABLE_CODES = ("upstream_unavailable", "circuit_open", "overloaded", "broker_unavailable")
+
+CLIENT = web.AppKey("client", AsyncArcaClient)
+
+
+def amqp_url():
+    """Returns the AMQP URL of the broker, from the RABBITMQ_* variables."""
+    return (f"amqp://{quote(RABBITMQ_USER, safe='')}:{quote(RABBITMQ_PASSWORD, safe='')}"
+            f"@{RABBITMQ_HOST}:{RABBITMQ_PORT}/")
+
+
+def json_response(payload, status=200, retry_after=None):
+    headers = {"Retry-After": str(max(1, math.ceil(retry_after)))} if retry_after is not None else None
+    return web.Response(body=encode(payload, JSON), status=status, content_type=JSON, headers=headers)
+
+
+async def ask(client, request, headers=None):
+    """
+    Sends a request to the gateway and waits for its reply.
+
+    Returns:
+        dict: The reply, with either a "response" or an "error" key. Requests that got no reply
+            in time or could not be published get an error with code "timeout" or
+            "broker_unavailable".
+    """
+    try:
+        return await client.call(request, TIMEOUT, headers)
+    except asyncio.TimeoutError:
+        return {"error": "No reply from the gateway within the timeout", "code": "timeout"}
+    except (aio_pika.exceptions.AMQPError, ConnectionError) as e:
+        return {"error": f"Message broker unavailable: {e}", "code": "broker_unavailable", "retry_after": 1}
+
+
+def reply_status(reply):
+    """
+    Returns the HTTP status of a reply of ask().
+
+    Args:
+        reply (dict): The reply, with either a "response" or an "error" key
+    """
+    if "error" not in reply:
+        return 200
+    code = reply.get("code")
+    if code == "timeout":
+        return 504
+    if code in UNAVAILABLE_CODES:
+        return 503
+    return 502
+
+
+def reply_response(reply):
+    """Returns the HTTP response of a reply of ask()."""
+    status = reply_status(reply)
+    return json_response(reply, status, reply.get("retry_after") if status == 503 else None)
+
+
+def invoice_request(item):
+    """
+    Builds the authorize request of an invoice in a POST /invoices body.
+
+    Raises:
+        ValueError: If cuit, pto_vta, cbte_tipo or invoice are missing
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Each invoice must be a JSON object")
+    if not item.get("cuit") or not item.get("pto_vta") or not item.get("cbte_tipo"):
+        raise ValueError("Missing required parameters: cuit, pto_vta, cbte_tipo")
+    if not isinstance(item.get("invoice"), dict):
+        raise ValueError("Missing required parameter: invoice")
+    return {
+        "operation": "authorize",
+        "cuit": str(item["cuit"]),
+        "pto_vta": str(item["pto_vta"]),
+        "cbte_tipo": str(item["cbte_tipo"]),
+        "invoice": item["invoice"],
+    }
+
+
+async def last_invoice(request):
+    """GET /last-invoice/{cuit}/{pto_vta}/{cbte_tipo}"""
+    info = request.match_info
+    return reply_response(await ask(request.app[CLIENT], {
+        "operation": "last_invoice",
+        "cuit": info["cuit"],
+        "pto_vta": info["pto_vta"],
+        "cbte_tipo": info["cbte_tipo"],
+    }))
+
+
+async def invoices(request):
+    """POST /invoices, with one invoice or an array of them"""
+    try:
+        body = await request.json()
+    except ValueError:
+        return json_response({"error": "Request body must be JSON"}, 400)
+
+    batch = isinstance(body, list)
+    items = body if batch else [body]
+    if not items:
+        return json_response({"error": "No invoices in the request"}, 400)
+    if len(items) > MAX_BATCH:
+        return json_response({"error": f"At most {MAX_BATCH} invoices per request"}, 400)
+    try:
+        authorize_requests = [invoice_request(item) for item in items]
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+
+    def headers(index):
+        if not key:
+            return None
+        return {"x-idempotency-key": f"{key}:{index}" if batch else key}
+
+    client = request.app[CLIENT]
+    replies = await asyncio.gather(
+        *(ask(client, authorize_request, headers(index)) for index, authorize_request in enumerate(authorize_requests))
+    )
+    if not batch:
+        return reply_response(replies[0])
+    # Every invoice of an array carries its own outcome
+    return json_response(replies)
+
+
+async def invoice_range(request):
+    """GET /invoices/{cuit}/{pto_vta}/{cbte_tipo}?from=&to=[&chunk_size=&from_chunk=], as NDJSON"""
+    data = dict(request.match_info)
+    data.update((name, request.query[name]) for name in ("from", "to", "chunk_size", "from_chunk") if name in request.query)
+    try:
+        bulk_query.validate(data)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    # The chunk size is always sent, so a resumed stream is chunked the same way
+    replies = request.app[CLIENT].bulk_query(
+        data["cuit"], data["pto_vta"], data["cbte_tipo"], data["from"], data["to"],
+        data["from_chunk"], data["chunk_size"], TIMEOUT,
+    )
+    response = None
+    next_chunk = data["from_chunk"]
+    try:
+        async for reply in replies:
+            if response is None:
+                if "error" in reply:
+                    return reply_response(reply)
+                response = web.StreamResponse(headers={"Content-Type": NDJSON})
+                response.enable_chunked_encoding()
+                await response.prepare(request)
+            if "chunk" in reply:
+                next_chunk = reply["chunk"] + 1
+            await response.write(encode(reply, JSON) + b"\n")
+    except asyncio.TimeoutError:
+        reply = {"error": "No reply from the gateway within the timeout", "code": "timeout"}
+    except (aio_pika.exceptions.AMQPError, ConnectionError) as e:
+        reply = {"error": f"Message broker unavailable: {e}", "code": "broker_unavailable", "retry_after": 1}
+    else:
+        reply = None
+    finally:
+        await replies.aclose()
+
+    if reply is not None:
+        if response is None:
+            return reply_response(reply)
+        await response.write(encode(bulk_query.interrupted_reply(reply, next_chunk), JSON) + b"\n")
+    await response.write_eof()
+    return response
+
+
+async def health(request):
+    """GET /health"""
+    client = request.app[CLIENT]
+    connected = client.connection is not None and not client.connection.is_closed
+    return json_response({"connected": connected, "pending": client.pending}, 200 if connected else 503)
+
+
+async def start_client(app):
+    app[CLIENT] = await AsyncArcaClient(amqp_url(), max_in_flight=MAX_IN_FLIGHT, channels=CHANNELS).connect()
+    print(f" [*] Connected to RabbitMQ at {RABBITMQ_HOST}:{RABBITMQ_PORT} with {CHANNELS} channels")
+
+
+async def close_client(app):
+    await app[CLIENT].close()
+
+
+def make_app(client=None):
+    """
+    Returns the aiohttp application.
+
+    Args:
+        client (AsyncArcaClient, optional): An already connected client. By default one is
+            connected on startup and closed on cleanup.
+    """
+    app = web.Application()
+    app.router.add_get(r"/last-invoice/{cuit:\d+}/{pto_vta:\d+}/{cbte_tipo:\d+}", last_invoice)
+    app.router.add_post("/invoices", invoices)
+    app.router.add_get(r"/invoices/{cuit:\d+}/{pto_vta:\d+}/{cbte_tipo:\d+}", invoice_range)
+    app.router.add_get("/health", health)
+    if client is None:
+        app.on_startup.append(start_client)
+        app.on_cleanup.append(close_client)
+    else:
+        app[CLIENT] = client
+    return app
+
+
+def main():
+    print(f" [*] ARCA HTTP gateway listening on {HOST}:{PORT}. To exit press CTRL+C")
+    # No access log: formatting a line per request costs more than forwarding it
+    web.run_app(make_app(), host=HOST, port=PORT, keepalive_timeout=KEEPALIVE, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
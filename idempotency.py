@@ -0,0 +1,273 @@
+"""
+Idempotent processing of the 'arca' requests.
+
+If a worker dies after calling ARCA but before acknowledging the request, RabbitMQ
+delivers it again, and a client that did not get its reply in time may publish it again.
+Either way the request must not reach ARCA twice: a second FECAESolicitar could authorize
+the same invoice twice.
+
+Every authorize request is identified by its x-idempotency-key header, or failing that its
+correlation_id, plus a hash of its body (so a key reused for another request does not get
+the reply of the first one). Queries are not deduplicated: their replies go stale, and the
+last invoice cache already decides how long they can be served from memory.
+
+Before processing a request, the worker claims its key in a SQLite database in WAL mode
+shared by the workers of the host. Stored replies are only looked up for requests that
+carry an x-idempotency-key, or that RabbitMQ redelivers because the worker that had them
+died before acknowledging them. Clients that reuse correlation_ids (e.g. send_arca.py)
+therefore never get the reply of an earlier request, though a request reusing the key of
+one in progress still waits for it:
+    - A key already answered gets the stored reply again, without calling ARCA.
+    - A key claimed by another request still in progress (a duplicate published twice)
+      is republished to a delay queue (see retry_queues.py) and comes back after
+      BUSY_DELAY seconds, by which time it is usually answered, without holding the
+      worker's prefetch meanwhile.
+    - Otherwise the key is claimed and the request processed. Its reply is stored before
+      it is sent and acknowledged, so a crash after ARCA answered finds it stored.
+
+Only successful replies are stored. A request that fails releases its claim, so retries
+(see retry_queues.py) and clients retrying with the same key are processed again.
+Claims older than ARCA_IDEMPOTENCY_CLAIM_TIMEOUT belong to a worker that died and are
+taken over. Replies are kept for ARCA_IDEMPOTENCY_RETENTION seconds, the most recent ones
+also in an in-memory LRU. Expired rows are deleted and the WAL truncated every
+ARCA_IDEMPOTENCY_COMPACT_INTERVAL seconds by the worker that stores a reply, or with
+`python idempotency.py compact`.
+
+If the database cannot be used, requests are processed without deduplication.
+
+Environment Variables:
+    - ARCA_IDEMPOTENCY_DB: SQLite database (default: ./idempotency/replies.db)
+    - ARCA_IDEMPOTENCY_RETENTION: Seconds a reply is kept, 0 disables deduplication (default: 86400)
+    - ARCA_IDEMPOTENCY_MEMORY_SIZE: Replies also kept in memory (default: 10000)
+    - ARCA_IDEMPOTENCY_CLAIM_TIMEOUT: Seconds after which an unanswered claim is taken over (default: 300)
+    - ARCA_IDEMPOTENCY_COMPACT_INTERVAL: Seconds between compactions (default: 3600)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+DB_PATH = os.environ.get(
+    "ARCA_IDEMPOTENCY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "idempotency", "replies.db")
+)
+RETENTION = float(os.environ.get("ARCA_IDEMPOTENCY_RETENTION", 86400))
+MEMORY_SIZE = int(os.environ.get("ARCA_IDEMPOTENCY_MEMORY_SIZE", 10000))
+CLAIM_TIMEOUT = float(os.environ.get("ARCA_IDEMPOTENCY_CLAIM_TIMEOUT", 300))
+COMPACT_INTERVAL = float(os.environ.get("ARCA_IDEMPOTENCY_COMPACT_INTERVAL", 3600))
+
+KEY_HEADER = "x-idempotency-key"
+
+# Operations whose replies are stored: only authorize reaches ARCA with side effects
+OPERATIONS = ("authorize",)
+
+# Seconds before a duplicate of a request in progress comes back from its delay queue
+BUSY_DELAY = 1
+
+# Outcomes of ReplyStore.begin()
+NEW, DONE, BUSY = "new", "done", "busy"
+
+_PENDING, _ANSWERED = 0, 1
+
+
+def request_key(headers, correlation_id, body):
+    """
+    Returns the key a request is deduplicated by, or None if it has no idempotency key nor
+    correlation_id.
+
+    Args:
+        headers (dict): Headers of the request
+        correlation_id (str): Its correlation_id
+        body (bytes): Its body
+    """
+    key = (headers or {}).get(KEY_HEADER) or correlation_id
+    if not key:
+        return None
+    if isinstance(key, bytes):
+        key = key.decode(errors="replace")
+    return f"{key}:{hashlib.blake2b(body, digest_size=16).hexdigest()}"
+
+
+def may_replay(headers, redelivered):
+    """
+    Tells whether a request may be answered with a stored reply: only when the client gave
+    it an idempotency key, or when RabbitMQ redelivers it.
+
+    Args:
+        headers (dict): Headers of the request
+        redelivered (bool): The redelivered flag of its delivery
+    """
+    return bool((headers or {}).get(KEY_HEADER)) or bool(redelivered)
+
+
+def deferred_headers(headers, correlation_id):
+    """
+    Returns the headers of a duplicate republished while its original is in progress.
+
+    The republished copy is a new delivery, not a redelivery, so its correlation_id becomes
+    its idempotency key: it is still answered with the reply of the original.
+    """
+    headers = dict(headers or {})
+    if not headers.get(KEY_HEADER) and correlation_id:
+        headers[KEY_HEADER] = correlation_id
+    return headers
+
+
+class ReplyStore:
+    """
+    Claims and stored replies of the requests, in SQLite behind an LRU of recent replies.
+    """
+
+    def __init__(self, path=DB_PATH, retention=RETENTION, memory_size=MEMORY_SIZE, claim_timeout=CLAIM_TIMEOUT,
+                 compact_interval=COMPACT_INTERVAL):
+        self.path = path
+        self.retention = retention
+        self.memory_size = memory_size
+        self.claim_timeout = claim_timeout
+        self.compact_interval = compact_interval
+        self._memory = OrderedDict()  # key -> (stored_at, payload)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_compaction = time.monotonic() + compact_interval
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared across threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Survives the worker crashing (what matters here), not the host losing power
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS replies "
+                "(key TEXT PRIMARY KEY, state INTEGER NOT NULL, stored_at REAL NOT NULL, payload TEXT) WITHOUT ROWID"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS replies_stored_at ON replies (stored_at)")
+            self._local.connection = connection
+        return connection
+
+    def _remember(self, key, stored_at, payload):
+        with self._lock:
+            self._memory[key] = (stored_at, payload)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def begin(self, key, replay=True):
+        """
+        Claims a request before processing it.
+
+        Args:
+            key (str): The key of the request, from request_key()
+            replay (bool): Whether it may get a stored reply (see may_replay). If not, a
+                stored reply is kept under the claim, and restored if it is abandoned.
+
+        Returns:
+            tuple: (NEW, None) if the request must be processed, (DONE, payload) with the
+                stored reply, or (BUSY, None) if another delivery of it is being processed
+        """
+        now = time.time()
+        if replay:
+            with self._lock:
+                entry = self._memory.get(key)
+                if entry is not None and entry[0] > now - self.retention:
+                    self._memory.move_to_end(key)
+                    return DONE, entry[1]
+        else:
+            with self._lock:
+                self._memory.pop(key, None)
+
+        connection = None
+        try:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT state, stored_at, payload FROM replies WHERE key = ?", (key,)).fetchone()
+            kept = None
+            if row is not None:
+                state, stored_at, payload = row
+                if state == _PENDING and stored_at > now - self.claim_timeout:
+                    connection.execute("COMMIT")
+                    return BUSY, None
+                if state == _ANSWERED and stored_at > now - self.retention:
+                    if replay:
+                        connection.execute("COMMIT")
+                        payload = json.loads(payload)
+                        self._remember(key, stored_at, payload)
+                        return DONE, payload
+                    # A new request reusing the key of an answered one (e.g. a reused
+                    # correlation_id): processed, but without losing the earlier reply
+                    kept = payload
+            connection.execute("INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?)", (key, _PENDING, now, kept))
+            connection.execute("COMMIT")
+        except (sqlite3.Error, ValueError) as e:
+            if connection is not None and connection.in_transaction:
+                connection.execute("ROLLBACK")
+            print(f"Idempotency store unavailable, processing without deduplication: {e}")
+        return NEW, None
+
+    def finish(self, key, payload):
+        """Stores the reply of a claimed request, before it is sent."""
+        now = time.time()
+        self._remember(key, now, payload)
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?)", (key, _ANSWERED, now, json.dumps(payload))
+            )
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"Could not store the reply of {key}: {e}")
+        if time.monotonic() >= self._next_compaction:
+            self.compact()
+
+    def abandon(self, key):
+        """
+        Releases the claim of a request that failed, so it is processed again next time. The
+        reply kept under the claim, if any, is stored again.
+        """
+        try:
+            connection = self._connection()
+            connection.execute(
+                "UPDATE replies SET state = ? WHERE key = ? AND state = ? AND payload IS NOT NULL",
+                (_ANSWERED, key, _PENDING),
+            )
+            connection.execute("DELETE FROM replies WHERE key = ? AND state = ?", (key, _PENDING))
+        except sqlite3.Error as e:
+            print(f"Could not release the claim of {key}: {e}")
+
+    def compact(self):
+        """
+        Deletes the expired replies and stale claims and truncates the WAL.
+
+        Returns:
+            int: Rows deleted
+        """
+        self._next_compaction = time.monotonic() + self.compact_interval
+        now = time.time()
+        try:
+            connection = self._connection()
+            deleted = connection.execute(
+                "DELETE FROM replies WHERE (state = ? AND stored_at <= ?) OR (state = ? AND stored_at <= ?)",
+                (_ANSWERED, now - self.retention, _PENDING, now - self.claim_timeout),
+            ).rowcount
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            print(f"Could not compact the idempotency store: {e}")
+            return 0
+        with self._lock:
+            for key in [key for key, (stored_at, _) in self._memory.items() if stored_at <= now - self.retention]:
+                del self._memory[key]
+        return deleted
+
+
+replies = ReplyStore() if RETENTION > 0 else None
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["compact"] or replies is None:
+        print("Usage: python idempotency.py compact (with ARCA_IDEMPOTENCY_RETENTION > 0)")
+        sys.exit(1)
+    print(f"Deleted {replies.compact()} expired rows from {replies.path}")
@@ -0,0 +1,116 @@
+"""
+Batching of invoice authorizations into FECAESolicitar calls with CantReg > 1.
+
+Authorization requests for the same (cuit, pto_vta, cbte_tipo) are collected into a
+batch that is flushed when it reaches ARCA_BATCH_SIZE invoices or ARCA_BATCH_WINDOW_MS
+after its first invoice arrived, whichever comes first. The batch is sent as a single
+FECAESolicitar with consecutive numbers and the per-invoice results (CAE, observations)
+are split back out, one response per original request.
+
+The batcher only groups requests; scheduling the flush and replying to each request is
+up to the worker (connection timers in the blocking worker, asyncio in the async one).
+
+Environment Variables:
+    - ARCA_BATCH_SIZE: Maximum invoices per FECAESolicitar (default: 50, ARCA accepts up to 250)
+    - ARCA_BATCH_WINDOW_MS: Maximum time an invoice waits for its batch to fill (default: 50)
+"""
+
+import os
+import threading
+
+BATCH_SIZE = int(os.environ.get("ARCA_BATCH_SIZE", 50))
+BATCH_WINDOW = float(os.environ.get("ARCA_BATCH_WINDOW_MS", 50)) / 1000
+
+
+class InvoiceBatcher:
+    """
+    Collects (invoice, waiter) pairs per key until their batch is flushed.
+
+    Args:
+        max_size (int): Number of invoices that makes a batch full.
+    """
+
+    def __init__(self, max_size=BATCH_SIZE):
+        self.max_size = max(max_size, 1)
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, invoice, waiter):
+        """
+        Adds an invoice to the open batch of a key.
+
+        Args:
+            key (tuple): (cuit, pto_vta, cbte_tipo)
+            invoice (dict): The FECAEDetRequest, without numbers
+            waiter: Value returned with the invoice by take()
+
+        Returns:
+            tuple: (opened, full) - opened is True if this invoice started a new batch, so the
+                caller must schedule its flush; full is True if the batch must be flushed now
+        """
+        with self._lock:
+            batch = self._batches.setdefault(key, [])
+            batch.append((invoice, waiter))
+            return len(batch) == 1, len(batch) >= self.max_size
+
+    def take(self, key):
+        """
+        Closes the open batch of a key.
+
+        Returns:
+            list: The (invoice, waiter) pairs of the batch, empty if it was already flushed
+        """
+        with self._lock:
+            return self._batches.pop(key, [])
+
+    def keys(self):
+        """Returns the keys with an open batch."""
+        with self._lock:
+            return list(self._batches)
+
+
+def number_invoices(invoices, first_number):
+    """
+    Assigns consecutive numbers to the invoices of a batch.
+
+    Args:
+        invoices (list): FECAEDetRequest dictionaries
+        first_number (int): Number of the first invoice
+
+    Returns:
+        list: Copies of the invoices with CbteDesde and CbteHasta set
+    """
+    numbered = []
+    for offset, invoice in enumerate(invoices):
+        number = first_number + offset
+        numbered.append(dict(invoice, CbteDesde=number, CbteHasta=number))
+    return numbered
+
+
+def split_batch_response(response, invoices):
+    """
+    Splits a serialized FECAESolicitar response into one response per invoice of the batch.
+
+    Each response has the shape of a single-invoice FECAESolicitar response: the shared
+    FeCabResp, Events and Errors plus the FECAEDetResponse of that invoice. When ARCA
+    rejected the whole batch (no detail results) every invoice gets the shared part only.
+
+    Args:
+        response (dict): The serialized FECAESolicitar response
+        invoices (list): The numbered invoices sent, in order
+
+    Returns:
+        list: One response dict per invoice, in the same order
+    """
+    details = (response.get("FeDetResp") or {}).get("FECAEDetResponse") or []
+    by_number = {detail.get("CbteDesde"): detail for detail in details}
+    responses = []
+    for invoice in invoices:
+        detail = by_number.get(invoice["CbteDesde"])
+        responses.append({
+            "FeCabResp": response.get("FeCabResp"),
+            "FeDetResp": {"FECAEDetResponse": [detail]} if detail is not None else None,
+            "Events": response.get("Events"),
+            "Errors": response.get("Errors"),
+        })
+    return responses
@@ -0,0 +1,186 @@
+"""
+Local invoice-number sequencer per (cuit, pto_vta, cbte_tipo).
+
+Instead of asking ARCA for the last authorized number (FECompUltimoAutorizado) before
+every FECAESolicitar, the gateway seeds each key once from ARCA and then keeps the last
+number it authorized on disk. Numbers are handed out and committed while holding a
+per-key file lock, so every worker process on the host shares one sequence and no number
+is handed out twice.
+
+The stored number is dropped, and therefore re-seeded from ARCA on next use, when ARCA
+reports a numbering error (e.g. 10016, "el numero o fecha del comprobante no se
+corresponde con el proximo a autorizar") or when the outcome of a FECAESolicitar is unknown.
+
+Environment Variables:
+    - ARCA_SEQUENCE_DIR: Directory of the sequence files (default: ./sequences)
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+
+SEQUENCE_DIR = os.environ.get(
+    "ARCA_SEQUENCE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sequences")
+)
+
+# ARCA codes meaning the number sent is not the next one to authorize
+NUMBERING_ERROR_CODES = {10016}
+
+
+class _KeyLock:
+    """Exclusive cross-process lock on the sequence of one key."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        self._file = open(self.path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class InvoiceSequencer:
+    """
+    Crash-safe store of the last authorized number of each (cuit, pto_vta, cbte_tipo).
+
+    Every method except lock() must be called while holding lock(key), from the moment
+    the number is read until the FECAESolicitar using it has been answered and committed.
+
+    Args:
+        directory (str): Where the sequence and lock files are kept.
+    """
+
+    def __init__(self, directory=SEQUENCE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, extension):
+        cuit, pto_vta, cbte_tipo = key
+        return os.path.join(self.directory, f"{cuit}-{pto_vta}-{cbte_tipo}.{extension}")
+
+    def lock(self, key):
+        """
+        Returns the cross-process lock of a key, usable as a context manager.
+        """
+        return _KeyLock(self._path(key, "lock"))
+
+    def last_number(self, key):
+        """
+        Returns the last number authorized for a key, or None if it must be seeded from ARCA.
+        """
+        try:
+            with open(self._path(key, "json"), 'r') as f:
+                return int(json.load(f)["last"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set_last_number(self, key, number):
+        """
+        Atomically persists the last number authorized for a key.
+        """
+        path = self._path(key, "json")
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"last": number}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def reset(self, key):
+        """
+        Forgets the sequence of a key so it is seeded from ARCA again.
+        """
+        try:
+            os.remove(self._path(key, "json"))
+        except FileNotFoundError:
+            pass
+
+    def commit(self, key, last, response):
+        """
+        Records the outcome of a FECAESolicitar numbered after `last`.
+
+        Approved numbers advance the sequence; rejected ones are not consumed. A numbering
+        error then resets the key, so it is re-seeded from ARCA, whose last number already
+        includes the ones approved here.
+
+        Args:
+            key (tuple): (cuit, pto_vta, cbte_tipo)
+            last (int): The last number before the request
+            response (dict): The serialized FECAESolicitar response
+        """
+        details = (response.get("FeDetResp") or {}).get("FECAEDetResponse") or []
+        approved = [detail["CbteHasta"] for detail in details if detail.get("Resultado") == "A"]
+        if approved:
+            self.set_last_number(key, max(approved + [last]))
+        if has_numbering_error(response):
+            print(f"ARCA reported a numbering error for {key}, resyncing the sequence")
+            self.reset(key)
+        elif not approved:
+            self.set_last_number(key, last)
+
+
+def _codes(container, list_name, item_name):
+    items = (container or {}).get(list_name) or {}
+    for item in items.get(item_name) or []:
+        if item.get("Code") is not None:
+            yield int(item["Code"])
+
+
+def has_numbering_error(response):
+    """
+    Returns True if a serialized FECAESolicitar response rejects a number as out of sequence.
+    """
+    codes = set(_codes(response, "Errors", "Err"))
+    for detail in (response.get("FeDetResp") or {}).get("FECAEDetResponse") or []:
+        codes.update(_codes(detail, "Observaciones", "Obs"))
+    return bool(codes & NUMBERING_ERROR_CODES)
+
+
+def rejected_for_numbering(response, invoices):
+    """
+    Returns which invoices of a FECAESolicitar must be sent again with new numbers.
+
+    When ARCA approved part of the batch (Resultado "P") only the details rejected with a
+    numbering error are returned: the approved ones already have their CAE and sending them
+    again would authorize them twice. When nothing was approved and the numbering was
+    rejected, every invoice is returned.
+
+    Args:
+        response (dict): The serialized FECAESolicitar response
+        invoices (list): The numbered invoices sent, in order
+
+    Returns:
+        list: Positions in `invoices`, in order
+    """
+    if not has_numbering_error(response):
+        return []
+    details = (response.get("FeDetResp") or {}).get("FECAEDetResponse") or []
+    if not any(detail.get("Resultado") == "A" for detail in details):
+        return list(range(len(invoices)))
+    by_number = {detail.get("CbteDesde"): detail for detail in details}
+    positions = []
+    for position, invoice in enumerate(invoices):
+        detail = by_number.get(invoice["CbteDesde"])
+        if (detail is not None and detail.get("Resultado") != "A"
+                and set(_codes(detail, "Observaciones", "Obs")) & NUMBERING_ERROR_CODES):
+            positions.append(position)
+    return positions
@@ -0,0 +1,171 @@
+"""
+Priority lanes of the 'arca' requests.
+
+Invoice authorizations come from point-of-sale terminals waiting on them, while bulk
+last_invoice queries from back-office jobs can wait. Each kind of request gets its own
+queue (lane) so a burst of queries does not block the authorizations behind it:
+    - authorize: 'arca.authorize', clients publish their authorize requests here
+    - query: 'arca', everything else (and any request sent to it, authorize included)
+
+Every lane has its own prefetch, so the worker always holds deliveries of every lane with
+work, and, in the async worker, its own concurrency budget. The blocking worker buffers the
+deliveries of all lanes and processes them one at a time in smooth weighted round robin
+(ARCA_LANE_<LANE>_WEIGHT), so queries still get one turn for every `weight` authorizations.
+A delivery that waited more than ARCA_LANE_MAX_WAIT_MS is served next whatever its lane,
+so a steady stream of authorizations never starves the queries. A delivery can also be put
+back in front of its lane, which then sits out its turns for a while (see
+LaneScheduler.put_back): that is how the retries of a shard keep their place (see
+retry_queues.in_place).
+
+Environment Variables:
+    - ARCA_LANE_AUTHORIZE_PREFETCH, ARCA_LANE_QUERY_PREFETCH: Prefetch of each lane
+      (default: ARCA_PREFETCH of the worker)
+    - ARCA_LANE_AUTHORIZE_CONCURRENCY, ARCA_LANE_QUERY_CONCURRENCY: Messages of each lane
+      processed at once by the async worker (default: ARCA_CONCURRENCY)
+    - ARCA_LANE_AUTHORIZE_WEIGHT, ARCA_LANE_QUERY_WEIGHT: Turns of each lane in the blocking
+      worker (default: 4 and 1)
+    - ARCA_LANE_MAX_WAIT_MS: Deliveries waiting longer are served first (default: 1000)
+"""
+
+import os
+import time
+from collections import deque
+
+AUTHORIZE_QUEUE = "arca.authorize"
+QUERY_QUEUE = "arca"
+
+MAX_WAIT = float(os.environ.get("ARCA_LANE_MAX_WAIT_MS", 1000)) / 1000
+
+DEFAULT_WEIGHTS = {"authorize": 4, "query": 1}
+
+
+class Lane:
+    """
+    A request queue with its own prefetch, concurrency budget and scheduling weight.
+    `arguments` are the x-arguments the queue is declared with.
+    """
+
+    def __init__(self, name, queue, prefetch, concurrency, weight, arguments=None):
+        self.name = name
+        self.queue = queue
+        self.prefetch = prefetch
+        self.concurrency = concurrency
+        self.weight = weight
+        self.arguments = arguments
+
+    def __repr__(self):
+        return (f"Lane({self.name!r}, queue={self.queue!r}, prefetch={self.prefetch}, "
+                f"concurrency={self.concurrency}, weight={self.weight})")
+
+
+def _setting(lane, name, default):
+    return int(os.environ.get(f"ARCA_LANE_{lane.upper()}_{name}", default))
+
+
+def lanes(default_prefetch, default_concurrency=None):
+    """
+    Returns the lanes of a worker, highest priority first.
+
+    Args:
+        default_prefetch (int): ARCA_PREFETCH of the worker, used for lanes without their own
+        default_concurrency (int): ARCA_CONCURRENCY of the async worker, likewise. Defaults
+            to the prefetch of each lane.
+    """
+    result = []
+    for name, queue in (("authorize", AUTHORIZE_QUEUE), ("query", QUERY_QUEUE)):
+        prefetch = _setting(name, "PREFETCH", default_prefetch)
+        result.append(Lane(
+            name,
+            queue,
+            prefetch,
+            _setting(name, "CONCURRENCY", default_concurrency or prefetch),
+            _setting(name, "WEIGHT", DEFAULT_WEIGHTS[name]),
+        ))
+    return result
+
+
+def queue_for(request):
+    """
+    Returns the queue a client should publish a request to.
+
+    Args:
+        request (dict): The request body
+    """
+    return AUTHORIZE_QUEUE if request.get("operation") == "authorize" else QUERY_QUEUE
+
+
+class LaneScheduler:
+    """
+    Buffers deliveries per lane and hands them out in smooth weighted round robin, serving
+    first any delivery that waited longer than max_wait.
+    """
+
+    def __init__(self, lanes, max_wait=MAX_WAIT):
+        self.lanes = list(lanes)
+        self.max_wait = max_wait
+        self._buffers = {lane.name: deque() for lane in self.lanes}
+        self._credit = {lane.name: 0 for lane in self.lanes}
+        self._held_until = {lane.name: 0 for lane in self.lanes}
+        # Deliveries put back since the lane was last taken from, which stay in that order
+        self._put_back = {lane.name: 0 for lane in self.lanes}
+
+    def put(self, lane, item):
+        """Buffers a delivery of a lane."""
+        self._buffers[lane.name].append((time.monotonic(), item))
+
+    def put_back(self, lane, item, delay=0):
+        """
+        Returns a delivery taken from a lane to the front of it, ahead of every delivery
+        that arrived after it, and holds the lane for `delay` seconds. Deliveries put back
+        before the lane is taken from again keep the order they were put back in.
+        """
+        now = time.monotonic()
+        self._buffers[lane.name].insert(self._put_back[lane.name], (now, item))
+        self._put_back[lane.name] += 1
+        self._held_until[lane.name] = max(self._held_until[lane.name], now + delay)
+
+    def wait(self):
+        """
+        Returns:
+            float: Seconds until a delivery can be taken (0 if one can now), or None if
+                every lane is empty
+        """
+        now = time.monotonic()
+        waits = [max(self._held_until[lane.name] - now, 0) for lane in self.lanes if self._buffers[lane.name]]
+        return min(waits) if waits else None
+
+    def take(self):
+        """
+        Returns:
+            The next delivery to process, or None if every lane is empty or held
+        """
+        now = time.monotonic()
+        ready = [lane for lane in self.lanes if self._buffers[lane.name] and self._held_until[lane.name] <= now]
+        if not ready:
+            return None
+
+        oldest = min(ready, key=lambda lane: self._buffers[lane.name][0][0])
+        if now - self._buffers[oldest.name][0][0] > self.max_wait:
+            return self._pop(oldest)
+
+        # Smooth weighted round robin (as in nginx): every ready lane earns its weight, the
+        # richest is served and pays the total, which interleaves the lanes evenly
+        total = 0
+        for lane in ready:
+            self._credit[lane.name] += lane.weight
+            total += lane.weight
+        chosen = max(ready, key=lambda lane: self._credit[lane.name])
+        self._credit[chosen.name] -= total
+        return self._pop(chosen)
+
+    def _pop(self, lane):
+        buffer = self._buffers[lane.name]
+        item = buffer.popleft()[1]
+        self._put_back[lane.name] = 0
+        if not buffer:
+            # An idle lane neither banks nor owes turns
+            self._credit[lane.name] = 0
+        return item
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self._buffers.values())
@@ -0,0 +1,127 @@
+"""
+Short-lived LRU cache of FECompUltimoAutorizado results.
+
+Clients often ask for the last authorized number of the same (cuit, pto_vta, cbte_tipo)
+within seconds of each other. The worker answers those from this cache instead of
+making an ARCA round trip. When the gateway itself authorizes invoices for a key the
+cached number is advanced, and when the outcome of an authorization is unknown the
+entry is dropped, so the cache never reports a number lower than one the gateway
+knows was authorized.
+
+Environment Variables:
+    - ARCA_LAST_INVOICE_CACHE_TTL: Seconds an entry stays valid, 0 disables the cache (default: 5)
+    - ARCA_LAST_INVOICE_CACHE_SIZE: Maximum number of cached keys (default: 1024)
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CACHE
+
+CACHE_TTL = float(os.environ.get("ARCA_LAST_INVOICE_CACHE_TTL", 5))
+CACHE_SIZE = int(os.environ.get("ARCA_LAST_INVOICE_CACHE_SIZE", 1024))
+
+
+def cache_key(cuit, pto_vta, cbte_tipo):
+    """
+    Normalizes a request into a cache key, so "0001" and 1 hit the same entry.
+
+    Returns:
+        tuple: (cuit, pto_vta, cbte_tipo)
+    """
+    return str(cuit), int(pto_vta), int(cbte_tipo)
+
+
+class LastInvoiceCache:
+    """
+    LRU cache with a time to live for serialized FECompUltimoAutorizado responses.
+
+    Args:
+        ttl (float): Seconds an entry stays valid. 0 disables the cache.
+        max_size (int): Maximum number of entries; the least recently used one is evicted.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_size=CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, response dict)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached response for a key, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return dict(entry[1])
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        """
+        Caches a serialized FECompUltimoAutorizado response. Responses with errors are not cached.
+        """
+        if self.ttl <= 0 or response.get("Errors"):
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, dict(response))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def advance(self, key, cbte_nro):
+        """
+        Raises the cached last number of a key after the gateway authorized cbte_nro.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1].get("CbteNro") or 0) < cbte_nro:
+                entry[1]["CbteNro"] = cbte_nro
+
+    def invalidate(self, key):
+        """
+        Drops the cached entry of a key.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def note_authorization(self, key, response):
+        """
+        Updates a key from a serialized FECAESolicitar response.
+
+        Advances the entry to the highest approved number, or drops it when the response
+        carries no detail results and the outcome is therefore unknown.
+        """
+        details = ((response or {}).get("FeDetResp") or {}).get("FECAEDetResponse") or []
+        if not details:
+            self.invalidate(key)
+            return
+        approved = [detail["CbteHasta"] for detail in details if detail.get("Resultado") == "A"]
+        if approved:
+            self.advance(key, max(approved))
+
+    def stats(self):
+        """
+        Returns the hit and miss counters and the current size.
+
+        Returns:
+            dict: hits, misses and size
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+# Process-wide cache used by the workers
+last_invoice_cache = LastInvoiceCache()
+
+CACHE.labels("hit").set_function(lambda: last_invoice_cache.hits)
+CACHE.labels("miss").set_function(lambda: last_invoice_cache.misses)
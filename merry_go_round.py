@@ -1,12 +1,23 @@
 """
 RabbitMQ consumer service for ARCA (Argentinian Revenue Service) integration.
 This service listens for requests on the 'arca' queue to fetch the last invoice number
-for a given CUIT (tax ID), point of sale, and invoice type. It handles authentication
-with ARCA and returns responses through a reply queue.
+for a given CUIT (tax ID), point of sale, and invoice type, or to authorize invoices.
+It handles authentication with ARCA and returns responses through a reply queue.
+
+Operations (selected with the "operation" field of the request):
+    - last_invoice (default): FECompUltimoAutorizado, served from a short-lived cache when possible
+    - authorize: FECAESolicitar for the FECAEDetRequest given in "invoice". Invoices without
+      CbteDesde/CbteHasta are numbered by the gateway and batched with other invoices of the
+      same cuit, pto_vta and cbte_tipo into a single call (see invoice_batcher.py)
+    - cache_stats: Hit/miss counters of the last invoice cache
+    - bulk_query: FECompConsultar of every invoice between "from" and "to", streamed back as
+      numbered chunks followed by an end-of-stream marker, a few chunks per message
+      (see bulk_query.py)
 
 Dependencies:
     - pika: RabbitMQ client library
     - zeep: SOAP client for ARCA web services
+    - orjson or msgspec (optional): faster reply encoding, MessagePack replies
     - Custom modules: solicitud_ultimo_comprobante, login_arca
 
 Environment Variables:
@@ -14,19 +25,54 @@ Environment Variables:
     - RABBITMQ_PORT: RabbitMQ server port (default: 5672)
     - RABBITMQ_USER: RabbitMQ username (default: guest)
     - RABBITMQ_PASSWORD: RabbitMQ password (default: guest)
+    - ARCA_WORKER_MODE: "blocking" or "async" (default: blocking)
+    - ARCA_PREFETCH: basic_qos prefetch count of each lane (default: 1 in blocking mode)
+    - ARCA_LANE_*: Prefetch and weight of the authorize and query lanes (see lanes.py)
+    - ARCA_SHARDS: Number of per-(cuit, pto_vta) shard queues, 0 disables them (default: 0, see shards.py)
+    - ARCA_COALESCE_WINDOW_MS: Identical last_invoice requests received within this window
+      share one ARCA call, 0 disables it (default: 5). Needs ARCA_PREFETCH > 1 in blocking mode.
+    - ARCA_METRICS_PORT: Port of the Prometheus /metrics endpoint, 0 disables it (default: 9464)
+    - ARCA_RETRY_ATTEMPTS: Delayed retries of transient failures before a request is parked,
+      0 disables them (default: 5, see retry_queues.py)
+    - ARCA_BREAKER_*, ARCA_LIMIT_*: Circuit breaker and concurrency limit of the ARCA calls
+      (see upstream_guard.py)
+    - ARCA_PROFILE_EVERY: Profile every Nth message with cProfile, 0 disables it (default: 0).
+      SIGUSR1 samples the stacks of every thread for ARCA_PROFILE_WINDOW seconds (see profiler.py)
+    - ARCA_IDEMPOTENCY_RETENTION: Seconds the reply of a request is kept to answer its
+      redeliveries and duplicates, 0 disables it (default: 86400, see idempotency.py)
+    - ARCA_CREDENTIALS: Registry of the certificate of each cuit (default: ssl/ssl_files/credentials.json,
+      see credentials.py)
+    - ARCA_BULK_*: Parallelism and chunking of bulk_query requests (see bulk_query.py)
 """
 
+import functools
 import os
+import signal
 import sys
+import time
 
 # Add the 'ssl' directory to the Python path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'ssl'))
 
 import pika
-import json
-from zeep.helpers import serialize_object
+from encoders import decode, encode, negotiate, to_builtin
 from solicitud_ultimo_comprobante import solicitar_ultimo_comprobante
+from solicitud_factura_a import solicitar_cae
+from solicitud_consulta_comprobante import consultar_comprobante
+from last_invoice_cache import cache_key, last_invoice_cache
+from coalesce import SingleFlight
+from invoice_batcher import BATCH_WINDOW, InvoiceBatcher, number_invoices, split_batch_response
+from invoice_sequencer import InvoiceSequencer, rejected_for_numbering
+import login_arca
 from login_arca import login_ARCA
+from upstream_guard import DEFER, UpstreamUnavailable
+import bulk_query
+import idempotency
+import lanes
+import metrics
+import profiler
+import retry_queues
+import shards
 
 #RabbitMQ connection parameters.  Adjust as needed.
 RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
@@ -34,6 +80,632 @@ RABBITMQ_PORT = int(os.environ.get("RABBITMQ_PORT", 5672))
 RABBITMQ_USER = os.environ.get("RABBITMQ_USER", "guest")
 RABBITMQ_PASSWORD = os.environ.get("RABBITMQ_PASSWORD", "guest")
 
+# "blocking" (one message at a time) or "async" (see async_worker.py)
+WORKER_MODE = os.environ.get("ARCA_WORKER_MODE", "blocking")
+
+# Unacknowledged messages a blocking worker may hold. The blocking worker handles one
+# message at a time, so a low value leaves the rest of the queue to the other workers.
+PREFETCH = int(os.environ.get("ARCA_PREFETCH", 1))
+
+# Authorization requests are consumed from their own queue ahead of queries (see lanes.py),
+# and with ARCA_SHARDS each worker also consumes the shard queues it owns (see shards.py)
+LANES = lanes.lanes(PREFETCH) + shards.lanes(PREFETCH)
+
+# Identical last_invoice requests received within this window share one ARCA call
+COALESCE_WINDOW = float(os.environ.get("ARCA_COALESCE_WINDOW_MS", 5)) / 1000
+
+# In-flight last_invoice queries of the blocking worker, waiters are (delivery_tag, properties, body)
+flights = SingleFlight()
+
+# Open invoice batches of the blocking worker, waiters are (delivery_tag, properties, body)
+batcher = InvoiceBatcher()
+
+# Last authorized number per (cuit, pto_vta, cbte_tipo), shared by every worker on the host
+sequencer = InvoiceSequencer()
+
+# Lane and delivery (ch, method, properties, body) of each unacknowledged delivery by delivery
+# tag, so its retries go back to its queue, or to the front of its lane (see hold)
+deliveries = {}
+
+# Puts a delivery back in front of its lane: hold_in_lane(lane, delivery, delay), set by consume_lanes
+hold_in_lane = None
+
+
+OPERATIONS = ("last_invoice", "authorize", "cache_stats", "bulk_query")
+
+
+def parse_request(body, content_type=None):
+    """
+    Parses and validates the body of an 'arca' request.
+
+    Args:
+        body (bytes): Message body containing JSON (or MessagePack) with request parameters
+        content_type (str): content_type property of the message
+
+    Returns:
+        dict: The request, with its "operation" set. Every operation except cache_stats
+            carries cuit, pto_vta and cbte_tipo; authorize also carries "invoice", and
+            bulk_query its range (see bulk_query.validate).
+
+    Raises:
+        ValueError: If message body is empty, cannot be decoded or is missing required parameters
+    """
+    if not body:
+        raise ValueError("Empty message body received")
+
+    data = decode(body, content_type)
+    if not isinstance(data, dict):
+        raise ValueError(f"Invalid request in message body: {body}")
+
+    operation = data.setdefault("operation", "last_invoice")
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation: {operation}")
+    if operation == "cache_stats":
+        return data
+
+    # Required parameters: cuit (Tax ID number), pto_vta (Point of sale identifier)
+    # and cbte_tipo (Invoice type code)
+    if not data.get("cuit") or not data.get("pto_vta") or not data.get("cbte_tipo"):
+        raise ValueError("Missing required parameters in message: cuit, pto_vta, cbte_tipo")
+    if operation == "authorize" and not isinstance(data.get("invoice"), dict):
+        raise ValueError("Missing required parameter in message: invoice")
+    if operation == "bulk_query":
+        bulk_query.validate(data)
+    return data
+
+
+def last_invoice(data):
+    """
+    Returns the last authorized invoice of the request's cuit, pto_vta and cbte_tipo.
+
+    Args:
+        data (dict): The parsed request
+
+    Returns:
+        dict: The serialized FECompUltimoAutorizado response
+    """
+    cached = last_invoice_cache.get(cache_key(data["cuit"], data["pto_vta"], data["cbte_tipo"]))
+    if cached is not None:
+        return cached
+    return fetch_last_invoice(data)
+
+
+def fetch_last_invoice(data):
+    """
+    Queries ARCA for the last authorized invoice, bypassing the cache, and caches the result.
+
+    Args:
+        data (dict): The parsed request
+
+    Returns:
+        dict: The serialized FECompUltimoAutorizado response
+    """
+    key = cache_key(data["cuit"], data["pto_vta"], data["cbte_tipo"])
+
+    # Get the security tokens of the cached TA of the cuit (WSAA is only called when it is missing or expired)
+    token, sign = login_ARCA(cuit=data["cuit"])
+
+    # Query ARCA web service for the last invoice number
+    response = solicitar_ultimo_comprobante(token, sign, data["cuit"], data["pto_vta"], data["cbte_tipo"])
+    # Convert Zeep response object to dictionary
+    response_dict = to_builtin(response)
+    last_invoice_cache.put(key, response_dict)
+    return response_dict
+
+
+def authorize(data):
+    """
+    Requests the CAE of the invoice in the request and updates the last invoice cache.
+
+    Args:
+        data (dict): The parsed request
+
+    Returns:
+        dict: The serialized FECAESolicitar response
+    """
+    key = cache_key(data["cuit"], data["pto_vta"], data["cbte_tipo"])
+    if "CbteDesde" not in data["invoice"]:
+        return authorize_batch(key, [data["invoice"]])[0]
+
+    token, sign = login_ARCA(cuit=data["cuit"])
+    try:
+        response = solicitar_cae(token, sign, data["cuit"], data["pto_vta"], data["cbte_tipo"], [data["invoice"]])
+    except UpstreamUnavailable:
+        # Rejected before it was sent
+        raise
+    except Exception:
+        # The invoice may or may not have been authorized
+        last_invoice_cache.invalidate(key)
+        raise
+    response_dict = to_builtin(response)
+    last_invoice_cache.note_authorization(key, response_dict)
+    return response_dict
+
+
+def authorize_batch(key, invoices):
+    """
+    Authorizes a batch of invoices of one cuit, pto_vta and cbte_tipo in a single FECAESolicitar.
+
+    The invoices are numbered consecutively by the local sequencer, which is only seeded
+    from FECompUltimoAutorizado the first time and after ARCA reports a numbering error.
+    In that case the invoices rejected for their number are retried once with the resynced
+    sequence; invoices ARCA already approved keep their response and are never sent again.
+
+    Args:
+        key (tuple): (cuit, pto_vta, cbte_tipo)
+        invoices (list): FECAEDetRequest dictionaries without numbers
+
+    Returns:
+        list: One serialized single-invoice FECAESolicitar response per invoice, in order
+    """
+    cuit, pto_vta, cbte_tipo = key
+    token, sign = login_ARCA(cuit=cuit)
+    responses = [None] * len(invoices)
+    pending = list(range(len(invoices)))
+    with sequencer.lock(key):
+        while pending:
+            last = sequencer.last_number(key)
+            seeded = last is None
+            if seeded:
+                last = seed_sequence(key)
+            numbered = number_invoices([invoices[position] for position in pending], last + 1)
+
+            try:
+                response = solicitar_cae(token, sign, cuit, pto_vta, cbte_tipo, numbered)
+            except UpstreamUnavailable:
+                # Rejected before it was sent, the sequence is still valid
+                raise
+            except Exception:
+                # The invoices may or may not have been authorized
+                sequencer.reset(key)
+                last_invoice_cache.invalidate(key)
+                raise
+            response_dict = to_builtin(response)
+            sequencer.commit(key, last, response_dict)
+            last_invoice_cache.note_authorization(key, response_dict)
+            for position, split in zip(pending, split_batch_response(response_dict, numbered)):
+                responses[position] = split
+            retry = [] if seeded else rejected_for_numbering(response_dict, numbered)
+            pending = [pending[index] for index in retry]
+            if pending:
+                metrics.RETRIES.labels("numbering").inc()
+    return responses
+
+
+def seed_sequence(key):
+    """
+    Returns the last authorized number of a key according to ARCA (FECompUltimoAutorizado).
+    """
+    cuit, pto_vta, cbte_tipo = key
+    last = fetch_last_invoice({"cuit": cuit, "pto_vta": pto_vta, "cbte_tipo": cbte_tipo})
+    if last.get("Errors"):
+        raise ValueError(f"Could not get the last authorized invoice: {last['Errors']}")
+    return last.get("CbteNro") or 0
+
+
+def handle_request(data):
+    """
+    Runs the operation of a parsed request.
+
+    Args:
+        data (dict): The parsed request
+
+    Returns:
+        dict: The response to send back
+    """
+    if data["operation"] == "authorize":
+        return authorize(data)
+    if data["operation"] == "cache_stats":
+        return last_invoice_cache.stats()
+    return last_invoice(data)
+
+
+def stream_bulk_query(ch, method, properties, data):
+    """
+    Streams up to bulk_query.CHUNKS_PER_MESSAGE chunks of the range of a bulk_query
+    request back (see bulk_query.py), republishes the request for the rest of the range
+    and acknowledges it.
+
+    The FECompConsultar calls run in a thread pool while this thread publishes the chunks;
+    every publish also services the connection, so heartbeats keep flowing. Capping the
+    chunks per message lets the other lanes run between the parts of a large range.
+    """
+    cuit, pto_vta, cbte_tipo = data["cuit"], data["pto_vta"], data["cbte_tipo"]
+
+    def fetch(cbte_nro):
+        token, sign = login_ARCA(cuit=cuit)
+        return to_builtin(consultar_comprobante(token, sign, cuit, pto_vta, cbte_tipo, cbte_nro))
+
+    def on_error(error):
+        print(f"Bulk query of {cuit} {pto_vta} {cbte_tipo} interrupted: {error}")
+        return error_reply(error)
+
+    if bulk_query.stream(data, fetch, functools.partial(send_reply, ch, properties), on_error):
+        rest = bulk_query.continuation(data)
+        if rest is None:
+            print(f"Bulk query of {data['from']} to {data['to']} streamed.")
+        elif not continue_bulk_query(ch, method.delivery_tag, properties, rest):
+            send_reply(ch, properties, bulk_query.interrupted_reply(
+                {"error": "Could not queue the rest of the range"}, rest["from_chunk"]
+            ))
+    ack(ch, method.delivery_tag)
+
+
+def continue_bulk_query(ch, delivery_tag, properties, rest):
+    """
+    Publishes the request for the rest of the range of a bulk query back to its queue,
+    behind the requests that arrived meanwhile.
+
+    Returns:
+        bool: True if the request was published
+    """
+    body = encode(rest, negotiate(properties.content_type if properties else None))
+    hop = retry_queues.Hop(delivery_queue(delivery_tag), properties.headers if properties else None, None, False)
+    return republish(ch, properties, body, hop)
+
+
+def send_reply(ch, properties, payload):
+    """
+    Publishes a reply to the reply_to queue of a request, if it has one.
+
+    The reply is encoded in the format negotiated from the request's "accept" header
+    or content_type (JSON by default), see encoders.py.
+
+    Args:
+        ch (pika.Channel): The channel object for RabbitMQ communication
+        properties (pika.spec.BasicProperties): Properties of the request
+        payload (dict): The reply body
+
+    Returns:
+        bool: True if the reply was published
+    """
+    if not (properties and properties.reply_to):
+        print("No reply_to property in request, response not sent")
+        return False
+    try:
+        content_type = negotiate(properties.content_type, properties.headers)
+        body = encode(payload, content_type)
+        with metrics.STAGE_SECONDS.labels("publish").time():
+            ch.basic_publish(
+                exchange='',
+                routing_key=str(properties.reply_to),  # Ensure routing key is string
+                properties=pika.BasicProperties(
+                    correlation_id=properties.correlation_id if properties.correlation_id else None,
+                    content_type=content_type,
+                ),
+                body=body
+            )
+        metrics.record_reply(payload)
+        return True
+    except Exception as pub_error:
+        print(f"Error sending response: {pub_error}")
+        return False
+
+
+def ack(ch, delivery_tag):
+    """
+    Acknowledges a request once it has been replied to.
+    """
+    ch.basic_ack(delivery_tag=delivery_tag)
+    deliveries.pop(delivery_tag, None)
+    metrics.IN_FLIGHT.dec()
+
+
+def idempotency_key(properties, body, operation):
+    """
+    Returns the key a request is deduplicated by (see idempotency.py), or None if it is not.
+    """
+    if idempotency.replies is None or properties is None or operation not in idempotency.OPERATIONS:
+        return None
+    return idempotency.request_key(properties.headers, properties.correlation_id, body)
+
+
+def replay(ch, method, properties, body, operation):
+    """
+    Claims a request in the idempotency store before it is processed.
+
+    A request that was already answered gets the stored reply again, and one whose other
+    delivery is still being processed comes back after idempotency.BUSY_DELAY through a
+    delay queue. Only redelivered requests and those with an idempotency key are
+    answered from the store (see idempotency.may_replay).
+
+    Returns:
+        bool: True if the request was taken care of and must not be processed
+    """
+    key = idempotency_key(properties, body, operation)
+    if key is None:
+        return False
+    may_replay = idempotency.may_replay(properties.headers, getattr(method, "redelivered", False))
+    state, payload = idempotency.replies.begin(key, may_replay)
+    if state == idempotency.DONE:
+        metrics.DUPLICATES.labels("replayed").inc()
+        send_reply(ch, properties, payload)
+        ack(ch, method.delivery_tag)
+        return True
+    if state == idempotency.BUSY:
+        metrics.DUPLICATES.labels("busy").inc()
+        defer(ch, method.delivery_tag, properties, body)
+        return True
+    return False
+
+
+def defer(ch, delivery_tag, properties, body):
+    """
+    Sets aside a duplicate of a request in progress: it is republished to a delay queue and
+    acknowledged, so it does not hold the prefetch of its lane while it waits. Without delay
+    queues it is requeued after idempotency.BUSY_DELAY instead, and a duplicate from a shard
+    is held in place (see hold).
+    """
+    headers = idempotency.deferred_headers(properties.headers, properties.correlation_id)
+    if hold(delivery_tag, headers, idempotency.BUSY_DELAY):
+        return
+    hop = retry_queues.deferral(headers, idempotency.BUSY_DELAY, delivery_queue(delivery_tag))
+    if hop is not None and republish(ch, properties, body, hop):
+        ack(ch, delivery_tag)
+        return
+    ch.connection.call_later(idempotency.BUSY_DELAY, functools.partial(requeue, ch, delivery_tag))
+
+
+def respond(ch, delivery_tag, properties, body, operation, payload):
+    """
+    Stores the reply of a request in the idempotency store, then sends it and acknowledges
+    the request, so a redelivery after a crash is never processed again.
+
+    Returns:
+        bool: True if the reply was published
+    """
+    key = idempotency_key(properties, body, operation)
+    if key is not None:
+        idempotency.replies.finish(key, payload)
+    sent = send_reply(ch, properties, payload)
+    ack(ch, delivery_tag)
+    return sent
+
+
+def error_reply(error):
+    """
+    Returns the reply to a request that failed.
+
+    Args:
+        error (Exception): What went wrong
+
+    Returns:
+        dict: {"error": message}, plus "code" and "retry_after" (seconds) when ARCA calls are
+            being rejected by the circuit breaker or the concurrency limit (see upstream_guard.py)
+    """
+    payload = {"error": str(error)}
+    if isinstance(error, UpstreamUnavailable):
+        payload["code"] = error.code
+        payload["retry_after"] = round(error.retry_after, 3)
+    return payload
+
+
+def fail(ch, delivery_tag, properties, body, operation, error):
+    """
+    Replies to a failed request with its error and acknowledges it.
+
+    Requests that failed with a transient error are instead republished to a delay queue
+    and come back later to the queue they were consumed from, or are parked once their
+    retries are exhausted (see retry_queues.py). With ARCA_BREAKER_DEFER set, requests rejected by the upstream guard
+    are held until it is worth retrying and then requeued for any worker to pick up.
+    Requests of a shard are retried and held in place instead (see hold).
+
+    Args:
+        ch (pika.Channel): The channel object for RabbitMQ communication
+        delivery_tag (int): Delivery tag of the request
+        properties (pika.spec.BasicProperties): Properties of the request
+        body (bytes): Body of the request, republished as is
+        operation (str): Operation of the request, None if it could not be parsed
+        error (Exception): What went wrong
+    """
+    key = idempotency_key(properties, body, operation)
+    if key is not None:
+        # Processed again when it comes back, or when the client retries it
+        idempotency.replies.abandon(key)
+    if DEFER and isinstance(error, UpstreamUnavailable):
+        delay = max(error.retry_after, 1)
+        if not hold(delivery_tag, properties.headers if properties else None, delay):
+            ch.connection.call_later(delay, functools.partial(requeue, ch, delivery_tag))
+        return
+    if retry_queues.retryable(operation, error):
+        hop = retry_queues.next_hop(properties.headers if properties else None, error, delivery_queue(delivery_tag))
+        if not hop.parked and hold(delivery_tag, hop.headers, retry_queues.hop_delay(hop)):
+            metrics.RETRIES.labels("delayed").inc()
+            return
+        published = republish(ch, properties, body, hop)
+        if published and not hop.parked:
+            metrics.RETRIES.labels("delayed").inc()
+            ack(ch, delivery_tag)
+            return
+        if published:
+            metrics.PARKED.inc()
+    send_reply(ch, properties, error_reply(error))
+    ack(ch, delivery_tag)
+
+
+def republish(ch, properties, body, hop):
+    """
+    Publishes a failed request to its delay queue or to the parking lot.
+
+    Returns:
+        bool: True if the request was published
+    """
+    properties = properties or pika.BasicProperties()
+    try:
+        ch.basic_publish(
+            exchange='',
+            routing_key=hop.queue,
+            properties=pika.BasicProperties(
+                reply_to=properties.reply_to,
+                correlation_id=properties.correlation_id,
+                content_type=properties.content_type,
+                delivery_mode=properties.delivery_mode,
+                headers=hop.headers,
+                expiration=hop.expiration,
+            ),
+            body=body
+        )
+        return True
+    except Exception as pub_error:
+        print(f"Error republishing request to {hop.queue}: {pub_error}")
+        return False
+
+
+def requeue(ch, delivery_tag):
+    """
+    Returns a request to the queue without replying to it.
+    """
+    ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+    deliveries.pop(delivery_tag, None)
+    metrics.IN_FLIGHT.dec()
+
+
+def delivery_queue(delivery_tag):
+    """Returns the queue an unacknowledged delivery was consumed from, where its retries go back to."""
+    entry = deliveries.get(delivery_tag)
+    return entry[0].queue if entry is not None else retry_queues.REQUEST_QUEUE
+
+
+def hold(delivery_tag, headers, delay):
+    """
+    Keeps a failed or deferred request of a shard in place (see retry_queues.in_place): it
+    stays unacknowledged at the front of its lane, which sits out its turns for `delay`
+    seconds, and is then processed again with the given headers. The later requests of the
+    shard wait behind it.
+
+    Returns:
+        bool: False if the request is not from a shard, and must go through a delay queue
+    """
+    entry = deliveries.get(delivery_tag)
+    if entry is None or hold_in_lane is None or not retry_queues.in_place(entry[0].queue):
+        return False
+    lane, delivery = entry
+    properties = delivery[2]
+    if properties is not None:
+        # As a republished copy would carry them
+        properties.headers = headers
+    hold_in_lane(lane, delivery, delay)
+    # Counted again when it is processed again
+    metrics.IN_FLIGHT.dec()
+    return True
+
+
+def declare_retry_queues(ch):
+    """
+    Declares the delay queues of the retries, which dead-letter back to the queue each
+    request came from, and the parking lot.
+    """
+    for queue, arguments in retry_queues.delay_queues():
+        ch.queue_declare(queue=queue, arguments=arguments)
+    ch.queue_declare(queue=retry_queues.PARKING_QUEUE)
+
+
+def sample_queue_depth(ch):
+    """
+    Samples the number of messages ready in each request queue, then reschedules itself.
+    """
+    try:
+        for lane in LANES:
+            metrics.QUEUE_DEPTH.labels(lane.queue).set(ch.queue_declare(queue=lane.queue, passive=True).method.message_count)
+    except Exception as e:
+        print(f"Could not sample the queue depth: {e}")
+        return
+    ch.connection.call_later(metrics.QUEUE_INTERVAL, functools.partial(sample_queue_depth, ch))
+
+
+def lane_prefetch(method):
+    """
+    Returns the prefetch of the lane a request was delivered from, which bounds how many
+    requests can join its flight or batch.
+    """
+    entry = deliveries.get(method.delivery_tag)
+    if entry is not None:
+        return entry[0].prefetch
+    # The routing key is the hash key, not the queue, of requests routed by the shard exchange
+    queue = getattr(method, "routing_key", None)
+    for lane in LANES:
+        if lane.queue == queue:
+            return lane.prefetch
+    return PREFETCH
+
+
+def coalesce_last_invoice(ch, method, properties, body, data):
+    """
+    Answers a last_invoice request from the cache, or joins it to the in-flight query for its key.
+
+    The leader's query runs COALESCE_WINDOW later from a connection timer, so identical
+    requests that were already prefetched can join it. Its result is then replied to and
+    acknowledged for every request of the flight (see run_flight).
+
+    Returns:
+        dict: The cached response, or None if the request joined a flight
+    """
+    key = cache_key(data["cuit"], data["pto_vta"], data["cbte_tipo"])
+    cached = last_invoice_cache.get(key)
+    if cached is not None:
+        return cached
+    if flights.join(key, (method.delivery_tag, properties, body)):
+        ch.connection.call_later(COALESCE_WINDOW, functools.partial(run_flight, ch, key, data))
+    return None
+
+
+def run_flight(ch, key, data):
+    """
+    Makes the upstream call of a last_invoice flight and fans the result out to its requests.
+    """
+    with profiler.profile("last_invoice"):
+        error = None
+        try:
+            payload = {"response": fetch_last_invoice(data)}
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            error = e
+
+        waiters = flights.complete(key)
+        for delivery_tag, properties, body in waiters:
+            if error is not None:
+                fail(ch, delivery_tag, properties, body, "last_invoice", error)
+                continue
+            respond(ch, delivery_tag, properties, body, "last_invoice", payload)
+    print(f"Message processed and response sent to {len(waiters)} requests.")
+
+
+def batch_authorization(ch, method, properties, body, data):
+    """
+    Adds an unnumbered invoice to the open batch of its cuit, pto_vta and cbte_tipo.
+
+    The batch is flushed when it is full or BATCH_WINDOW after it was opened (see flush_batch).
+    With a prefetch of 1 in its lane no other invoice can join, so it is flushed right away.
+    """
+    key = cache_key(data["cuit"], data["pto_vta"], data["cbte_tipo"])
+    opened, full = batcher.add(key, data["invoice"], (method.delivery_tag, properties, body))
+    if full or lane_prefetch(method) <= 1:
+        flush_batch(ch, key)
+    elif opened:
+        ch.connection.call_later(BATCH_WINDOW, functools.partial(flush_batch, ch, key))
+
+
+def flush_batch(ch, key):
+    """
+    Authorizes the open batch of a key and replies to and acknowledges each of its requests.
+    """
+    batch = batcher.take(key)
+    if not batch:
+        # Already flushed because it was full
+        return
+    with profiler.profile("authorize"):
+        try:
+            payloads = [{"response": response} for response in authorize_batch(key, [invoice for invoice, _ in batch])]
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            for _, (delivery_tag, properties, body) in batch:
+                fail(ch, delivery_tag, properties, body, "authorize", e)
+            return
+
+        for (_, (delivery_tag, properties, body)), payload in zip(batch, payloads):
+            respond(ch, delivery_tag, properties, body, "authorize", payload)
+    print(f"Batch of {len(batch)} invoices processed and responses sent.")
+
 
 def process_message(ch, method, properties, body):
     """
@@ -46,89 +718,144 @@ def process_message(ch, method, properties, body):
         body (bytes): Message body containing JSON with request parameters
     
     The message body should contain:
+        - operation: last_invoice (default), authorize, cache_stats or bulk_query
         - cuit: Tax ID number
         - pto_vta: Point of sale number
         - cbte_tipo: Invoice type code
+        - invoice: The FECAEDetRequest to authorize (authorize only)
+        - from, to, chunk_size, from_chunk: The invoice range to stream (bulk_query only)
     
-    Raises:
-        ValueError: If message body is empty or missing required parameters
-        json.JSONDecodeError: If message body contains invalid JSON
+    Errors (invalid JSON, missing parameters, ARCA failures) are sent back as {"error": ...}
+    (see error_reply). Requests already answered get their stored reply without calling
+    ARCA again (see idempotency.py).
     """
-    try:
-        if not body:
-            raise ValueError("Empty message body received")
-            
+    metrics.IN_FLIGHT.inc()
+    operation = None
+    with profiler.profile() as sample:
         try:
-            data = json.loads(body)
-        except json.JSONDecodeError:
-            raise ValueError(f"Invalid JSON in message body: {body}")
-        # Extract required parameters from the JSON message
-        cuit = data.get("cuit")  # Tax ID number
-        pto_vta = data.get("pto_vta")  # Point of sale identifier
-        cbte_tipo = data.get("cbte_tipo")  # Invoice type code
-
-        if not cuit or not pto_vta or not cbte_tipo:
-            raise ValueError("Missing required parameters in message: cuit, pto_vta, cbte_tipo")
-
-        # #Check for existing token and sign.  If not found, log in to ARCA.
-        # token_file = "ssl/ssl_files/token.txt"
-        # sign_file = "ssl/ssl_files/sign.txt"
-        
-        # if not os.path.exists(token_file) or not os.path.exists(sign_file):
-        #   print("Login to ARCA required...")
-        #   token, sign = login_ARCA()
-        # else:
-        #   with open(token_file, 'r') as f:
-        #       token = f.read()
-        #   with open(sign_file, 'r') as f:
-        #       sign = f.read()
-
-        # Authenticate with ARCA service and get security tokens
-        token, sign = login_ARCA()
-
-        # Query ARCA web service for the last invoice number
-        response = solicitar_ultimo_comprobante(token, sign, cuit, pto_vta, cbte_tipo)
-        # Convert Zeep response object to dictionary
-        response_dict = serialize_object(response)
+            try:
+                data = parse_request(body, properties.content_type if properties else None)
+            except ValueError:
+                sample.operation = "invalid"
+                metrics.MESSAGES.labels("invalid").inc()
+                raise
+            operation = sample.operation = data["operation"]
+            metrics.MESSAGES.labels(operation).inc()
+            if replay(ch, method, properties, body, operation):
+                # Already answered, or being processed from another delivery
+                return
+            if data["operation"] == "last_invoice" and COALESCE_WINDOW > 0 and lane_prefetch(method) > 1:
+                response_dict = coalesce_last_invoice(ch, method, properties, body, data)
+                if response_dict is None:
+                    # Replied to and acknowledged by run_flight
+                    return
+            elif data["operation"] == "authorize" and "CbteDesde" not in data["invoice"]:
+                # Replied to and acknowledged by flush_batch
+                batch_authorization(ch, method, properties, body, data)
+                return
+            elif data["operation"] == "bulk_query":
+                # Replied to with a stream of chunks, continued in a new message and
+                # acknowledged by stream_bulk_query
+                stream_bulk_query(ch, method, properties, data)
+                return
+            else:
+                response_dict = handle_request(data)
+
+        except Exception as e:
+            #Handle exceptions, send error message back if needed
+            print(f"Error processing message: {e}")
+            fail(ch, method.delivery_tag, properties, body, operation, e)
+            return
 
         #Send response back to the original sender using reply_to
-        if properties and properties.reply_to:
-            try:
-                ch.basic_publish(
-                    exchange='',
-                    routing_key=str(properties.reply_to),  # Ensure routing key is string
-                    properties=pika.BasicProperties(
-                        correlation_id=properties.correlation_id if properties.correlation_id else None
-                    ),
-                    body=json.dumps({"response": response_dict})
-                )
-                print("Message processed and response sent.")
-            except Exception as pub_error:
-                print(f"Error sending response: {pub_error}")
-        else:
-            print("No reply_to property in request, response not sent")
-        
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        if respond(ch, method.delivery_tag, properties, body, operation, {"response": response_dict}):
+            print("Message processed and response sent.")
 
-    except Exception as e:
-        #Handle exceptions, send error message back if needed
-        print(f"Error processing message: {e}")
-        
-        # Only try to send error response if reply_to is available
-        if properties and properties.reply_to:
-            try:
-                ch.basic_publish(
-                    exchange='',
-                    routing_key=str(properties.reply_to),  # Ensure routing key is string
-                    properties=pika.BasicProperties(
-                        correlation_id=properties.correlation_id if properties.correlation_id else None
-                    ),
-                    body=json.dumps({"error": str(e)})
-                )
-            except Exception as pub_error:
-                print(f"Error sending error response: {pub_error}")
-        
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+def consume_lanes(channel):
+    """
+    Consumes every lane, each with its own prefetch, and processes the deliveries one at a
+    time in the order chosen by a LaneScheduler.
+
+    Deliveries are only buffered by the consumer callbacks. A connection timer then
+    processes one of them and reschedules itself while any is left, so the deliveries that
+    arrive in the meantime compete for the next turn. Requests of a shard held in place
+    (see hold) are put back in front of their lane, and the timer waits for them while no
+    other lane has work.
+
+    Returns:
+        function: Stops processing after the message in progress and closes the channel.
+            Closing (instead of cancelling the consumers first) requeues the buffered
+            deliveries before the next single active consumer of a shard gets any message,
+            so the requests of a point of sale stay in order across the handover.
+    """
+    global hold_in_lane
+    scheduler = lanes.LaneScheduler(LANES)
+    timer = None
+    due = None
+    stopping = False
+
+    def schedule(delay):
+        nonlocal timer, due
+        if timer is not None:
+            if due <= time.monotonic() + delay:
+                return
+            channel.connection.remove_timeout(timer)
+        due = time.monotonic() + delay
+        timer = channel.connection.call_later(delay, run_next)
+
+    def run_next():
+        nonlocal timer
+        timer = None
+        if stopping:
+            return
+        delivery = scheduler.take()
+        if delivery is not None:
+            process_message(*delivery)
+        wait = scheduler.wait()
+        if wait is not None:
+            schedule(wait)
+
+    def on_delivery(lane, ch, method, properties, body):
+        delivery = (ch, method, properties, body)
+        deliveries[method.delivery_tag] = (lane, delivery)
+        scheduler.put(lane, delivery)
+        schedule(0)
+
+    def put_back(lane, delivery, delay):
+        scheduler.put_back(lane, delivery, delay)
+        schedule(scheduler.wait())
+
+    hold_in_lane = put_back
+
+    for lane in LANES:
+        channel.queue_declare(queue=lane.queue, arguments=lane.arguments)
+        # Without global_qos, the prefetch applies to each consumer created afterwards
+        channel.basic_qos(prefetch_count=lane.prefetch)
+        channel.basic_consume(queue=lane.queue, on_message_callback=functools.partial(on_delivery, lane))
+
+    def stop():
+        nonlocal stopping
+        stopping = True
+        channel.connection.call_later(0, channel.close)
+
+    return stop
+
+
+def declare_shards(ch):
+    """
+    Declares every shard queue, owned or not, so no sharded request is dropped while its
+    owner is down, and in exchange routing mode the consistent hash exchange and its bindings.
+    """
+    if shards.SHARDS <= 0:
+        return
+    if shards.SHARD_ROUTING == "exchange":
+        ch.exchange_declare(exchange=shards.SHARD_EXCHANGE, exchange_type="x-consistent-hash", durable=True)
+    for queue in shards.shard_queues():
+        ch.queue_declare(queue=queue, arguments=shards.SHARD_QUEUE_ARGUMENTS)
+        if shards.SHARD_ROUTING == "exchange":
+            # The routing key of a binding is its weight in the hash ring
+            ch.queue_bind(queue=queue, exchange=shards.SHARD_EXCHANGE, routing_key="1")
 
 
 def main():
@@ -136,24 +863,48 @@ def main():
     Main function to establish RabbitMQ connection and start consuming messages.
     
     Sets up a connection to RabbitMQ using environment variables for configuration,
-    declares necessary queues ('arca' for requests and 'response' for replies),
-    and starts consuming messages from the 'arca' queue.
+    declares necessary queues ('arca' and 'arca.authorize' for requests and 'response'
+    for replies), and starts consuming the request queues (see consume_lanes).
     
-    The service runs indefinitely until interrupted with CTRL+C.
+    The service runs indefinitely until interrupted with CTRL+C. On SIGTERM it finishes
+    and acknowledges the message in progress and closes the channel and the connection,
+    so prefetched but unprocessed messages are requeued.
     """
     # Set up RabbitMQ connection with credentials from environment variables
     credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials))
     
     # Create channel and ensure queues exist
+    # Heartbeats keep flowing while this thread waits for a TA renewed by another process
+    login_arca.wait_with(connection.sleep)
     channel = connection.channel()
-    channel.queue_declare(queue='arca')
     channel.queue_declare(queue='response') # For responses, if needed.
+    declare_retry_queues(channel)
+    declare_shards(channel)
+    stop = consume_lanes(channel)
+    metrics.start_server()
+    if metrics.QUEUE_INTERVAL > 0:
+        sample_queue_depth(channel)
+    profiler.install()
+
+    def drain(signum, frame):
+        # process_message runs to completion (including its ack) before pika
+        # runs the timer that closes the channel, which ends the consume loop
+        print(' [*] SIGTERM received, draining')
+        stop()
 
-    channel.basic_consume(queue='arca', on_message_callback=process_message)
+    signal.signal(signal.SIGTERM, drain)
 
     print(' [*] Waiting for messages. To exit press CTRL+C')
-    channel.start_consuming()
+    try:
+        channel.start_consuming()
+    finally:
+        if connection.is_open:
+            connection.close()
 
 if __name__ == '__main__':
-    main()
+    if WORKER_MODE == "async":
+        from async_worker import run
+        run()
+    else:
+        main()
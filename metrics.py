@@ -0,0 +1,319 @@
+"""
+Prometheus metrics of the gateway workers.
+
+A minimal, dependency-free implementation of counters, gauges and histograms with labels,
+rendered in the Prometheus text exposition format by a small HTTP server that each worker
+starts on ARCA_METRICS_PORT (plus the worker slot when running under supervisor.py).
+Recording a sample is a dict lookup, a bisect and a locked increment, a microsecond or two.
+
+Metrics:
+    - arca_stage_seconds{stage}: login_arca, wsdl_load, to_builtin, encode, publish
+    - arca_soap_call_seconds{operation}: WSFEv1 calls, through the template engine or zeep
+    - arca_messages_total{operation}: Requests received (operation "invalid" if unparseable)
+    - arca_replies_total{outcome}: Replies sent, "response" or "error"
+    - arca_upstream_errors_total{code}: ARCA error and observation codes in replies
+    - arca_retries_total{reason}: "numbering" (batch resent after resyncing), "ta_renewal",
+      "delayed" (request sent to a retry queue)
+    - arca_parked_total: Requests moved to the parking lot after their last retry
+    - arca_last_invoice_cache_total{result}: Cache hits and misses
+    - arca_in_flight_messages: Messages received and not yet acknowledged
+    - arca_queue_depth{queue}: Messages ready in each request queue ('arca', 'arca.authorize'),
+      sampled every ARCA_METRICS_QUEUE_INTERVAL
+    - arca_upstream_concurrency_limit: Adaptive limit of concurrent WSFEv1 calls (see upstream_guard.py)
+    - arca_circuit_state: 0 closed, 1 half-open, 2 open
+    - arca_upstream_rejected_total{reason}: Calls not sent to ARCA, "circuit_open" or "overloaded"
+    - arca_duplicates_total{outcome}: Repeated requests, "replayed" from the idempotency store or
+      "busy" (deferred while the original is in progress)
+
+Environment Variables:
+    - ARCA_METRICS_PORT: Port of the /metrics endpoint, 0 disables it (default: 9464)
+    - ARCA_METRICS_QUEUE_INTERVAL: Seconds between queue depth samples (default: 5)
+"""
+
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("ARCA_METRICS_PORT", 9464))
+QUEUE_INTERVAL = float(os.environ.get("ARCA_METRICS_QUEUE_INTERVAL", 5))
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        """Returns the child metric of a combination of label values."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(_format_labels(self.labelnames, values), values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value", "lock", "function")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+        self.function = None
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Samples the value from function() when scraped."""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Counter(_Metric):
+    """Monotonic counter. Without labels, inc() is called on the metric itself."""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, labels, values, child):
+        return [f"{self.name}{labels} {child.get()}"]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, or is sampled from a function when scraped."""
+
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the time spent in its block."""
+        return _Timer(self)
+
+
+class Histogram(_Metric):
+    """Cumulative histogram with fixed buckets (seconds)."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, labels, values, child):
+        with child.lock:
+            counts, total = list(child.counts), child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = 'le="+Inf"' if bound == float("inf") else f'le="{float(bound)!r}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def timed(histogram, *labels):
+    """
+    Decorator observing the duration of every call of a function or coroutine function.
+    """
+    child = histogram.labels(*labels)
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+
+    return decorator
+
+
+STAGE_SECONDS = Histogram("arca_stage_seconds", "Time spent in each stage of a request", ("stage",))
+SOAP_CALL_SECONDS = Histogram("arca_soap_call_seconds", "Duration of WSFEv1 calls", ("operation",))
+MESSAGES = Counter("arca_messages_total", "Requests received", ("operation",))
+REPLIES = Counter("arca_replies_total", "Replies sent", ("outcome",))
+UPSTREAM_ERRORS = Counter("arca_upstream_errors_total", "ARCA error and observation codes in replies", ("code",))
+RETRIES = Counter("arca_retries_total", "Retried upstream operations", ("reason",))
+PARKED = Counter("arca_parked_total", "Requests parked after their last retry")
+CACHE = Counter("arca_last_invoice_cache_total", "Last invoice cache lookups", ("result",))
+IN_FLIGHT = Gauge("arca_in_flight_messages", "Messages received and not yet acknowledged")
+QUEUE_DEPTH = Gauge("arca_queue_depth", "Messages ready in each request queue", ("queue",))
+UPSTREAM_LIMIT = Gauge("arca_upstream_concurrency_limit", "Adaptive limit of concurrent WSFEv1 calls")
+CIRCUIT_STATE = Gauge("arca_circuit_state", "Circuit breaker state: 0 closed, 1 half-open, 2 open")
+REJECTED = Counter("arca_upstream_rejected_total", "Calls rejected without being sent to ARCA", ("reason",))
+DUPLICATES = Counter("arca_duplicates_total", "Repeated requests answered without calling ARCA", ("outcome",))
+
+
+def _codes(container, list_name, item_name):
+    for item in ((container or {}).get(list_name) or {}).get(item_name) or []:
+        code = item.get("Code")
+        if code is not None:
+            yield code
+
+
+def record_reply(payload):
+    """
+    Counts a reply by outcome and the ARCA error and observation codes of its response.
+    """
+    response = payload.get("response")
+    if response is None:
+        REPLIES.labels("error").inc()
+        return
+    REPLIES.labels("response").inc()
+    if not isinstance(response, dict):
+        return
+    for code in _codes(response, "Errors", "Err"):
+        UPSTREAM_ERRORS.labels(str(code)).inc()
+    for detail in (response.get("FeDetResp") or {}).get("FECAEDetResponse") or []:
+        for code in _codes(detail, "Observaciones", "Obs"):
+            UPSTREAM_ERRORS.labels(str(code)).inc()
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=None):
+    """
+    Serves /metrics from a daemon thread.
+
+    The port is ARCA_METRICS_PORT plus ARCA_WORKER_SLOT (set by supervisor.py), so every
+    worker of a pool gets its own endpoint.
+
+    Returns:
+        ThreadingHTTPServer: The server, or None if metrics are disabled or the port is taken
+    """
+    if port is None:
+        if not METRICS_PORT:
+            return None
+        port = METRICS_PORT + int(os.environ.get("ARCA_WORKER_SLOT", 0))
+    try:
+        server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    except OSError as e:
+        print(f"Could not serve metrics on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f" [*] Serving metrics on port {port}")
+    return server
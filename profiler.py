@@ -0,0 +1,223 @@
+"""
+Opt-in profiling of the gateway workers under real traffic.
+
+Two modes, both off by default:
+    - Per message: with ARCA_PROFILE_EVERY=N every Nth message is run under cProfile. The
+      samples are aggregated per operation (last_invoice, authorize, ...) and written as
+      pstats files every ARCA_PROFILE_FLUSH samples and on exit:
+          <ARCA_PROFILE_DIR>/<operation>-<pid>-<timestamp>.pstats
+      Open them with pstats, snakeviz, or turn them into flame graphs with flameprof.
+    - Time window: on SIGUSR1 a sampler thread records the stack of every thread each
+      ARCA_PROFILE_INTERVAL_MS for ARCA_PROFILE_WINDOW seconds (pika callbacks, zeep, the
+      TA renewal and executor threads included) and writes them in collapsed-stack format,
+      with the operation being processed by the thread as the root frame ("untagged" for
+      threads outside of a message, and for the async worker):
+          <ARCA_PROFILE_DIR>/window-<pid>-<timestamp>.collapsed
+      Feed them to flamegraph.pl or speedscope.
+
+When disabled, profile() costs a counter increment per message.
+
+Environment Variables:
+    - ARCA_PROFILE_EVERY: Profile every Nth message, 0 disables it (default: 0)
+    - ARCA_PROFILE_FLUSH: Samples of an operation aggregated per pstats file (default: 100)
+    - ARCA_PROFILE_WINDOW: Seconds sampled after SIGUSR1 (default: 30)
+    - ARCA_PROFILE_INTERVAL_MS: Interval of the stack sampler (default: 5)
+    - ARCA_PROFILE_DIR: Directory of the profiles (default: ./profiles)
+"""
+
+import atexit
+import cProfile
+import itertools
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+PROFILE_EVERY = int(os.environ.get("ARCA_PROFILE_EVERY", 0))
+PROFILE_FLUSH = int(os.environ.get("ARCA_PROFILE_FLUSH", 100))
+PROFILE_WINDOW = float(os.environ.get("ARCA_PROFILE_WINDOW", 30))
+PROFILE_INTERVAL = float(os.environ.get("ARCA_PROFILE_INTERVAL_MS", 5)) / 1000
+PROFILE_DIR = os.environ.get(
+    "ARCA_PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+)
+
+_counter = itertools.count(1)
+_stats = {}  # operation -> (pstats.Stats, samples)
+_stats_lock = threading.Lock()
+
+# Thread ident -> operation in progress, only maintained while a window is being sampled
+_operations = {}
+_window = None
+_local = threading.local()
+
+
+def _path(prefix, extension):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    return os.path.join(PROFILE_DIR, f"{prefix}-{os.getpid()}-{stamp}.{extension}")
+
+
+class _MessageProfile:
+    """Context of one profiled message. Set `operation` once it is known."""
+
+    def __init__(self, operation, sampled):
+        self.operation = operation
+        self._profile = cProfile.Profile() if sampled else None
+
+    def __enter__(self):
+        _local.active = True
+        if _window is not None:
+            _operations[threading.get_ident()] = self
+        if self._profile is not None:
+            try:
+                self._profile.enable()
+            except ValueError:
+                # Another profiler is active in this thread
+                self._profile = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._profile is not None:
+            self._profile.disable()
+            _record(self.operation or "unknown", self._profile)
+        _operations.pop(threading.get_ident(), None)
+        _local.active = False
+
+
+def profile(operation=None):
+    """
+    Returns the context to run one message in, profiled if it is its turn.
+
+    Args:
+        operation (str): The operation, if already known. It can also be set later on
+            the returned object (`as p: ... p.operation = data["operation"]`).
+
+    Work nested in a profiled message (e.g. a batch flushed while processing the message
+    that filled it) belongs to that message and is not profiled on its own.
+    """
+    if (PROFILE_EVERY <= 0 and _window is None) or getattr(_local, "active", False):
+        return _UNTRACKED
+    sampled = PROFILE_EVERY > 0 and next(_counter) % PROFILE_EVERY == 0
+    return _MessageProfile(operation, sampled)
+
+
+class _Untracked:
+    """Shared no-op context used when profiling is off."""
+
+    operation = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_UNTRACKED = _Untracked()
+
+
+def _record(operation, profile):
+    with _stats_lock:
+        stats, samples = _stats.get(operation, (None, 0))
+        if stats is None:
+            stats = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+        samples += 1
+        if samples >= PROFILE_FLUSH:
+            _dump(operation, stats)
+            _stats.pop(operation, None)
+        else:
+            _stats[operation] = (stats, samples)
+
+
+def _dump(operation, stats):
+    path = _path(operation, "pstats")
+    try:
+        stats.dump_stats(path)
+    except OSError as e:
+        print(f"Could not write profile {path}: {e}")
+
+
+def flush():
+    """Writes the samples aggregated so far, e.g. before the worker exits."""
+    with _stats_lock:
+        for operation, (stats, _) in _stats.items():
+            _dump(operation, stats)
+        _stats.clear()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample_window(duration, interval):
+    global _window
+    own = threading.get_ident()
+    samples = Counter()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            context = _operations.get(ident)
+            root = (context.operation if context is not None else None) or "untagged"
+            samples[";".join([root] + stack[::-1])] += 1
+        time.sleep(interval)
+    _window = None
+    _operations.clear()
+
+    path = _path("window", "collapsed")
+    try:
+        with open(path, "w") as f:
+            for stack, count in samples.items():
+                f.write(f"{stack} {count}\n")
+        print(f"Wrote {sum(samples.values())} stack samples to {path}")
+    except OSError as e:
+        print(f"Could not write profile {path}: {e}")
+
+
+def start_window(duration=PROFILE_WINDOW, interval=PROFILE_INTERVAL):
+    """
+    Samples the stacks of every thread for `duration` seconds from a background thread.
+
+    Returns:
+        bool: False if a window is already being sampled
+    """
+    global _window
+    if _window is not None:
+        return False
+    _window = threading.Thread(target=_sample_window, args=(duration, interval), daemon=True)
+    _window.start()
+    return True
+
+
+def install(per_message=True):
+    """
+    Starts a sampling window on SIGUSR1 and flushes the per-message profiles on exit.
+    Must be called from the main thread.
+
+    Args:
+        per_message (bool): False where messages interleave in one thread (async_worker.py),
+            which cProfile cannot tell apart. Only the window mode is available there.
+    """
+    global PROFILE_EVERY
+    if not per_message:
+        PROFILE_EVERY = 0
+    def on_signal(signum, frame):
+        if start_window():
+            print(f" [*] Sampling stacks for {PROFILE_WINDOW}s")
+
+    signal.signal(signal.SIGUSR1, on_signal)
+    if PROFILE_EVERY > 0:
+        atexit.register(flush)
+        print(f" [*] Profiling every {PROFILE_EVERY} messages into {PROFILE_DIR}")
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 """
 RabbitMQ client that requests the last invoice number from a remote service.
-This script establishes a connection with RabbitMQ, sends a request with invoice parameters,
-and waits for a response using a temporary callback queue. It implements a request-reply
-pattern with correlation IDs to ensure responses match their requests.
+ArcaRpcClient keeps one connection with RabbitMQ, sends requests with invoice parameters
+and receives the responses through direct reply-to (amq.rabbitmq.reply-to). It implements
+a request-reply pattern with correlation IDs to ensure responses match their requests, and
+lets callers pipeline many requests with individual timeouts.
 
 The script handles connection retries, timeouts, and proper cleanup of resources.
 """
@@ -12,11 +13,159 @@ import json
 import uuid
 import time
 import sys
+from concurrent.futures import Future
+
+from shards import route
+
+# RabbitMQ pseudo-queue for direct reply-to: replies are pushed straight to the consumer
+# of the requesting channel, without declaring a callback queue
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+class ArcaRpcClient:
+    """
+    Reusable RPC client for the 'arca' queue.
+
+    Keeps one connection and channel open and receives every reply through RabbitMQ's
+    direct reply-to. Each request gets a Future that is resolved by correlation_id, so
+    many requests can be pipelined and waited for together, each with its own timeout.
+
+    The client is not thread-safe: use one instance per thread.
+
+    Example:
+        with ArcaRpcClient() as client:
+            futures = [client.send_last_invoice(cuit, pto_vta, tipo, timeout=5) for tipo in ("1", "6")]
+            responses = client.wait(futures)
+    """
+
+    def __init__(self, host='localhost', port=5672, user='guest', password='guest'):
+        # Establish connection with retry mechanism for better reliability
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+            host=host,
+            port=port,
+            credentials=pika.PlainCredentials(user, password),
+            connection_attempts=3,
+            retry_delay=1
+        ))
+        self.channel = self.connection.channel()
+        # Direct reply-to requires consuming in no-ack mode before publishing
+        self.channel.basic_consume(
+            queue=DIRECT_REPLY_TO,
+            on_message_callback=self._on_response,
+            auto_ack=True
+        )
+        self._pending = {}  # correlation_id -> (future, deadline)
+
+    def _on_response(self, ch, method, props, body):
+        entry = self._pending.pop(props.correlation_id, None)
+        if entry is None:
+            # Late reply for a request that already timed out
+            return
+        try:
+            entry[0].set_result(json.loads(body))
+        except json.JSONDecodeError:
+            entry[0].set_result({"error": "Failed to parse response as JSON", "raw": body.decode()})
+
+    def send(self, message, timeout=30):
+        """
+        Publishes a request to its queue ('arca', 'arca.authorize' for authorize requests, see
+        lanes.py, or its shard with ARCA_SHARDS, see shards.py) without waiting for its reply.
+
+        Args:
+            message (dict): The request body
+            timeout (float, optional): Seconds to wait for the reply. Defaults to 30.
+
+        Returns:
+            concurrent.futures.Future: Resolved with the reply by wait(), or failed with
+                TimeoutError if no reply arrives in time
+        """
+        # Generate a unique correlation ID for this request to match response with request
+        correlation_id = str(uuid.uuid4())
+        future = Future()
+        self._pending[correlation_id] = (future, time.monotonic() + timeout)
+        exchange, routing_key = route(message)
+        try:
+            self.channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                properties=pika.BasicProperties(
+                    reply_to=DIRECT_REPLY_TO,
+                    correlation_id=correlation_id,
+                ),
+                body=json.dumps(message)
+            )
+        except Exception:
+            # Never sent, so no reply will ever resolve it
+            self._pending.pop(correlation_id, None)
+            raise
+        return future
+
+    def send_last_invoice(self, cuit, pto_vta, cbte_tipo, timeout=30):
+        """
+        Requests the last invoice number without waiting for the reply. See send().
+        """
+        return self.send({"cuit": cuit, "pto_vta": pto_vta, "cbte_tipo": cbte_tipo}, timeout)
+
+    def wait(self, futures):
+        """
+        Processes replies until every given request is answered or timed out.
+
+        Args:
+            futures (Future or list): What send() returned
+
+        Returns:
+            The reply, or the list of replies in the same order
+
+        Raises:
+            TimeoutError: If a request was not answered within its timeout
+        """
+        single = isinstance(futures, Future)
+        waiting = [futures] if single else list(futures)
+        while not all(future.done() for future in waiting):
+            deadlines = [deadline for future, deadline in self._pending.values() if not future.done()]
+            remaining = min(deadlines) - time.monotonic() if deadlines else 0
+            self.connection.process_data_events(time_limit=max(remaining, 0))
+            self._expire()
+        results = [future.result() for future in waiting]
+        return results[0] if single else results
+
+    def call(self, message, timeout=30):
+        """
+        Sends a request and waits for its reply.
+        """
+        return self.wait(self.send(message, timeout))
+
+    def _expire(self):
+        now = time.monotonic()
+        for correlation_id, (future, deadline) in list(self._pending.items()):
+            if deadline <= now:
+                del self._pending[correlation_id]
+                future.set_exception(TimeoutError(f"No response received for request {correlation_id}"))
+
+    def close(self):
+        """Closes the connection, failing the requests still pending."""
+        for future, _ in self._pending.values():
+            future.set_exception(ConnectionError("Client closed"))
+        self._pending.clear()
+        if self.connection and not self.connection.is_closed:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+_client = None
+
 
 def request_last_invoice(cuit, pto_vta, cbte_tipo, timeout=30):  # timeout in seconds
     """
     Request the last invoice number for given parameters using RabbitMQ.
 
+    Reuses one ArcaRpcClient (and its connection) for every call in the process.
+
     Args:
         cuit (str): The tax ID number of the company
         pto_vta (str): The point of sale number
@@ -31,81 +180,23 @@ def request_last_invoice(cuit, pto_vta, cbte_tipo, timeout=30):  # timeout in se
         pika.exceptions.AMQPConnectionError: If connection to RabbitMQ fails
         Exception: For other unexpected errors
     """
-    connection = None
+    global _client
     try:
-        # Establish connection with retry mechanism for better reliability
-        connection = pika.BlockingConnection(pika.ConnectionParameters(
-            host='localhost',
-            connection_attempts=3,
-            retry_delay=1
-        ))
-        channel = connection.channel()
-
-        # Declare a temporary exclusive queue for responses - will be auto-deleted when connection closes
-        result = channel.queue_declare(queue='', exclusive=True)
-        callback_queue = result.method.queue
-
-        # Generate a unique correlation ID for this request to match response with request
-        correlation_id = str(uuid.uuid4())
-        
-        # Store the response when it arrives - used by callback function
-        response_received = None
-        
-        def on_response(ch, method, props, body):
-            if props.correlation_id == correlation_id:
-                nonlocal response_received
-                try:
-                    response_received = json.loads(body)
-                except json.JSONDecodeError:
-                    response_received = {"error": "Failed to parse response as JSON", "raw": body.decode()}
-
-        # Set up consumer for the response queue with auto acknowledgment
-        channel.basic_consume(
-            queue=callback_queue,
-            on_message_callback=on_response,
-            auto_ack=True
-        )
-
-        # Prepare the request message with required invoice parameters
-        message = {
-            "cuit": cuit,
-            "pto_vta": pto_vta,
-            "cbte_tipo": cbte_tipo
-        }
-
-        # Send the request to the 'arca' queue with correlation ID and reply-to queue
-        channel.basic_publish(
-            exchange='',
-            routing_key='arca',
-            properties=pika.BasicProperties(
-                reply_to=callback_queue,
-                correlation_id=correlation_id,
-            ),
-            body=json.dumps(message)
-        )
+        if _client is None or _client.connection.is_closed:
+            _client = ArcaRpcClient()
 
+        future = _client.send_last_invoice(cuit, pto_vta, cbte_tipo, timeout)
         print(" [x] Sent request for last invoice, waiting for response...")
+        return _client.wait(future)
 
-        # Wait for the response with timeout - check every second for new messages
-        start_time = time.time()
-        while response_received is None:
-            if time.time() - start_time > timeout:
-                raise TimeoutError(f"No response received after {timeout} seconds")
-            connection.process_data_events()
-            connection.sleep(1.0)  # Sleep for 1 second between checks
-
-        return response_received
-
+    except TimeoutError:
+        raise
     except pika.exceptions.AMQPConnectionError as e:
         print(f"Failed to connect to RabbitMQ: {e}")
         sys.exit(1)
     except Exception as e:
         print(f"An error occurred: {e}")
         sys.exit(1)
-    finally:
-        # Ensure connection is closed even if an error occurs
-        if connection and not connection.is_closed:
-            connection.close()
 
 def main():
     """
@@ -0,0 +1,204 @@
+"""
+Delayed retries of failed requests through RabbitMQ, without blocking the worker.
+
+A request that fails with a transient error (ARCA unreachable, timing out, answering 5xx or
+a SOAP fault, or rejected by upstream_guard.py) is republished to a delay queue and
+acknowledged. Delay queues have no consumers: the message expires after the delay of its
+tier and is dead-lettered back to the queue it was consumed from, where a worker picks it
+up again. Each attempt waits twice as long as the previous one:
+
+    arca -> fails -> arca.retry.1000ms --(1s)--> arca -> fails -> arca.retry.2000ms --(2s)--> ...
+
+Every request queue has its own delay queues ('arca.authorize.retry.<delay>ms', ...), so a
+retried authorization stays in the priority lane of lanes.py.
+
+Shard queues (see shards.py) have none: a request of a shard that comes back through a delay
+queue lands at its tail, behind later invoices of the same point of sale. Its retries and
+deferrals are instead held in place (see in_place): the worker keeps the delivery
+unacknowledged at the front of the shard for the same delay and processes it again then,
+so the shard waits for it, as it would for a slow ARCA call.
+
+The attempt number travels in the x-arca-attempt header. After ARCA_RETRY_ATTEMPTS retries
+the request is moved to the 'arca.parking' queue, with the last error in x-arca-error, for
+inspection or manual replay, and the error is replied to.
+
+The TTL is set per message (the expiration property) instead of on the queue, so the delays
+can be tuned without redeclaring the queues. Every message of a tier has the same TTL, so
+none of them waits behind a longer-lived one.
+
+Only requests that can be repeated safely are retried: last_invoice on any transient error,
+authorize only when it was rejected before being sent to ARCA, since a CAE request that
+timed out may have been authorized.
+
+Environment Variables:
+    - ARCA_RETRY_ATTEMPTS: Retries before a request is parked, 0 disables retries (default: 5)
+    - ARCA_RETRY_BASE_DELAY: Seconds before the first retry (default: 1)
+    - ARCA_RETRY_MAX_DELAY: Longest delay between retries, in seconds (default: 300)
+"""
+
+import os
+from collections import namedtuple
+
+import requests
+from zeep.exceptions import Fault, TransportError
+
+import lanes
+import shards
+from upstream_guard import UpstreamUnavailable
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+RETRY_ATTEMPTS = int(os.environ.get("ARCA_RETRY_ATTEMPTS", 5))
+RETRY_BASE_DELAY = float(os.environ.get("ARCA_RETRY_BASE_DELAY", 1))
+RETRY_MAX_DELAY = float(os.environ.get("ARCA_RETRY_MAX_DELAY", 300))
+
+REQUEST_QUEUE = lanes.QUERY_QUEUE
+PARKING_QUEUE = "arca.parking"
+ATTEMPT_HEADER = "x-arca-attempt"
+ERROR_HEADER = "x-arca-error"
+
+# Where to republish a failed request: expiration is in milliseconds (None when parked)
+Hop = namedtuple("Hop", ["queue", "headers", "expiration", "parked"])
+
+
+def delays():
+    """
+    Returns:
+        list: Seconds to wait before each retry, one per attempt
+    """
+    return [min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY) for attempt in range(RETRY_ATTEMPTS)]
+
+
+def delay_queue(delay, origin=REQUEST_QUEUE):
+    """Returns the name of the delay queue of a tier for the requests of a queue."""
+    return f"{origin}.retry.{int(delay * 1000)}ms"
+
+
+def delay_queue_arguments(origin):
+    """Returns the arguments of the delay queues of a queue: expired messages go back to it."""
+    return {"x-dead-letter-exchange": "", "x-dead-letter-routing-key": origin}
+
+
+def origin_queues():
+    """Returns every request queue whose requests are retried through delay queues."""
+    return [lanes.AUTHORIZE_QUEUE, lanes.QUERY_QUEUE]
+
+
+def in_place(origin):
+    """
+    Tells whether the requests of a queue are retried and deferred in place instead of
+    through delay queues: those of a shard queue, which must keep their order.
+    """
+    return origin in shards.shard_queues()
+
+
+def hop_delay(hop):
+    """Returns the seconds a hop waits before the request comes back."""
+    return int(hop.expiration) / 1000
+
+
+def delay_queues():
+    """
+    Returns:
+        list: (name, arguments) of every delay queue of every request queue, shortest delay first
+    """
+    tiers = list(dict.fromkeys(delays()))
+    return [(delay_queue(delay, origin), delay_queue_arguments(origin)) for origin in origin_queues() for delay in tiers]
+
+
+def _status_code(error):
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_transient(error):
+    """
+    Tells whether an error may go away by itself (network, timeouts, 5xx/429, SOAP faults).
+    """
+    if isinstance(error, (UpstreamUnavailable, Fault, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(error, TransportError):
+        return error.status_code >= 500 or error.status_code == 429
+    if isinstance(error, requests.HTTPError) or (httpx is not None and isinstance(error, httpx.HTTPStatusError)):
+        status = _status_code(error)
+        return status is not None and (status >= 500 or status == 429)
+    if isinstance(error, requests.RequestException):
+        return True
+    return httpx is not None and isinstance(error, httpx.TransportError)
+
+
+def retryable(operation, error):
+    """
+    Tells whether a request that failed with an error should be retried later.
+
+    Args:
+        operation (str): The operation of the request, None if it could not be parsed
+        error (Exception): What went wrong
+    """
+    if RETRY_ATTEMPTS <= 0:
+        return False
+    if operation == "last_invoice":
+        return is_transient(error)
+    # Not sent to ARCA, so repeating it cannot authorize an invoice twice
+    return operation == "authorize" and isinstance(error, UpstreamUnavailable)
+
+
+def attempt_of(headers):
+    """Returns how many times a request has been retried, from its headers."""
+    try:
+        return int((headers or {}).get(ATTEMPT_HEADER, 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def next_hop(headers, error, origin=REQUEST_QUEUE):
+    """
+    Plans the retry of a failed request.
+
+    Args:
+        headers (dict): Headers of the request
+        error (Exception): What went wrong
+        origin (str): The queue the request was consumed from, where the retry goes back to
+
+    Returns:
+        Hop: The queue to republish the request to and its new headers. When the retries are
+            exhausted the queue is the parking lot and the error must also be replied to.
+    """
+    attempt = attempt_of(headers)
+    headers = dict(headers or {})
+    if attempt >= RETRY_ATTEMPTS:
+        headers[ERROR_HEADER] = str(error)[:1000]
+        return Hop(PARKING_QUEUE, headers, None, True)
+
+    tiers = delays()
+    delay = tiers[attempt]
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after:
+        # No point in coming back while the circuit breaker is still open
+        delay = next((tier for tier in tiers[attempt:] if tier >= retry_after), tiers[-1])
+    headers[ATTEMPT_HEADER] = attempt + 1
+    return Hop(delay_queue(delay, origin), headers, str(int(delay * 1000)), False)
+
+
+def deferral(headers, delay, origin=REQUEST_QUEUE):
+    """
+    Plans bringing a request back after about `delay` seconds without counting it as a
+    retry, e.g. a duplicate of a request still in progress (see idempotency.py).
+
+    Args:
+        headers (dict): Headers to republish the request with
+        delay (float): Seconds to wait, rounded up to the next delay tier
+        origin (str): The queue the request was consumed from, where it goes back to
+
+    Returns:
+        Hop: Where to republish the request, or None if there are no delay queues
+            (ARCA_RETRY_ATTEMPTS=0)
+    """
+    tiers = delays()
+    if not tiers:
+        return None
+    delay = next((tier for tier in tiers if tier >= delay), tiers[-1])
+    return Hop(delay_queue(delay, origin), dict(headers or {}), str(int(delay * 1000)), False)
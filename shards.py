@@ -0,0 +1,134 @@
+"""
+Per-taxpayer sharding of the 'arca' requests.
+
+With ARCA_SHARDS=N, requests that carry a cuit are routed by (cuit, pto_vta) to one of N
+shard queues, 'arca.shard.0' ... 'arca.shard.<N-1>':
+    - Publisher routing (ARCA_SHARD_ROUTING=publisher, the default): the client picks the
+      shard with a jump consistent hash of "cuit:pto_vta" and publishes to it directly.
+    - Exchange routing (ARCA_SHARD_ROUTING=exchange): the client publishes to the
+      'arca.shards' x-consistent-hash exchange (rabbitmq_consistent_hash_exchange plugin)
+      with "cuit:pto_vta" as routing key, and the exchange picks the shard.
+
+Every shard queue is declared with x-single-active-consumer, so even if two workers consume
+it only one of them gets its messages, in order. Shards are owned by worker slots
+(shard % ARCA_WORKERS == ARCA_WORKER_SLOT), so the work of a point of sale runs in order
+while different taxpayers run in parallel, and a noisy CUIT only slows down its own shard.
+Requests without a cuit (cache_stats) keep using the lanes of lanes.py, and so do bulk
+queries, which only read and would hold a shard for the whole of their stream.
+
+Rebalancing: when supervisor.py grows or shrinks the pool (SIGTTIN / SIGTTOU) it restarts
+the workers one at a time with the new ARCA_WORKERS. A worker hands over its shards by
+finishing the message in progress and closing its channel, which requeues the rest in
+order before the new owner becomes the active consumer. The number of shards must stay
+fixed while there are messages in the shard queues, or some points of sale would move
+to another shard with requests still queued in the old one.
+
+Environment Variables:
+    - ARCA_SHARDS: Number of shard queues, 0 disables sharding (default: 0)
+    - ARCA_SHARD_ROUTING: "publisher" or "exchange" (default: publisher)
+    - ARCA_SHARD_PREFETCH: Prefetch of each shard (default: ARCA_PREFETCH of the worker)
+    - ARCA_SHARD_WEIGHT: Turns of each shard in the blocking worker's lane scheduler (default: 4)
+    - ARCA_WORKERS, ARCA_WORKER_SLOT: Set by supervisor.py (default: a single worker owns every shard)
+"""
+
+import hashlib
+import os
+
+from lanes import Lane, queue_for
+
+SHARDS = int(os.environ.get("ARCA_SHARDS", 0))
+SHARD_ROUTING = os.environ.get("ARCA_SHARD_ROUTING", "publisher")
+SHARD_WEIGHT = int(os.environ.get("ARCA_SHARD_WEIGHT", 4))
+
+SHARD_EXCHANGE = "arca.shards"
+
+# Only one consumer of a shard queue receives messages at a time
+SHARD_QUEUE_ARGUMENTS = {"x-single-active-consumer": True}
+
+
+def shard_queue(shard):
+    """Returns the name of the queue of a shard."""
+    return f"arca.shard.{shard}"
+
+
+def shard_key(cuit, pto_vta):
+    """Returns the key requests are sharded by, also the routing key in exchange mode."""
+    # "0001" and 1 are the same point of sale
+    return f"{cuit}:{str(pto_vta).lstrip('0') or '0'}"
+
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping and Veach): maps a key to one of `buckets` buckets so that
+    growing from n to n + 1 buckets only moves 1 / (n + 1) of the keys.
+
+    Args:
+        key (str): The key
+        buckets (int): Number of buckets
+
+    Returns:
+        int: The bucket, in range(buckets)
+    """
+    # Stable across processes, unlike hash()
+    key = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_for(cuit, pto_vta, shards=None):
+    """Returns the shard of a cuit and point of sale."""
+    return jump_hash(shard_key(cuit, pto_vta), shards or SHARDS)
+
+
+def route(request):
+    """
+    Returns where a client should publish a request.
+
+    Args:
+        request (dict): The request body
+
+    Returns:
+        tuple: (exchange, routing_key)
+    """
+    if (SHARDS <= 0 or not request.get("cuit") or not request.get("pto_vta")
+            or request.get("operation") == "bulk_query"):
+        return "", queue_for(request)
+    if SHARD_ROUTING == "exchange":
+        return SHARD_EXCHANGE, shard_key(request["cuit"], request["pto_vta"])
+    return "", shard_queue(shard_for(request["cuit"], request["pto_vta"]))
+
+
+def owned_shards(slot=None, workers=None):
+    """
+    Returns the shards a worker consumes.
+
+    Args:
+        slot (int): Index of the worker in the pool (default: ARCA_WORKER_SLOT)
+        workers (int): Size of the pool (default: ARCA_WORKERS)
+    """
+    if slot is None:
+        slot = int(os.environ.get("ARCA_WORKER_SLOT", 0))
+    if workers is None:
+        workers = int(os.environ.get("ARCA_WORKERS", 1))
+    return [shard for shard in range(SHARDS) if shard % max(workers, 1) == slot]
+
+
+def lanes(default_prefetch):
+    """
+    Returns a lane (see lanes.py) per shard owned by this worker, concurrency 1 so the
+    requests of a shard are processed in order.
+    """
+    prefetch = int(os.environ.get("ARCA_SHARD_PREFETCH", default_prefetch))
+    return [
+        Lane(f"shard-{shard}", shard_queue(shard), prefetch, 1, SHARD_WEIGHT, SHARD_QUEUE_ARGUMENTS)
+        for shard in owned_shards()
+    ]
+
+
+def shard_queues():
+    """Returns every shard queue, owned or not."""
+    return [shard_queue(shard) for shard in range(SHARDS)]
@@ -0,0 +1,317 @@
+"""
+Lean SOAP engine for the hot WSFEv1 operations: FECompUltimoAutorizado, FECAESolicitar
+and FECompConsultar.
+
+zeep builds every request by walking the parsed WSDL and every response by validating it
+against the schema, which costs far more CPU than the call itself needs. This engine:
+    - Renders requests from precompiled envelope templates, escaping each substituted value
+    - Sends them through a pooled keep-alive requests.Session (or an httpx.AsyncClient)
+    - Parses responses incrementally with iterparse straight into dicts with typed values
+      (ints, floats), shaped like encoders.to_builtin applied to the zeep result
+
+zeep stays in use for every other operation, and for these ones too when
+ARCA_SOAP_ENGINE=zeep.
+
+Environment Variables:
+    - ARCA_SOAP_ENGINE: "template" or "zeep" (default: template)
+    - ARCA_HTTP_POOL_SIZE: Keep-alive connections kept per host (default: 20)
+"""
+
+import io
+import os
+import threading
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from zeep.exceptions import Fault
+
+SOAP_ENGINE = os.environ.get("ARCA_SOAP_ENGINE", "template")
+HTTP_POOL_SIZE = int(os.environ.get("ARCA_HTTP_POOL_SIZE", 20))
+
+SOAP_ACTION = "http://ar.gov.afip.dif.FEV1/{}"
+
+ENVELOPE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ar="http://ar.gov.afip.dif.FEV1/">'
+    '<soapenv:Header/><soapenv:Body><ar:{operation}>{auth}{body}</ar:{operation}></soapenv:Body></soapenv:Envelope>'
+)
+AUTH = '<ar:Auth><ar:Token>{token}</ar:Token><ar:Sign>{sign}</ar:Sign><ar:Cuit>{cuit}</ar:Cuit></ar:Auth>'
+ULTIMO_AUTORIZADO = '<ar:PtoVta>{pto_vta}</ar:PtoVta><ar:CbteTipo>{cbte_tipo}</ar:CbteTipo>'
+COMP_CONSULTAR = (
+    '<ar:FeCompConsReq><ar:CbteTipo>{cbte_tipo}</ar:CbteTipo><ar:CbteNro>{cbte_nro}</ar:CbteNro>'
+    '<ar:PtoVta>{pto_vta}</ar:PtoVta></ar:FeCompConsReq>'
+)
+CAE_SOLICITAR = (
+    '<ar:FeCAEReq><ar:FeCabReq><ar:CantReg>{cant_reg}</ar:CantReg><ar:PtoVta>{pto_vta}</ar:PtoVta>'
+    '<ar:CbteTipo>{cbte_tipo}</ar:CbteTipo></ar:FeCabReq><ar:FeDetReq>{details}</ar:FeDetReq></ar:FeCAEReq>'
+)
+
+# Element order of FECAEDetRequest and its nested types, as required by the WSFEv1 schema.
+# A tuple value is (item element, item fields) for a list container.
+DETAIL_FIELDS = (
+    ("Concepto", None), ("DocTipo", None), ("DocNro", None), ("CbteDesde", None), ("CbteHasta", None),
+    ("CbteFch", None), ("ImpTotal", None), ("ImpTotConc", None), ("ImpNeto", None), ("ImpOpEx", None),
+    ("ImpTrib", None), ("ImpIVA", None), ("FchServDesde", None), ("FchServHasta", None),
+    ("FchVtoPago", None), ("MonId", None), ("MonCotiz", None), ("CanMisMonExt", None),
+    ("CondicionIVAReceptorId", None),
+    ("CbtesAsoc", ("CbteAsoc", ("Tipo", "PtoVta", "Nro", "Cuit", "CbteFch"))),
+    ("Tributos", ("Tributo", ("Id", "Desc", "BaseImp", "Alic", "Importe"))),
+    ("Iva", ("AlicIva", ("Id", "BaseImp", "Importe"))),
+    ("Opcionales", ("Opcional", ("Id", "Valor"))),
+    ("Compradores", ("Comprador", ("DocTipo", "DocNro", "Porcentaje"))),
+    ("PeriodoAsoc", ("FchDesde", "FchHasta")),
+    ("Actividades", ("Actividad", ("Id",))),
+)
+
+# Response elements that are always lists, even with a single item
+LIST_TAGS = frozenset((
+    "FECAEDetResponse", "Obs", "Err", "Evt", "CbteAsoc", "Tributo", "AlicIva", "Opcional",
+    "Comprador", "Actividad",
+))
+INT_TAGS = frozenset((
+    "PtoVta", "CbteTipo", "CbteNro", "CantReg", "Concepto", "DocTipo", "DocNro", "CbteDesde",
+    "CbteHasta", "Code", "Cuit", "Tipo", "Nro", "CondicionIVAReceptorId",
+))
+FLOAT_TAGS = frozenset((
+    "ImpTotal", "ImpTotConc", "ImpNeto", "ImpOpEx", "ImpTrib", "ImpIVA", "MonCotiz", "BaseImp",
+    "Importe", "Alic", "Porcentaje",
+))
+
+
+def _text(value):
+    if isinstance(value, float):
+        return repr(value)
+    return escape(str(value))
+
+
+def _render_fields(values, fields):
+    parts = []
+    for name in fields:
+        value = values.get(name)
+        if value is not None:
+            parts.append(f"<ar:{name}>{_text(value)}</ar:{name}>")
+    return "".join(parts)
+
+
+def render_detail(detail):
+    """
+    Renders a FECAEDetRequest dict as XML, in schema order. None values are omitted.
+
+    Args:
+        detail (dict): The invoice, as accepted by zeep
+
+    Returns:
+        str: The <ar:FECAEDetRequest> element
+    """
+    parts = ["<ar:FECAEDetRequest>"]
+    for name, nested in DETAIL_FIELDS:
+        value = detail.get(name)
+        if value is None:
+            continue
+        if nested is None:
+            parts.append(f"<ar:{name}>{_text(value)}</ar:{name}>")
+        elif isinstance(nested[1], tuple):
+            item_name, item_fields = nested
+            items = value.get(item_name) if isinstance(value, dict) else value
+            if isinstance(items, dict):
+                items = [items]
+            parts.append(f"<ar:{name}>")
+            for item in items or []:
+                parts.append(f"<ar:{item_name}>{_render_fields(item, item_fields)}</ar:{item_name}>")
+            parts.append(f"</ar:{name}>")
+        else:
+            parts.append(f"<ar:{name}>{_render_fields(value, nested)}</ar:{name}>")
+    parts.append("</ar:FECAEDetRequest>")
+    return "".join(parts)
+
+
+def render(operation, token, sign, cuit, body):
+    """
+    Renders a complete WSFEv1 request envelope.
+
+    Args:
+        operation (str): The WSFEv1 operation
+        token (str): Authentication token
+        sign (str): Signature
+        cuit (str): CUIT (taxpayer ID)
+        body (str): Already rendered operation parameters
+
+    Returns:
+        bytes: The SOAP envelope
+    """
+    auth = AUTH.format(token=escape(str(token)), sign=escape(str(sign)), cuit=escape(str(cuit)))
+    return ENVELOPE.format(operation=operation, auth=auth, body=body).encode("utf-8")
+
+
+def _convert(tag, text):
+    if text is None:
+        return None
+    if tag in INT_TAGS:
+        try:
+            return int(text)
+        except ValueError:
+            return text
+    if tag in FLOAT_TAGS:
+        try:
+            return float(text)
+        except ValueError:
+            return text
+    return text
+
+
+def parse_response(stream, operation):
+    """
+    Parses a WSFEv1 response incrementally into the dict of its <operation>Result.
+
+    Args:
+        stream: File-like object with the response body
+        operation (str): The WSFEv1 operation
+
+    Returns:
+        dict: The result, with list elements as lists and numeric fields converted
+
+    Raises:
+        zeep.exceptions.Fault: If the response is a SOAP fault
+    """
+    stack = [{}]
+    for event, element in ET.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            stack.append({})
+            continue
+        tag = element.tag.rpartition("}")[2]
+        children = stack.pop()
+        value = children if children else _convert(tag, element.text)
+        parent = stack[-1]
+        if tag in LIST_TAGS:
+            parent.setdefault(tag, []).append(value)
+        else:
+            parent[tag] = value
+        element.clear()
+
+    body = stack[0].get("Envelope", {}).get("Body") or {}
+    fault = body.get("Fault")
+    if fault is not None:
+        raise Fault(fault.get("faultstring") or "SOAP fault", code=fault.get("faultcode"))
+    result = (body.get(f"{operation}Response") or {}).get(f"{operation}Result")
+    if result is None:
+        raise ValueError(f"Unexpected {operation} response")
+    return result
+
+
+class WsfeEngine:
+    """
+    Template-based client for the hot WSFEv1 operations.
+
+    Args:
+        url (str): WSFEv1 endpoint (the WSDL URL without ?WSDL)
+        pool_size (int): Keep-alive connections kept per host
+        timeout (float): Timeout in seconds for each call
+    """
+
+    def __init__(self, url, pool_size=HTTP_POOL_SIZE, timeout=None):
+        self.url = url
+        self.timeout = timeout
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._async_client = None
+
+    def _headers(self, operation):
+        return {"Content-Type": "text/xml; charset=utf-8", "SOAPAction": SOAP_ACTION.format(operation)}
+
+    def call(self, operation, envelope):
+        """
+        Posts an envelope and parses the response as it is read from the socket.
+        """
+        response = self.session.post(self.url, data=envelope, headers=self._headers(operation),
+                                     timeout=self.timeout, stream=True)
+        try:
+            if response.status_code >= 400 and "xml" not in response.headers.get("Content-Type", ""):
+                response.raise_for_status()
+            response.raw.decode_content = True
+            return parse_response(response.raw, operation)
+        finally:
+            response.close()
+
+    async def call_async(self, operation, envelope):
+        """
+        Non-blocking version of call(), through a pooled httpx.AsyncClient.
+        """
+        if self._async_client is None:
+            import httpx
+            self._async_client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+            )
+        response = await self._async_client.post(self.url, content=envelope, headers=self._headers(operation))
+        if response.status_code >= 400 and "xml" not in response.headers.get("Content-Type", ""):
+            response.raise_for_status()
+        return parse_response(io.BytesIO(response.content), operation)
+
+    @staticmethod
+    def ultimo_autorizado_envelope(token, sign, cuit, pto_vta, cbte_tipo):
+        return render("FECompUltimoAutorizado", token, sign, cuit,
+                      ULTIMO_AUTORIZADO.format(pto_vta=_text(pto_vta), cbte_tipo=_text(cbte_tipo)))
+
+    @staticmethod
+    def cae_solicitar_envelope(token, sign, cuit, pto_vta, cbte_tipo, comprobantes):
+        return render("FECAESolicitar", token, sign, cuit, CAE_SOLICITAR.format(
+            cant_reg=len(comprobantes), pto_vta=_text(pto_vta), cbte_tipo=_text(cbte_tipo),
+            details="".join(render_detail(detail) for detail in comprobantes),
+        ))
+
+    @staticmethod
+    def comp_consultar_envelope(token, sign, cuit, pto_vta, cbte_tipo, cbte_nro):
+        return render("FECompConsultar", token, sign, cuit, COMP_CONSULTAR.format(
+            pto_vta=_text(pto_vta), cbte_tipo=_text(cbte_tipo), cbte_nro=_text(cbte_nro)))
+
+    def ultimo_autorizado(self, token, sign, cuit, pto_vta, cbte_tipo):
+        """FECompUltimoAutorizado: returns the FECompUltimoAutorizadoResult dict."""
+        return self.call("FECompUltimoAutorizado",
+                         self.ultimo_autorizado_envelope(token, sign, cuit, pto_vta, cbte_tipo))
+
+    def cae_solicitar(self, token, sign, cuit, pto_vta, cbte_tipo, comprobantes):
+        """FECAESolicitar: returns the FECAESolicitarResult dict."""
+        return self.call("FECAESolicitar",
+                         self.cae_solicitar_envelope(token, sign, cuit, pto_vta, cbte_tipo, comprobantes))
+
+    def comp_consultar(self, token, sign, cuit, pto_vta, cbte_tipo, cbte_nro):
+        """FECompConsultar: returns the FECompConsultarResult dict."""
+        return self.call("FECompConsultar",
+                         self.comp_consultar_envelope(token, sign, cuit, pto_vta, cbte_tipo, cbte_nro))
+
+    async def ultimo_autorizado_async(self, token, sign, cuit, pto_vta, cbte_tipo):
+        return await self.call_async("FECompUltimoAutorizado",
+                                     self.ultimo_autorizado_envelope(token, sign, cuit, pto_vta, cbte_tipo))
+
+    async def cae_solicitar_async(self, token, sign, cuit, pto_vta, cbte_tipo, comprobantes):
+        return await self.call_async("FECAESolicitar",
+                                     self.cae_solicitar_envelope(token, sign, cuit, pto_vta, cbte_tipo, comprobantes))
+
+    async def comp_consultar_async(self, token, sign, cuit, pto_vta, cbte_tipo, cbte_nro):
+        return await self.call_async("FECompConsultar",
+                                     self.comp_consultar_envelope(token, sign, cuit, pto_vta, cbte_tipo, cbte_nro))
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(wsdl_url):
+    """
+    Returns the shared engine for a WSFEv1 WSDL URL, or None when ARCA_SOAP_ENGINE=zeep.
+
+    Args:
+        wsdl_url (str): The WSDL URL the zeep client would use; the endpoint is derived from it.
+    """
+    if SOAP_ENGINE != "template":
+        return None
+    url = wsdl_url.split("?", 1)[0]
+    engine = _engines.get(url)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.setdefault(url, WsfeEngine(url))
+    return engine
@@ -0,0 +1,48 @@
+from arca_clients import WSFE_WSDL, get_async_client, get_client
+from metrics import SOAP_CALL_SECONDS, timed
+from soap_engine import get_engine
+from upstream_guard import guarded
+
+@guarded
+@timed(SOAP_CALL_SECONDS, "FECompConsultar")
+def consultar_comprobante(token, sign, cuit, pto_vta, cbte_tipo, cbte_nro, wsdl_url=WSFE_WSDL):
+    """
+    Sends a SOAP message to the AFIP web service to get an authorized invoice (FECompConsultar).
+
+    Args:
+        token (str): The token for authentication.
+        sign (str): The signature for authentication.
+        cuit (str): The CUIT number.
+        pto_vta (int): The point of sale.
+        cbte_tipo (int): The invoice type.
+        cbte_nro (int): The invoice number.
+        wsdl_url (str): The URL of the WSDL file.
+
+    Returns:
+        The FECompConsultarResult, as a dict when the template engine is enabled
+        (see soap_engine.py) or as returned by zeep otherwise. Numbers that were never
+        authorized come back with Errors instead of a ResultGet.
+    """
+    engine = get_engine(wsdl_url)
+    if engine is not None:
+        return engine.comp_consultar(token, sign, cuit, pto_vta, cbte_tipo, cbte_nro)
+
+    client = get_client(wsdl_url, basic_auth=('user', 'pass'))
+    return client.service.FECompConsultar(
+        Auth={"Token": token, "Sign": sign, "Cuit": cuit},
+        FeCompConsReq={"CbteTipo": cbte_tipo, "CbteNro": cbte_nro, "PtoVta": pto_vta},
+    )
+
+@guarded
+@timed(SOAP_CALL_SECONDS, "FECompConsultar")
+async def consultar_comprobante_async(token, sign, cuit, pto_vta, cbte_tipo, cbte_nro, wsdl_url=WSFE_WSDL):
+    """Non-blocking version of consultar_comprobante for the asyncio worker."""
+    engine = get_engine(wsdl_url)
+    if engine is not None:
+        return await engine.comp_consultar_async(token, sign, cuit, pto_vta, cbte_tipo, cbte_nro)
+
+    client = get_async_client(wsdl_url, basic_auth=('user', 'pass'))
+    return await client.service.FECompConsultar(
+        Auth={"Token": token, "Sign": sign, "Cuit": cuit},
+        FeCompConsReq={"CbteTipo": cbte_tipo, "CbteNro": cbte_nro, "PtoVta": pto_vta},
+    )
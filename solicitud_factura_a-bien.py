@@ -1,6 +1,8 @@
 import requests
 import xml.etree.ElementTree as ET
 
+from arca_clients import WSFE_WSDL
+
 def send_soap_request(token, cuit, pto_vta, cbte_fch, imp_total, cbte_desde, cbte_hasta, sign):
     """Sends a SOAP request to the AFIP WSFEV1 service (FECAESolicitar) using ElementTree.
 
@@ -91,7 +93,7 @@ def send_soap_request(token, cuit, pto_vta, cbte_fch, imp_total, cbte_desde, cbt
         "Content-Type": "text/xml;charset=UTF-8",
         "SOAPAction": "http://ar.gov.afip.dif.FEV1/FECAESolicitar",
     }
-    url = "https://wswhomo.afip.gov.ar/wsfev1/service.asmx"
+    url = WSFE_WSDL.split("?", 1)[0]
 
     try:
         response = requests.post(url, data=soap_message, headers=headers) # No need to encode here
@@ -1,10 +1,80 @@
-from zeep import Client, Settings
-from zeep.transports import Transport
-from requests import Session
-from requests.auth import HTTPBasicAuth
+from arca_clients import WSFE_WSDL, get_async_client, get_client
+from metrics import SOAP_CALL_SECONDS, timed
+from soap_engine import get_engine
+from upstream_guard import guarded
 import os
 
-def send_soap_request(token, sign, cuit, pto_vta, cbte_fch, imp_total, cbte_desde, cbte_hasta, wsdl_url="https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL"):
+@guarded
+@timed(SOAP_CALL_SECONDS, "FECAESolicitar")
+def solicitar_cae(token, sign, cuit, pto_vta, cbte_tipo, comprobantes, wsdl_url=WSFE_WSDL):
+    """Requests CAEs for one or more invoices of the same point of sale and type (FECAESolicitar).
+
+    Args:
+        token (str): Authentication token.
+        sign (str): Signature.
+        cuit (str): CUIT (taxpayer ID).
+        pto_vta (int): Point of Sale.
+        cbte_tipo (int): Invoice type.
+        comprobantes (list): FECAEDetRequest dictionaries, with consecutive CbteDesde/CbteHasta.
+        wsdl_url (str): WSDL URL
+
+    Returns:
+        The FECAESolicitarResult, as a dict when the template engine is enabled
+        (see soap_engine.py) or as returned by zeep otherwise.
+    """
+    engine = get_engine(wsdl_url)
+    if engine is not None:
+        return engine.cae_solicitar(token, sign, cuit, pto_vta, cbte_tipo, comprobantes)
+
+    client = get_client(wsdl_url, basic_auth=('user', 'pass')) #Replace with your credentials if needed.  May not be necessary.
+    return client.service.FECAESolicitar(
+        Auth={
+            "Token": token,
+            "Sign": sign,
+            "Cuit": cuit,
+        },
+        FeCAEReq={
+            "FeCabReq": {
+                "CantReg": len(comprobantes),
+                "PtoVta": pto_vta,
+                "CbteTipo": cbte_tipo,
+            },
+            "FeDetReq": {
+                "FECAEDetRequest": comprobantes
+            },
+        },
+    )
+
+
+@guarded
+@timed(SOAP_CALL_SECONDS, "FECAESolicitar")
+async def solicitar_cae_async(token, sign, cuit, pto_vta, cbte_tipo, comprobantes, wsdl_url=WSFE_WSDL):
+    """Non-blocking version of solicitar_cae for the asyncio worker."""
+    engine = get_engine(wsdl_url)
+    if engine is not None:
+        return await engine.cae_solicitar_async(token, sign, cuit, pto_vta, cbte_tipo, comprobantes)
+
+    client = get_async_client(wsdl_url, basic_auth=('user', 'pass'))
+    return await client.service.FECAESolicitar(
+        Auth={
+            "Token": token,
+            "Sign": sign,
+            "Cuit": cuit,
+        },
+        FeCAEReq={
+            "FeCabReq": {
+                "CantReg": len(comprobantes),
+                "PtoVta": pto_vta,
+                "CbteTipo": cbte_tipo,
+            },
+            "FeDetReq": {
+                "FECAEDetRequest": comprobantes
+            },
+        },
+    )
+
+
+def send_soap_request(token, sign, cuit, pto_vta, cbte_fch, imp_total, cbte_desde, cbte_hasta, wsdl_url=WSFE_WSDL):
     """Sends a SOAP request to the AFIP WSFEV1 service (FECAESolicitar) using zeep.
 
     Args:
@@ -21,64 +91,44 @@ def send_soap_request(token, sign, cuit, pto_vta, cbte_fch, imp_total, cbte_desd
     Returns:
         dict: A dictionary containing the parsed SOAP response or None if there was an error.
     """
-    session = Session()
-    session.auth = HTTPBasicAuth('user', 'pass') #Replace with your credentials if needed.  May not be necessary.
-    transport = Transport(session=session)
-    settings = Settings(strict=False, xml_huge_tree=True)
-    client = Client(wsdl_url, settings=settings, transport=transport)
-
     try:
-        response = client.service.FECAESolicitar(
-            Auth={
-                "Token": token,
-                "Sign": sign,
-                "Cuit": cuit,
-            },
-            FeCAEReq={
-                "FeCabReq": {
-                    "CantReg": 1,
-                    "PtoVta": pto_vta,
-                    "CbteTipo": 1,
-                },
-                "FeDetReq": {
-                    "FECAEDetRequest": {
-                        "Concepto": 1,
-                        "DocTipo": 80,
-                        "DocNro": "30678186445",  # Replace with actual document number
-                        "CbteDesde": cbte_desde,
-                        "CbteHasta": cbte_hasta,
-                        "CbteFch": cbte_fch,
-                        "ImpTotal": imp_total,
-                        "ImpTotConc": 0,
-                        "ImpNeto": 150,
-                        "ImpOpEx": 0,
-                        "ImpTrib": 7.8,
-                        "ImpIVA": 26.25,
-                        "FchServDesde": "",
-                        "FchServHasta": "",
-                        "FchVtoPago": "",
-                        "MonId": "PES",
-                        "MonCotiz": 1,
-                        "CondicionIVAReceptorId": 1,
-                        "Tributos": {
-                            "Tributo": {
-                                "Id": "99",
-                                "Desc": "Impuesto Municipal Matanza",
-                                "BaseImp": 150,
-                                "Alic": 5.2,
-                                "Importe": 7.8,
-                            }
-                        },
-                        "Iva": {
-                            "AlicIva": [
-                                {"Id": 5, "BaseImp": 100, "Importe": 21},
-                                {"Id": 4, "BaseImp": 50, "Importe": 5.25},
-                            ]
-                        },
+        response = solicitar_cae(token, sign, cuit, pto_vta, 1, [
+            {
+                "Concepto": 1,
+                "DocTipo": 80,
+                "DocNro": "30678186445",  # Replace with actual document number
+                "CbteDesde": cbte_desde,
+                "CbteHasta": cbte_hasta,
+                "CbteFch": cbte_fch,
+                "ImpTotal": imp_total,
+                "ImpTotConc": 0,
+                "ImpNeto": 150,
+                "ImpOpEx": 0,
+                "ImpTrib": 7.8,
+                "ImpIVA": 26.25,
+                "FchServDesde": "",
+                "FchServHasta": "",
+                "FchVtoPago": "",
+                "MonId": "PES",
+                "MonCotiz": 1,
+                "CondicionIVAReceptorId": 1,
+                "Tributos": {
+                    "Tributo": {
+                        "Id": "99",
+                        "Desc": "Impuesto Municipal Matanza",
+                        "BaseImp": 150,
+                        "Alic": 5.2,
+                        "Importe": 7.8,
                     }
                 },
-            },
-        )
+                "Iva": {
+                    "AlicIva": [
+                        {"Id": 5, "BaseImp": 100, "Importe": 21},
+                        {"Id": 4, "BaseImp": 50, "Importe": 5.25},
+                    ]
+                },
+            }
+        ], wsdl_url=wsdl_url)
         return response
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -1,11 +1,12 @@
-from zeep import Client, Settings
-from zeep.transports import Transport
-from requests import Session
-from requests.auth import HTTPBasicAuth
-import xml.etree.ElementTree as ET
+from arca_clients import WSFE_WSDL, get_async_client, get_client
+from metrics import SOAP_CALL_SECONDS, timed
+from soap_engine import get_engine
+from upstream_guard import guarded
 import os
 
-def solicitar_ultimo_comprobante(token, sign, cuit, pto_vta, cbte_tipo, wsdl_url="https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL"):
+@guarded
+@timed(SOAP_CALL_SECONDS, "FECompUltimoAutorizado")
+def solicitar_ultimo_comprobante(token, sign, cuit, pto_vta, cbte_tipo, wsdl_url=WSFE_WSDL):
     """
     Sends a SOAP message to the AFIP web service to get the last authorized invoice number.
 
@@ -18,38 +19,41 @@ def solicitar_ultimo_comprobante(token, sign, cuit, pto_vta, cbte_tipo, wsdl_url
         wsdl_url (str): The URL of the WSDL file.
 
     Returns:
-        str: The SOAP response.
+        The FECompUltimoAutorizadoResult, as a dict when the template engine is enabled
+        (see soap_engine.py) or as returned by zeep otherwise.
     """
-    session = Session()
-    session.auth = HTTPBasicAuth('user', 'pass')
-    transport = Transport(session=session)
-    settings = Settings(strict=False, xml_huge_tree=True)
-    client = Client(wsdl_url, settings=settings, transport=transport)
-
-    envelope = ET.Element("{http://schemas.xmlsoap.org/soap/envelope/}Envelope")
-    envelope.set("xmlns:soapenv", "http://schemas.xmlsoap.org/soap/envelope/")
-    envelope.set("xmlns:ar", "http://ar.gov.afip.dif.FEV1/")
-
-    header = ET.SubElement(envelope, "{http://schemas.xmlsoap.org/soap/envelope/}Header")
-    body = ET.SubElement(envelope, "{http://schemas.xmlsoap.org/soap/envelope/}Body")
-    fe_comp_ultimo_autorizado = ET.SubElement(body, "ar:FECompUltimoAutorizado")
-    auth = ET.SubElement(fe_comp_ultimo_autorizado, "ar:Auth")
-    token_element = ET.SubElement(auth, "ar:Token")
-    token_element.text = token
-    sign_element = ET.SubElement(auth, "ar:Sign")
-    
-    sign_element.text = sign
-    cuit_element = ET.SubElement(auth, "ar:Cuit")
-    cuit_element.text = cuit
-    pto_vta_element = ET.SubElement(fe_comp_ultimo_autorizado, "ar:PtoVta")
-    pto_vta_element.text = str(pto_vta)
-    cbte_tipo_element = ET.SubElement(fe_comp_ultimo_autorizado, "ar:CbteTipo")
-    cbte_tipo_element.text = str(cbte_tipo)
-
-    xml_string = ET.tostring(envelope, encoding="unicode")
+    engine = get_engine(wsdl_url)
+    if engine is not None:
+        return engine.ultimo_autorizado(token, sign, cuit, pto_vta, cbte_tipo)
+
+    client = get_client(wsdl_url, basic_auth=('user', 'pass'))
     response = client.service.FECompUltimoAutorizado(Auth={"Token": token, "Sign": sign, "Cuit": cuit}, PtoVta=pto_vta, CbteTipo=cbte_tipo)
     return response
 
+@guarded
+@timed(SOAP_CALL_SECONDS, "FECompUltimoAutorizado")
+async def solicitar_ultimo_comprobante_async(token, sign, cuit, pto_vta, cbte_tipo, wsdl_url=WSFE_WSDL):
+    """
+    Non-blocking version of solicitar_ultimo_comprobante for the asyncio worker.
+
+    Args:
+        token (str): The token for authentication.
+        sign (str): The signature for authentication.
+        cuit (str): The CUIT number.
+        pto_vta (int): The point of sale.
+        cbte_tipo (int): The invoice type.
+        wsdl_url (str): The URL of the WSDL file.
+
+    Returns:
+        str: The SOAP response.
+    """
+    engine = get_engine(wsdl_url)
+    if engine is not None:
+        return await engine.ultimo_autorizado_async(token, sign, cuit, pto_vta, cbte_tipo)
+
+    client = get_async_client(wsdl_url, basic_auth=('user', 'pass'))
+    return await client.service.FECompUltimoAutorizado(Auth={"Token": token, "Sign": sign, "Cuit": cuit}, PtoVta=pto_vta, CbteTipo=cbte_tipo)
+
 def main():
     
     cuit = "23146234399"  # Replace with test CUIT
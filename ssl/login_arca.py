@@ -36,10 +36,20 @@ from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.x509 import load_pem_x509_certificate
 from cryptography.hazmat.primitives.serialization import Encoding
 from cryptography.hazmat.primitives.serialization import pkcs7
-from datetime import datetime, timedelta
-from zeep import Client
+from datetime import datetime, timedelta, timezone
 import base64
 import os
+import sys
+import threading
+import time
+
+# Add the project root to the Python path for the shared zeep client registry
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import credentials
+import ta_store
+from arca_clients import WSAA_WSDL, get_client
+from metrics import RETRIES, STAGE_SECONDS, timed
 
 def create_login_ticket_request(service_id):    
     """
@@ -99,6 +109,20 @@ def sign_cms(certificate_path, private_key_path, data):
             password=None
         )
     
+    return sign_cms_with(certificate, private_key, data)
+
+def sign_cms_with(certificate, private_key, data):
+    """
+    Signs data using a CMS/PKCS#7 signature with an already loaded certificate and key.
+
+    Args:
+        certificate (x509.Certificate): The certificate.
+        private_key: The private key of the certificate.
+        data (bytes): The data to be signed.
+
+    Returns:
+        bytes: The CMS/PKCS#7 signature.
+    """
     # Create CMS/PKCS#7 signature
     options = [pkcs7.PKCS7Options.Binary]
     cms = pkcs7.PKCS7SignatureBuilder().set_data(
@@ -114,96 +138,449 @@ def sign_cms(certificate_path, private_key_path, data):
     
     return cms
 
-def login_ARCA(certificate="certificado_generado.pem", 
-         private_key="MiClavePrivadaTest.key",
-         service_id="wsfe", # OJO que hay que autorizarlo para este DN (Distinguished Name) en ARCA
-         wsaa_wsdl="https://wsaahomo.afip.gov.ar/ws/services/LoginCms?WSDL"):
-    
+# "Already has a valid TA" fault returned by WSAA when a TA is requested too early
+TA_ALREADY_VALID_ERROR = "El CEE ya posee un TA valido para el acceso al WSN solicitado"
+
+# Renew the TA this long before it expires (background renewal)
+TA_RENEW_MARGIN = timedelta(minutes=int(os.environ.get("ARCA_TA_RENEW_MARGIN_MINUTES", 10)))
+
+# Lifetime assumed for a TA recovered from the legacy token.txt/sign.txt files,
+# which do not record their expiration
+TA_LEGACY_LIFETIME = timedelta(minutes=10)
+
+# Delay before retrying a failed background renewal while the current TA is still valid
+TA_RETRY_DELAY = 60
+
+
+def parse_login_ticket_response(response):
     """
-    Main function to request a login ticket from AFIP WSAA.
+    Parses a loginTicketResponse returned by WSAA.
 
     Args:
-        certificate (str): Path to the certificate file.
-        private_key (str): Path to the private key file.
-        service_id (str): The ID of the service to request access to.
-        wsaa_wsdl (str): The URL of the WSAA WSDL file.
+        response (str): The loginTicketResponse XML.
+
+    Returns:
+        dict: The ticket with keys 'token', 'sign' and 'expiration_time' (aware datetime).
+    """
+    from xml.etree import ElementTree
+    root = ElementTree.fromstring(response)
+    credentials = root.find('credentials')
+    expiration = root.find('header').find('expirationTime').text
+    return {
+        "token": credentials.find('token').text,
+        "sign": credentials.find('sign').text,
+        "expiration_time": _parse_expiration(expiration),
+    }
+
+
+def _parse_expiration(value):
+    """Parses an ISO 8601 expirationTime, assuming local time when it has no offset."""
+    expiration = datetime.fromisoformat(value)
+    if expiration.tzinfo is None:
+        expiration = expiration.astimezone()
+    return expiration
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def load_legacy_ticket(ssl_files_dir):
+    """
+    Loads the token and sign of the legacy token.txt/sign.txt files, which carry no
+    expiration, assuming they are valid for TA_LEGACY_LIFETIME from now.
+
+    Args:
+        ssl_files_dir (str): Directory where the files are stored.
+
+    Returns:
+        dict: The ticket, or None if nothing usable is stored.
+    """
+    try:
+        with open(os.path.join(ssl_files_dir, 'token.txt'), 'r') as f:
+            token = f.read().strip()
+        with open(os.path.join(ssl_files_dir, 'sign.txt'), 'r') as f:
+            sign = f.read().strip()
+    except OSError:
+        return None
+    if not token or not sign:
+        return None
+    return {"token": token, "sign": sign, "expiration_time": _now() + TA_LEGACY_LIFETIME}
+
+
+def write_legacy_ticket(ssl_files_dir, ticket):
+    """
+    Writes the token and sign of a ticket to the legacy token.txt/sign.txt files read by
+    the standalone scripts.
+
+    Args:
+        ssl_files_dir (str): Directory where the files are stored.
+        ticket (dict): The ticket.
+    """
+    ta_store.write_atomic(os.path.join(ssl_files_dir, 'token.txt'), ticket["token"])
+    ta_store.write_atomic(os.path.join(ssl_files_dir, 'sign.txt'), ticket["sign"])
+
+
+def request_ticket(certificate_path, private_key_path, service_id, wsaa_wsdl, credential=None):
     """
-    # Get the directory of the current script
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+    Requests a new TA from WSAA.
 
-    # Construct absolute paths
-    certificate_path = os.path.join(script_dir, 'ssl_files', certificate)
-    private_key_path = os.path.join(script_dir, 'ssl_files', private_key)
+    Args:
+        certificate_path (str): Path to the certificate file.
+        private_key_path (str): Path to the private key file.
+        service_id (str): The ID of the service to request access to.
+        wsaa_wsdl (str): The URL of the WSAA WSDL file.
+        credential (credentials.Credential): Signs with its parsed certificate and key
+            instead of loading the files.
 
+    Returns:
+        dict: The ticket as returned by parse_login_ticket_response.
+    """
     print(f"Certificate path: {certificate_path}")
     print(f"Private key path: {private_key_path}")
 
-    try:
-        # Generate sequence number
-        seq_nr = datetime.now().strftime('%Y%m%d%H%S')
-        
-        # Generate login ticket request
-        xml_content = create_login_ticket_request(service_id)
-        
-        # Sign the content
+    # Generate login ticket request
+    xml_content = create_login_ticket_request(service_id)
+
+    # Sign the content
+    if credential is not None:
+        cms_signature = sign_cms_with(credential.certificate, credential.private_key, xml_content)
+    else:
         cms_signature = sign_cms(certificate_path, private_key_path, xml_content)
-        
-        # Encode in base64
-        cms_base64 = base64.b64encode(cms_signature).decode('utf-8')
-        
-        # Call WSAA web service
-        client = Client(wsaa_wsdl)
-        response = client.service.loginCms(cms_base64)
-        
-        print("Response content:")
-        print(response)
-        
-        # Parse response and save token and sign in a file for debugging purposes
-        from xml.etree import ElementTree
-        root = ElementTree.fromstring(response)
-        credentials = root.find('credentials')
-        token = credentials.find('token').text
-        sign = credentials.find('sign').text
-        
-        token_file_path = os.path.join(script_dir, 'ssl_files', 'token.txt')
-        sign_file_path = os.path.join(script_dir, 'ssl_files', 'sign.txt')
-        
-        with open(token_file_path, 'w') as f:
-            f.write(token)
-            
-        with open(sign_file_path, 'w') as f:
-            f.write(sign)
-               
-        print(f"Token saved to ssl_files/token.txt")
-        print(f"Sign saved to ssl_files/sign.txt")
-        
-        return token, sign
-
-    except Exception as e:
-        error_msg = str(e)
-        print(f"Error: {error_msg}")
-        
-        # If we get the "already valid TA" error, read and return existing token and sign
-        if error_msg == "El CEE ya posee un TA valido para el acceso al WSN solicitado":
-            token_file_path = os.path.join(script_dir, 'ssl_files', 'token.txt')
-            sign_file_path = os.path.join(script_dir, 'ssl_files', 'sign.txt')
-            
+
+    # Encode in base64
+    cms_base64 = base64.b64encode(cms_signature).decode('utf-8')
+
+    # Call WSAA web service (the client and its parsed WSDL are shared process-wide)
+    client = get_client(wsaa_wsdl, strict=True, xml_huge_tree=False)
+    response = client.service.loginCms(cms_base64)
+
+    print("Response content:")
+    print(response)
+
+    return parse_login_ticket_response(response)
+
+
+class _Renewal:
+    """A TA renewal in progress, shared by every caller waiting on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ticket = None
+        self.error = None
+
+
+# How the threads that called wait_with() pass the time while a TA is being renewed
+_waiting = threading.local()
+
+
+def wait_with(sleep):
+    """
+    Makes the calling thread wait for TA renewals with sleep(seconds) instead of blocking.
+
+    The blocking worker passes BlockingConnection.sleep from its connection thread, so it
+    keeps answering heartbeats while another process or node holds the lease of the TA.
+    """
+    _waiting.sleep = sleep
+
+
+def _sleep(seconds):
+    getattr(_waiting, "sleep", time.sleep)(seconds)
+
+
+def _wait(event):
+    sleep = getattr(_waiting, "sleep", None)
+    if sleep is None:
+        event.wait()
+        return
+    while not event.wait(ta_store.LEASE_POLL):
+        sleep(0)
+
+
+class TicketCache:
+    """
+    Keeps the TA for one certificate/service in memory and renews it before it expires.
+
+    The ticket is shared through a TA store (see ta_store.py) so it survives restarts and
+    every process and node using the same store logs in only once. Concurrent callers
+    that find no valid ticket share a single renewal, and a background timer renews the
+    ticket TA_RENEW_MARGIN before expiration so callers never wait on WSAA while a ticket
+    is valid. Across processes and nodes, the renewal is done by the holder of the lease
+    of the TA while the others wait for the TA it stores.
+
+    Only the TA of the default certificate and service of ssl_files, the one the standalone
+    scripts log in with, is also written to and recovered from token.txt/sign.txt: those
+    files are shared, and any other certificate would get a token and sign that are not its own.
+    """
+
+    def __init__(self, certificate_path, private_key_path, service_id, wsaa_wsdl, ssl_files_dir, store=None,
+                 credential=None):
+        self.certificate_path = certificate_path
+        self.private_key_path = private_key_path
+        self.service_id = service_id
+        self.wsaa_wsdl = wsaa_wsdl
+        self.ssl_files_dir = ssl_files_dir
+        self.store = store or ta_store.get_store(ssl_files_dir)
+        # Signs with the parsed certificate and key of the credential instead of reading the files
+        self.credential = credential
+        if credential is not None:
+            self.key = credential.ticket_key
+        else:
+            self.key = ta_store.ticket_key(certificate_path, service_id)
+        self.legacy = self.key == ta_store.ticket_key(
+            os.path.join(ssl_files_dir, credentials.DEFAULT_CERTIFICATE), credentials.DEFAULT_SERVICE
+        )
+        self._lock = threading.Lock()
+        self._ticket = None
+        self._renewal = None
+        self._timer = None
+
+    def get(self):
+        """
+        Returns a valid (token, sign) pair, renewing the TA only if it is missing or expired.
+        """
+        with self._lock:
+            if self._ticket is None:
+                self._ticket = self.store.load(self.key)
+                if self._is_valid(self._ticket):
+                    self._schedule_renewal(self._ticket)
+            if self._is_valid(self._ticket):
+                return self._ticket["token"], self._ticket["sign"]
+            renewal, leader = self._join_renewal()
+
+        if leader:
+            self._renew(renewal)
+        _wait(renewal.done)
+        if renewal.error is not None:
+            raise renewal.error
+        return renewal.ticket["token"], renewal.ticket["sign"]
+
+    def invalidate(self):
+        """Drops the in-memory ticket, e.g. after WSFE rejected it."""
+        with self._lock:
+            self._ticket = None
+
+    def close(self):
+        """Stops renewing the ticket in the background."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _is_valid(self, ticket):
+        return ticket is not None and _now() < ticket["expiration_time"]
+
+    def _is_newer(self, ticket, current):
+        return self._is_valid(ticket) and (current is None or ticket["expiration_time"] > current["expiration_time"])
+
+    def _join_renewal(self):
+        """Returns the renewal in progress, starting one if needed. Must hold self._lock."""
+        if self._renewal is not None:
+            return self._renewal, False
+        self._renewal = _Renewal()
+        return self._renewal, True
+
+    def _renew(self, renewal):
+        try:
+            renewal.ticket = self._renew_shared()
+        except Exception as e:
+            renewal.error = e
+        with self._lock:
+            if renewal.ticket is not None:
+                self._ticket = renewal.ticket
+                self._schedule_renewal(renewal.ticket)
+            self._renewal = None
+        renewal.done.set()
+
+    def _renew_shared(self):
+        """
+        Returns a TA newer than the one in memory, adopting the one in the store if another
+        process already renewed it, or renewing it while holding the lease of the TA.
+        """
+        current = self._ticket
+        waited = False
+        while True:
+            stored = self.store.load(self.key)
+            if self._is_newer(stored, current):
+                return stored
+            fence = self.store.acquire_lease(self.key, ta_store.HOLDER, ta_store.LEASE_TTL)
+            if fence is None:
+                # Another process is renewing: wait for its TA, or for its lease to expire
+                waited = True
+                _sleep(ta_store.LEASE_POLL)
+                continue
             try:
-                with open(token_file_path, 'r') as f:
-                    token = f.read().strip()
-                with open(sign_file_path, 'r') as f:
-                    sign = f.read().strip()
-                print("Using existing valid token and sign")
-                return token, sign
-            except Exception as read_error:
-                print(f"Error reading existing token/sign: {read_error}")
-                raise e
+                # Stored between our look and the lease
+                stored = self.store.load(self.key)
+                if self._is_newer(stored, current):
+                    return stored
+                if waited and self._is_valid(current):
+                    # The renewal we waited on failed: keep the valid TA and retry later,
+                    # instead of every process calling WSAA in turn
+                    return current
+                ticket = self._fetch()
+                if not self.store.save(self.key, ticket, fence):
+                    print("TA lease expired during the renewal, not storing the new TA")
+                elif self.legacy:
+                    write_legacy_ticket(self.ssl_files_dir, ticket)
+                return ticket
+            finally:
+                try:
+                    self.store.release_lease(self.key, ta_store.HOLDER, fence)
+                except Exception as e:
+                    # It expires by itself
+                    print(f"Could not release the TA lease: {e}")
+
+    def _fetch(self):
+        try:
+            return request_ticket(self.certificate_path, self.private_key_path, self.service_id, self.wsaa_wsdl,
+                                  self.credential)
+        except Exception as e:
+            error_msg = str(e)
+            print(f"Error: {error_msg}")
+            # WSAA refuses to issue a new TA while one is still valid: reuse the stored one
+            if error_msg == TA_ALREADY_VALID_ERROR:
+                ticket = self.store.load(self.key)
+                if not self._is_valid(ticket) and self.legacy:
+                    ticket = load_legacy_ticket(self.ssl_files_dir)
+                if self._is_valid(ticket):
+                    print("Using existing valid token and sign")
+                    return ticket
+                print("Error reading existing token/sign: no valid stored ticket")
+            else:
+                # For other errors, write to error log
+                seq_nr = datetime.now().strftime('%Y%m%d%H%S')
+                loginTicketResponse_ERROR = os.path.join(os.path.dirname(self.ssl_files_dir), "responses", f"{seq_nr}-loginTicketResponse-ERROR.xml")
+                try:
+                    with open(loginTicketResponse_ERROR, 'w') as f:
+                        f.write(error_msg)
+                except OSError:
+                    pass
+            raise
+
+    def _schedule_renewal(self, ticket):
+        """
+        Arms the background renewal timer. Must hold self._lock.
+
+        Renewals are never attempted more often than every TA_RETRY_DELAY seconds, so a
+        ticket close to expiration (or a WSAA that keeps answering "ya posee un TA valido")
+        does not make us hammer WSAA.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = max((ticket["expiration_time"] - TA_RENEW_MARGIN - _now()).total_seconds(), TA_RETRY_DELAY)
+        self._timer = threading.Timer(delay, self._renew_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _renew_in_background(self):
+        with self._lock:
+            renewal, leader = self._join_renewal()
+        if not leader:
+            return
+        self._renew(renewal)
+        if renewal.error is not None:
+            print(f"Background TA renewal failed: {renewal.error}")
+            RETRIES.labels("ta_renewal").inc()
+            with self._lock:
+                if self._is_valid(self._ticket):
+                    self._schedule_renewal(self._ticket)
+
+
+_ticket_caches = {}
+_tenant_caches = {}  # (ticket key, wsaa_wsdl) -> TicketCache of a registered credential
+_ticket_caches_lock = threading.Lock()
+
+
+def get_ticket_cache(certificate="certificado_generado.pem",
+         private_key="MiClavePrivadaTest.key",
+         service_id="wsfe",
+         wsaa_wsdl=WSAA_WSDL):
+    """
+    Returns the process-wide TicketCache for the given certificate, key, service and WSAA endpoint.
+    """
+    key = (certificate, private_key, service_id, wsaa_wsdl)
+    with _ticket_caches_lock:
+        cache = _ticket_caches.get(key)
+        if cache is None:
+            # Get the directory of the current script
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            ssl_files_dir = os.path.join(script_dir, 'ssl_files')
+            cache = TicketCache(
+                os.path.join(ssl_files_dir, certificate),
+                os.path.join(ssl_files_dir, private_key),
+                service_id,
+                wsaa_wsdl,
+                ssl_files_dir,
+            )
+            _ticket_caches[key] = cache
+        return cache
+
+
+def get_tenant_ticket_cache(cuit, wsaa_wsdl=WSAA_WSDL):
+    """
+    Returns the process-wide TicketCache of the credential registered for a CUIT (see credentials.py).
+
+    CUITs sharing a certificate and service share the cache. Caches of certificates that
+    were replaced on disk are closed.
+
+    Raises:
+        credentials.UnknownCuit: If no credential is registered for the CUIT
+    """
+    credential = credentials.registry.get(cuit)
+    key = (credential.ticket_key, wsaa_wsdl)
+    cache = _tenant_caches.get(key)
+    if cache is not None and cache.credential is credential:
+        return cache
+    with _ticket_caches_lock:
+        cache = _tenant_caches.get(key)
+        if cache is None:
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            cache = TicketCache(
+                credential.certificate_path,
+                credential.private_key_path,
+                credential.service_id,
+                wsaa_wsdl,
+                os.path.join(script_dir, 'ssl_files'),
+                credential=credential,
+            )
+            _tenant_caches[key] = cache
+            in_use = {registered.ticket_key for registered in credentials.registry.credentials()}
+            for stale_key in [stale_key for stale_key in _tenant_caches if stale_key[0] not in in_use]:
+                _tenant_caches.pop(stale_key).close()
         else:
-            # For other errors, write to error log and raise
-            loginTicketResponse_ERROR = os.path.join(script_dir, "responses", f"{seq_nr}-loginTicketResponse-ERROR.xml")
-            with open(loginTicketResponse_ERROR, 'w') as f:
-                f.write(error_msg)
-            raise e
+            # Same certificate, reloaded (e.g. a new key file): the TA is still valid
+            cache.credential = credential
+        return cache
+
+
+@timed(STAGE_SECONDS, "login_arca")
+def login_ARCA(certificate="certificado_generado.pem", 
+         private_key="MiClavePrivadaTest.key",
+         service_id="wsfe", # OJO que hay que autorizarlo para este DN (Distinguished Name) en ARCA
+         wsaa_wsdl=WSAA_WSDL,
+         cuit=None):
+    
+    """
+    Returns the token and sign of a valid TA for the requested service.
+
+    The TA is cached in memory and in the TA store (by default ssl_files/ta_<service_id>-<certificate>.json)
+    and is only requested from WSAA when it is missing or about to expire.
+
+    Args:
+        certificate (str): Path to the certificate file.
+        private_key (str): Path to the private key file.
+        service_id (str): The ID of the service to request access to.
+        wsaa_wsdl (str): The URL of the WSAA WSDL file.
+        cuit (str): Log in with the credential registered for this CUIT (see credentials.py)
+            instead of certificate, private_key and service_id.
+
+    Returns:
+        tuple: (token, sign)
+    """
+    if cuit is not None:
+        return get_tenant_ticket_cache(cuit, wsaa_wsdl).get()
+    return get_ticket_cache(certificate, private_key, service_id, wsaa_wsdl).get()
 
 if __name__ == "__main__":
     login_ARCA()
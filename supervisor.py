@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Prefork supervisor for the ARCA gateway workers.
+
+Forks ARCA_WORKERS worker processes, each running merry_go_round (or the asyncio
+worker when ARCA_WORKER_MODE=async) with its own RabbitMQ connection and prefetch.
+The workers share the TA through the TA store (see ta_store.py): renewals are done by
+the worker holding the lease of the TA, so only one of them logs in to WSAA.
+
+Crashed workers are restarted. On SIGTERM (or CTRL+C) the supervisor forwards SIGTERM
+to every worker, which stops consuming, finishes and acknowledges its in-flight
+messages and exits; the supervisor exits once all of them are gone.
+
+Each worker serves its Prometheus metrics on ARCA_METRICS_PORT plus its slot (see metrics.py).
+
+SIGTTIN adds a worker and SIGTTOU removes the one with the highest slot. With ARCA_SHARDS the
+shards are owned by slot modulo the pool size (see shards.py), so after a resize the other
+workers are restarted one at a time to take over their new shards.
+
+Environment Variables:
+    - ARCA_WORKERS: Number of worker processes (default: number of CPUs)
+    - ARCA_WORKER_MODE: "blocking" or "async" (default: blocking)
+    - ARCA_RESTART_DELAY: Seconds to wait before restarting a crashed worker (default: 1)
+    - ARCA_SHARDS: See shards.py
+"""
+
+import os
+import signal
+import sys
+import time
+
+import shards
+
+WORKERS = int(os.environ.get("ARCA_WORKERS", os.cpu_count() or 1))
+RESTART_DELAY = float(os.environ.get("ARCA_RESTART_DELAY", 1))
+
+
+def run_worker(slot, size):
+    """
+    Body of a worker process. Never returns.
+
+    Args:
+        slot (int): Index of the worker in the pool
+        size (int): Number of workers in the pool
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # CTRL+C is handled by the supervisor
+    # Resizing the pool is up to the supervisor, even if the whole process group is signalled.
+    # Ignored rather than SIG_DFL, whose action would stop the worker with its messages unacked.
+    signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+    signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    # Each worker serves its metrics on ARCA_METRICS_PORT + slot
+    os.environ["ARCA_WORKER_SLOT"] = str(slot)
+    # ... and consumes the shards of its slot
+    os.environ["ARCA_WORKERS"] = str(size)
+    code = 0
+    try:
+        # Imported after the fork so no connection, session or timer is shared with the parent
+        import merry_go_round
+        if merry_go_round.WORKER_MODE == "async":
+            from async_worker import run
+            run()
+        else:
+            merry_go_round.main()
+    except Exception as e:
+        print(f"Worker {slot} failed: {e!r}")
+        code = 1
+    finally:
+        # os._exit skips atexit, where the profiler writes its per-message profiles
+        profiler = sys.modules.get("profiler")
+        if profiler is not None:
+            try:
+                profiler.flush()
+            except Exception as e:
+                print(f"Worker {slot} could not write its profiles: {e!r}")
+        os._exit(code)
+
+
+def spawn(slot, size):
+    """
+    Forks a worker process.
+
+    Args:
+        slot (int): Index of the worker in the pool
+        size (int): Number of workers in the pool
+
+    Returns:
+        int: The PID of the worker
+    """
+    pid = os.fork()
+    if pid == 0:
+        run_worker(slot, size)
+    print(f" [*] Started worker {slot} (pid {pid})")
+    return pid
+
+
+def main():
+    """
+    Starts the worker pool and supervises it until SIGTERM or CTRL+C.
+    """
+    workers = {}  # pid -> (slot, pool size it was started with)
+    size = WORKERS
+    retiring = set()  # pids stopped because the pool shrank
+    recycling = None  # pid being restarted with the current pool size
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            print(f" [*] Stopping {len(workers)} workers")
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def recycle_next():
+        # One worker at a time, so the others keep serving their shards meanwhile
+        nonlocal recycling
+        if shards.SHARDS <= 0 or stopping or recycling is not None:
+            return
+        stale = [pid for pid, (_, started) in workers.items() if started != size and pid not in retiring]
+        if stale:
+            recycling = stale[0]
+            os.kill(recycling, signal.SIGTERM)
+
+    def resize(signum, frame):
+        nonlocal size
+        if stopping:
+            return
+        if signum == signal.SIGTTIN:
+            size += 1
+            workers[spawn(size - 1, size)] = (size - 1, size)
+        elif size > 1:
+            size -= 1
+            for pid, (slot, _) in workers.items():
+                if slot == size:
+                    retiring.add(pid)
+                    os.kill(pid, signal.SIGTERM)
+        print(f" [*] Pool resized to {size} workers")
+        recycle_next()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTTIN, resize)
+    signal.signal(signal.SIGTTOU, resize)
+
+    for slot in range(size):
+        workers[spawn(slot, size)] = (slot, size)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        entry = workers.pop(pid, None)
+        if entry is None:
+            continue
+        slot = entry[0]
+        code = os.waitstatus_to_exitcode(status)
+        if stopping or pid in retiring:
+            retiring.discard(pid)
+            print(f" [*] Worker {slot} (pid {pid}) exited with {code}")
+            continue
+        if pid == recycling:
+            recycling = None
+            workers[spawn(slot, size)] = (slot, size)
+            recycle_next()
+            continue
+        print(f" [!] Worker {slot} (pid {pid}) exited with {code}, restarting in {RESTART_DELAY}s")
+        time.sleep(RESTART_DELAY)
+        if not stopping:
+            workers[spawn(slot, size)] = (slot, size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,479 @@
+"""
+Shared storage of the WSAA tickets (TA), so a cluster of gateway nodes logs in only once.
+
+WSAA issues one valid TA per certificate and service at a time and answers any other
+loginCms with "El CEE ya posee un TA valido". Every node therefore reads the TA from a
+shared store, and renewals are done by a single node elected with a lease:
+
+    1. A node that needs a newer TA first looks in the store; if another node already
+       stored one, it adopts it.
+    2. Otherwise it takes the lease of the TA. The lease comes with a fencing token that
+       grows with every lease granted, and expires after ARCA_TA_LEASE_TTL seconds so a
+       node that dies while renewing does not block the others.
+    3. The leader calls WSAA and stores the new TA. The store rejects the write if a newer
+       lease was granted meanwhile (the leader stalled past its lease), so a late TA never
+       overwrites the one of the next leader.
+    4. The other nodes wait for the TA to show up in the store instead of calling WSAA.
+
+Backends (ARCA_TA_STORE):
+    - file: JSON files next to the certificates, with the lease in a file guarded by flock.
+      Shared by the processes of a host, or by nodes mounting the same NFSv4 directory.
+    - sqlite: A SQLite database, same reach as the file backend.
+    - redis: Any server speaking the Redis protocol (Redis, Valkey, KeyDB, fake_redis.py).
+      The lease is a SET NX PX key, the fence an INCR counter and the fenced write a
+      WATCH/MULTI/EXEC transaction, so no scripting support is needed.
+
+Environment Variables:
+    - ARCA_TA_STORE: "file", "sqlite" or "redis" (default: file)
+    - ARCA_TA_STORE_URL: Directory (file), database path (sqlite) or redis://[:password@]host:port/db
+      (default: ssl/ssl_files, ssl/ssl_files/ta.sqlite3, redis://localhost:6379/0)
+    - ARCA_TA_LEASE_TTL: Seconds a node may take to renew the TA before another one can (default: 60)
+    - ARCA_TA_LEASE_POLL_MS: How often waiting nodes look for the renewed TA (default: 500)
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import unquote, urlparse
+
+TA_STORE = os.environ.get("ARCA_TA_STORE", "file")
+TA_STORE_URL = os.environ.get("ARCA_TA_STORE_URL")
+LEASE_TTL = float(os.environ.get("ARCA_TA_LEASE_TTL", 60))
+LEASE_POLL = float(os.environ.get("ARCA_TA_LEASE_POLL_MS", 500)) / 1000
+
+# Identifies this process as a lease holder
+HOLDER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def ticket_key(certificate_path, service_id):
+    """
+    Returns the key a TA is stored under: WSAA issues one per certificate and service.
+
+    Args:
+        certificate_path (str): Path to the certificate file
+        service_id (str): The WSN the TA is for
+    """
+    try:
+        with open(certificate_path, 'rb') as f:
+            return certificate_ticket_key(f.read(), service_id)
+    except OSError:
+        # Logging in will fail with a clearer error
+        return service_id
+
+
+def certificate_ticket_key(certificate_pem, service_id):
+    """Same as ticket_key(), for a certificate already read (bytes of the PEM file)."""
+    return f"{service_id}-{hashlib.sha256(certificate_pem).hexdigest()[:16]}"
+
+
+def encode_ticket(ticket):
+    return json.dumps({
+        "token": ticket["token"],
+        "sign": ticket["sign"],
+        "expiration_time": ticket["expiration_time"].isoformat(),
+    })
+
+
+def decode_ticket(data):
+    """Returns the ticket stored as `data`, or None if it is not a valid ticket."""
+    try:
+        data = json.loads(data)
+        expiration = datetime.fromisoformat(data["expiration_time"])
+        if expiration.tzinfo is None:
+            expiration = expiration.astimezone()
+        return {"token": data["token"], "sign": data["sign"], "expiration_time": expiration}
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def write_atomic(path, content):
+    """Writes a file atomically by writing a temporary file and renaming it over the target."""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _grant(lease, holder, ttl, now):
+    """
+    Decides on a lease request given the current lease (holder, expires_at, fence).
+
+    Returns:
+        tuple: The new lease, or None if it is held, even by holder itself: as with SET NX
+            in RedisTAStore, a lease is only granted again once released or expired
+    """
+    current_holder, expires_at, fence = lease or (None, 0, 0)
+    if current_holder is not None and expires_at > now:
+        return None
+    return holder, now + ttl, fence + 1
+
+
+class TAStore:
+    """
+    Where the TAs are kept and who may renew them. Keys come from ticket_key().
+    """
+
+    def load(self, key):
+        """
+        Returns:
+            dict: The stored ticket (token, sign, expiration_time), or None
+        """
+        raise NotImplementedError
+
+    def acquire_lease(self, key, holder, ttl):
+        """
+        Takes the right to renew the TA of a key for ttl seconds.
+
+        Returns:
+            int: The fencing token to pass to save() and release_lease(), or None if the
+                lease is held and unexpired, by another holder or by this one
+        """
+        raise NotImplementedError
+
+    def save(self, key, ticket, fence):
+        """
+        Stores a renewed ticket.
+
+        Returns:
+            bool: False if the write was fenced off because a newer lease was granted
+        """
+        raise NotImplementedError
+
+    def release_lease(self, key, holder, fence):
+        """Gives the lease back early, if it is still held by holder with that fence."""
+        raise NotImplementedError
+
+
+class FileTAStore(TAStore):
+    """
+    ta_<key>.json with the ticket and ta_<key>.lease with the lease, both updated under an
+    flock on ta_<key>.lock.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, f"ta_{key}.{extension}")
+
+    @contextmanager
+    def _locked(self, key):
+        with open(self._path(key, "lock"), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_lease(self, key):
+        try:
+            with open(self._path(key, "lease"), 'r') as f:
+                data = json.load(f)
+            return data["holder"], data["expires_at"], data["fence"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_lease(self, key, lease):
+        holder, expires_at, fence = lease
+        write_atomic(self._path(key, "lease"), json.dumps({"holder": holder, "expires_at": expires_at, "fence": fence}))
+
+    def load(self, key):
+        try:
+            with open(self._path(key, "json"), 'r') as f:
+                return decode_ticket(f.read())
+        except OSError:
+            return None
+
+    def acquire_lease(self, key, holder, ttl):
+        with self._locked(key):
+            lease = _grant(self._read_lease(key), holder, ttl, time.time())
+            if lease is None:
+                return None
+            self._write_lease(key, lease)
+            return lease[2]
+
+    def save(self, key, ticket, fence):
+        with self._locked(key):
+            lease = self._read_lease(key)
+            if lease is not None and lease[2] != fence:
+                return False
+            write_atomic(self._path(key, "json"), encode_ticket(ticket))
+            return True
+
+    def release_lease(self, key, holder, fence):
+        with self._locked(key):
+            lease = self._read_lease(key)
+            if lease is not None and lease[0] == holder and lease[2] == fence:
+                # Keep the fence, so tokens keep growing
+                self._write_lease(key, (None, 0, fence))
+
+
+class SQLiteTAStore(TAStore):
+    """
+    Tickets and leases in a SQLite database. Lease and fenced writes run in BEGIN IMMEDIATE
+    transactions, which SQLite serializes with its own file locks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS tickets (key TEXT PRIMARY KEY, ticket TEXT NOT NULL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(key TEXT PRIMARY KEY, holder TEXT, expires_at REAL NOT NULL, fence INTEGER NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # One short-lived connection per operation: they are cheap and safe across threads
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    @staticmethod
+    def _read_lease(connection, key):
+        return connection.execute("SELECT holder, expires_at, fence FROM leases WHERE key = ?", (key,)).fetchone()
+
+    def load(self, key):
+        with self._connect() as connection:
+            row = connection.execute("SELECT ticket FROM tickets WHERE key = ?", (key,)).fetchone()
+        return decode_ticket(row[0]) if row else None
+
+    def acquire_lease(self, key, holder, ttl):
+        with self._transaction() as connection:
+            lease = _grant(self._read_lease(connection, key), holder, ttl, time.time())
+            if lease is None:
+                return None
+            connection.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)", (key,) + lease)
+            return lease[2]
+
+    def save(self, key, ticket, fence):
+        with self._transaction() as connection:
+            lease = self._read_lease(connection, key)
+            if lease is not None and lease[2] != fence:
+                return False
+            connection.execute("INSERT OR REPLACE INTO tickets VALUES (?, ?)", (key, encode_ticket(ticket)))
+            return True
+
+    def release_lease(self, key, holder, fence):
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE leases SET holder = NULL, expires_at = 0 WHERE key = ? AND holder = ? AND fence = ?",
+                (key, holder, fence),
+            )
+
+
+class RedisError(Exception):
+    """An error reply of the Redis server."""
+
+
+class RespConnection:
+    """
+    Minimal Redis protocol (RESP2) client, enough for the TA store without a redis package.
+    Not thread-safe: callers serialize access, and WATCH/MULTI/EXEC must run on one connection.
+    """
+
+    def __init__(self, url, timeout=5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        # Between WATCH and EXEC/UNWATCH a new connection would silently drop the WATCH
+        self._watching = False
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        self._file = self._sock.makefile('rb')
+        if self.password:
+            self._call("AUTH", self.password)
+        if self.db:
+            self._call("SELECT", self.db)
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+        self._sock = self._file = None
+        self._watching = False
+
+    def _call(self, *args):
+        parts = [str(arg).encode() for arg in args]
+        self._sock.sendall(
+            b"*%d\r\n" % len(parts) + b"".join(b"$%d\r\n%s\r\n" % (len(part), part) for part in parts)
+        )
+        return self._read()
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Redis closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            return self._file.read(length + 2)[:-2].decode()
+        if kind == b"*":
+            length = int(rest)
+            return None if length < 0 else [self._read() for _ in range(length)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    def execute(self, *args):
+        """
+        Sends a command and returns its reply, reconnecting once if the connection dropped.
+
+        Raises:
+            ConnectionError: If the connection dropped inside a transaction or after WATCH.
+                Resending on a new connection would run the transaction unfenced.
+        """
+        command = args[0]
+        for attempt in range(2):
+            watching = self._watching
+            try:
+                if self._sock is None:
+                    self._connect()
+                reply = self._call(*args)
+            except (OSError, ConnectionError):
+                self.close()
+                # A command outside a transaction can be resent; inside one the transaction is lost
+                if attempt or watching or command in ("MULTI", "EXEC"):
+                    raise
+                continue
+            if command == "WATCH":
+                self._watching = True
+            elif command in ("EXEC", "UNWATCH", "DISCARD"):
+                self._watching = False
+            return reply
+
+
+class RedisTAStore(TAStore):
+    """
+    arca:ta:<key> holds the ticket (expiring with it), arca:ta:<key>:lease the holder of the
+    lease and arca:ta:<key>:fence the last fencing token handed out.
+    """
+
+    def __init__(self, url, prefix="arca:ta:"):
+        self.prefix = prefix
+        self._connection = RespConnection(url)
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        with self._lock:
+            data = self._connection.execute("GET", self.prefix + key)
+        return decode_ticket(data) if data is not None else None
+
+    def acquire_lease(self, key, holder, ttl):
+        with self._lock:
+            if self._connection.execute("SET", f"{self.prefix}{key}:lease", holder, "NX", "PX", int(ttl * 1000)) is None:
+                return None
+            # Only the holder gets here until the lease expires
+            return self._connection.execute("INCR", f"{self.prefix}{key}:fence")
+
+    def save(self, key, ticket, fence):
+        ttl = int((ticket["expiration_time"] - datetime.now(ticket["expiration_time"].tzinfo)).total_seconds() * 1000)
+        fence_key = f"{self.prefix}{key}:fence"
+        with self._lock:
+            connection = self._connection
+            connection.execute("WATCH", fence_key)
+            try:
+                current = connection.execute("GET", fence_key)
+                if current is not None and int(current) != fence:
+                    connection.execute("UNWATCH")
+                    return False
+                connection.execute("MULTI")
+                connection.execute("SET", self.prefix + key, encode_ticket(ticket), "PX", max(ttl, 1))
+                # None when the fence moved after WATCH
+                return connection.execute("EXEC") is not None
+            except RedisError:
+                connection.close()
+                raise
+
+    def release_lease(self, key, holder, fence):
+        lease_key = f"{self.prefix}{key}:lease"
+        fence_key = f"{self.prefix}{key}:fence"
+        with self._lock:
+            connection = self._connection
+            # Compare-and-delete: only the holder of the lease with that fence may release it
+            connection.execute("WATCH", lease_key, fence_key)
+            try:
+                current = connection.execute("GET", fence_key)
+                if (connection.execute("GET", lease_key) != holder
+                        or current is None or int(current) != fence):
+                    connection.execute("UNWATCH")
+                    return
+                connection.execute("MULTI")
+                connection.execute("DEL", lease_key)
+                connection.execute("EXEC")
+            except RedisError:
+                connection.close()
+                raise
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(default_directory):
+    """
+    Returns the process-wide store configured with ARCA_TA_STORE / ARCA_TA_STORE_URL.
+
+    Args:
+        default_directory (str): Directory of the file and sqlite backends when
+            ARCA_TA_STORE_URL is not set (the ssl_files directory)
+
+    Raises:
+        ValueError: If ARCA_TA_STORE is not a known backend
+    """
+    with _stores_lock:
+        store = _stores.get(default_directory)
+        if store is None:
+            if TA_STORE == "file":
+                store = FileTAStore(TA_STORE_URL or default_directory)
+            elif TA_STORE == "sqlite":
+                store = SQLiteTAStore(TA_STORE_URL or os.path.join(default_directory, "ta.sqlite3"))
+            elif TA_STORE == "redis":
+                store = RedisTAStore(TA_STORE_URL or "redis://localhost:6379/0")
+            else:
+                raise ValueError(f"Unknown ARCA_TA_STORE: {TA_STORE}")
+            _stores[default_directory] = store
+        return store
@@ -0,0 +1,28 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip("zeep")
+
+import encoders  # noqa: E402
+from encoders import JSON, MSGPACK, decode, encode, to_builtin  # noqa: E402
+
+
+def test_decimal_amounts_keep_their_exact_value():
+    amount = Decimal("0.1") + Decimal("0.2")
+    payload = to_builtin({"ImpTotal": amount, "MonCotiz": Decimal("1.000000")})
+    assert payload == {"ImpTotal": "0.3", "MonCotiz": "1.000000"}
+    assert json.loads(encode(payload, JSON)) == {"ImpTotal": "0.3", "MonCotiz": "1.000000"}
+
+
+def test_decimal_left_in_a_payload_is_encoded_as_a_string():
+    body = encode({"response": {"ImpIVA": Decimal("0.1") + Decimal("0.2")}}, JSON)
+    assert decode(body) == {"response": {"ImpIVA": "0.3"}}
+
+
+def test_decimal_in_msgpack_replies_is_a_string():
+    if encoders.negotiate(MSGPACK) != MSGPACK:
+        pytest.skip("no MessagePack backend installed")
+    body = encode({"ImpTotal": Decimal("0.1") + Decimal("0.2")}, MSGPACK)
+    assert decode(body, MSGPACK) == {"ImpTotal": "0.3"}
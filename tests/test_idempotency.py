@@ -0,0 +1,33 @@
+from idempotency import BUSY, DONE, NEW, ReplyStore
+
+
+def make_store(tmp_path):
+    return ReplyStore(path=str(tmp_path / "replies.db"))
+
+
+def test_duplicate_without_replay_waits_for_the_claim(tmp_path):
+    store = make_store(tmp_path)
+    assert store.begin("key", replay=False) == (NEW, None)
+    # Published twice, neither with an idempotency key nor redelivered
+    assert store.begin("key", replay=False) == (BUSY, None)
+    store.finish("key", {"response": 1})
+    assert store.begin("key", replay=True) == (DONE, {"response": 1})
+
+
+def test_reused_key_without_replay_keeps_the_stored_reply(tmp_path):
+    store = make_store(tmp_path)
+    store.begin("key")
+    store.finish("key", {"response": 1})
+
+    assert store.begin("key", replay=False) == (NEW, None)
+    # A redelivery of the new request waits for it instead of getting the old reply
+    assert store.begin("key", replay=True) == (BUSY, None)
+    store.abandon("key")
+    assert store.begin("key", replay=True) == (DONE, {"response": 1})
+
+
+def test_abandoned_claim_is_processed_again(tmp_path):
+    store = make_store(tmp_path)
+    store.begin("key", replay=False)
+    store.abandon("key")
+    assert store.begin("key", replay=False) == (NEW, None)
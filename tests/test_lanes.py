@@ -0,0 +1,49 @@
+import time
+
+import lanes
+import shards
+
+
+def make_scheduler():
+    shard = lanes.Lane("shard-0", shards.shard_queue(0), 20, 1, 4, shards.SHARD_QUEUE_ARGUMENTS)
+    query = lanes.Lane("query", lanes.QUERY_QUEUE, 20, 20, 1)
+    return lanes.LaneScheduler([shard, query]), shard, query
+
+
+def test_retried_authorize_keeps_its_place_in_its_shard():
+    scheduler, shard, query = make_scheduler()
+    scheduler.put(shard, "authorize 1")
+    scheduler.put(shard, "authorize 2")
+
+    assert scheduler.take() == "authorize 1"
+    # Failed with a retryable error: held in place instead of going to a delay queue
+    scheduler.put_back(shard, "authorize 1", 0.05)
+    scheduler.put(shard, "authorize 3")
+
+    assert scheduler.take() is None
+    assert 0 < scheduler.wait() <= 0.05
+    time.sleep(scheduler.wait())
+    assert [scheduler.take() for _ in range(3)] == ["authorize 1", "authorize 2", "authorize 3"]
+    assert scheduler.wait() is None
+
+
+def test_held_shard_does_not_hold_other_lanes():
+    scheduler, shard, query = make_scheduler()
+    scheduler.put(shard, "authorize 1")
+    scheduler.put_back(shard, scheduler.take(), 60)
+    scheduler.put(query, "last_invoice")
+
+    assert scheduler.wait() == 0
+    assert scheduler.take() == "last_invoice"
+    assert scheduler.take() is None
+
+
+def test_batch_put_back_keeps_its_order():
+    scheduler, shard, query = make_scheduler()
+    for n in range(1, 5):
+        scheduler.put(shard, f"authorize {n}")
+    batch = [scheduler.take() for _ in range(3)]
+
+    for item in batch:
+        scheduler.put_back(shard, item)
+    assert [scheduler.take() for _ in range(4)] == ["authorize 1", "authorize 2", "authorize 3", "authorize 4"]
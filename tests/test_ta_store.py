@@ -0,0 +1,49 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import fake_redis
+import ta_store
+
+
+@pytest.fixture(params=["file", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "file":
+        yield ta_store.FileTAStore(str(tmp_path))
+    elif request.param == "sqlite":
+        yield ta_store.SQLiteTAStore(str(tmp_path / "ta.sqlite3"))
+    else:
+        server = fake_redis.make_server(port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield ta_store.RedisTAStore(f"redis://127.0.0.1:{server.server_address[1]}/0")
+        server.shutdown()
+        server.server_close()
+
+
+def ticket():
+    return {"token": "token", "sign": "sign", "expiration_time": datetime.now(timezone.utc) + timedelta(hours=12)}
+
+
+def test_lease_is_not_granted_again_to_its_holder(store):
+    fence = store.acquire_lease("wsfe", "a", 60)
+    assert fence is not None
+    assert store.acquire_lease("wsfe", "a", 60) is None
+    assert store.acquire_lease("wsfe", "b", 60) is None
+
+    store.release_lease("wsfe", "a", fence)
+    assert store.acquire_lease("wsfe", "a", 60) > fence
+
+
+def test_stale_holder_cannot_store_nor_release(store):
+    stale = store.acquire_lease("wsfe", "a", 0.01)
+    time.sleep(0.05)
+    fence = store.acquire_lease("wsfe", "b", 60)
+    assert fence > stale
+
+    assert store.save("wsfe", ticket(), stale) is False
+    store.release_lease("wsfe", "a", stale)
+    assert store.acquire_lease("wsfe", "a", 60) is None
+    assert store.save("wsfe", ticket(), fence) is True
+    assert store.load("wsfe")["token"] == "token"
@@ -0,0 +1,339 @@
+"""
+Load protection around the WSFEv1 calls: an adaptive concurrency limit and a circuit breaker.
+
+When ARCA degrades, every call takes longer and the workers would keep piling requests on
+it. Two mechanisms, shared by every call of the process, keep the latency of the requests
+that can still succeed under control:
+    - AdaptiveLimiter (AIMD): the number of concurrent calls grows by one per `limit`
+      calls that finish under ARCA_LIMIT_LATENCY_MS, and is halved when a call fails or is
+      slower (at most once per round of calls). Callers over the limit wait up to
+      ARCA_LIMIT_QUEUE_TIMEOUT for a slot. It only matters where calls run concurrently
+      (async_worker.py); the blocking worker makes one call at a time.
+    - CircuitBreaker: once ARCA_BREAKER_MIN_CALLS calls were made in the last
+      ARCA_BREAKER_WINDOW seconds and at least ARCA_BREAKER_ERROR_RATE of them failed
+      (raised or took over ARCA_BREAKER_SLOW_CALL_S), calls fail fast for
+      ARCA_BREAKER_COOLDOWN seconds. Then ARCA_BREAKER_PROBES probe calls are let through
+      (half-open): a success closes the breaker, a failure opens it again.
+
+Rejected calls raise UpstreamUnavailable (CircuitOpen or Overloaded) before anything is sent
+to ARCA, with the seconds after which it is worth retrying. The workers turn it into a
+structured error reply, or defer the message when ARCA_BREAKER_DEFER is set.
+
+Environment Variables:
+    - ARCA_LIMIT_INITIAL: Initial concurrency limit (default: 10)
+    - ARCA_LIMIT_MIN: Lowest concurrency limit (default: 1)
+    - ARCA_LIMIT_MAX: Highest concurrency limit, 0 disables the limiter (default: 50)
+    - ARCA_LIMIT_LATENCY_MS: Calls slower than this shrink the limit (default: 2000)
+    - ARCA_LIMIT_QUEUE_TIMEOUT: Seconds a call may wait for a slot (default: 30)
+    - ARCA_BREAKER_ERROR_RATE: Failure rate that opens the breaker, 0 disables it (default: 0.5)
+    - ARCA_BREAKER_MIN_CALLS: Calls in the window before the rate is considered (default: 10)
+    - ARCA_BREAKER_WINDOW: Seconds of calls the rate is computed on (default: 30)
+    - ARCA_BREAKER_COOLDOWN: Seconds the breaker stays open before probing (default: 30)
+    - ARCA_BREAKER_PROBES: Concurrent probe calls while half-open (default: 1)
+    - ARCA_BREAKER_SLOW_CALL_S: Calls slower than this count as failures (default: 10)
+    - ARCA_BREAKER_DEFER: Set to 1 to hold rejected messages until retry_after and requeue
+      them instead of replying with an error (default: 0)
+"""
+
+import asyncio
+import functools
+import inspect
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+
+LIMIT_INITIAL = int(os.environ.get("ARCA_LIMIT_INITIAL", 10))
+LIMIT_MIN = int(os.environ.get("ARCA_LIMIT_MIN", 1))
+LIMIT_MAX = int(os.environ.get("ARCA_LIMIT_MAX", 50))
+LIMIT_LATENCY = float(os.environ.get("ARCA_LIMIT_LATENCY_MS", 2000)) / 1000
+LIMIT_QUEUE_TIMEOUT = float(os.environ.get("ARCA_LIMIT_QUEUE_TIMEOUT", 30))
+
+BREAKER_ERROR_RATE = float(os.environ.get("ARCA_BREAKER_ERROR_RATE", 0.5))
+BREAKER_MIN_CALLS = int(os.environ.get("ARCA_BREAKER_MIN_CALLS", 10))
+BREAKER_WINDOW = float(os.environ.get("ARCA_BREAKER_WINDOW", 30))
+BREAKER_COOLDOWN = float(os.environ.get("ARCA_BREAKER_COOLDOWN", 30))
+BREAKER_PROBES = int(os.environ.get("ARCA_BREAKER_PROBES", 1))
+BREAKER_SLOW_CALL = float(os.environ.get("ARCA_BREAKER_SLOW_CALL_S", 10))
+DEFER = os.environ.get("ARCA_BREAKER_DEFER", "0") == "1"
+
+
+class UpstreamUnavailable(Exception):
+    """
+    A call was rejected without being sent to ARCA.
+
+    Attributes:
+        code (str): Machine-readable reason, sent in the error reply
+        retry_after (float): Seconds after which the call is worth retrying
+    """
+
+    code = "upstream_unavailable"
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(UpstreamUnavailable):
+    code = "circuit_open"
+
+
+class Overloaded(UpstreamUnavailable):
+    code = "overloaded"
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of concurrent calls, for threads and coroutines alike.
+    """
+
+    def __init__(self, initial=LIMIT_INITIAL, minimum=LIMIT_MIN, maximum=LIMIT_MAX,
+                 latency_target=LIMIT_LATENCY, backoff=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._async_waiters = deque()
+        self._decreased_at = 0.0
+
+    def _try_acquire(self):
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout=LIMIT_QUEUE_TIMEOUT):
+        """
+        Waits for a slot.
+
+        Returns:
+            float: The start time of the call, to pass to release()
+
+        Raises:
+            Overloaded: If no slot was freed within timeout seconds
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                raise Overloaded(f"Too many concurrent ARCA calls (limit {int(self.limit)})", self.latency_target)
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def acquire_async(self, timeout=LIMIT_QUEUE_TIMEOUT):
+        """Non-blocking version of acquire()."""
+        deadline = time.monotonic() + timeout
+        while not self._try_acquire():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Overloaded(f"Too many concurrent ARCA calls (limit {int(self.limit)})", self.latency_target)
+            waiter = asyncio.get_running_loop().create_future()
+            self._async_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                try:
+                    self._async_waiters.remove(waiter)
+                except ValueError:
+                    pass
+        return time.monotonic()
+
+    def release(self, start, failed):
+        """
+        Frees the slot of a finished call and adapts the limit to its outcome.
+
+        Args:
+            start (float): Returned by acquire()
+            failed (bool): True if the call raised
+        """
+        now = time.monotonic()
+        with self._condition:
+            self.in_flight -= 1
+            if not failed and now - start <= self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif start >= self._decreased_at:
+                # Calls that were already in flight when the limit was cut report the same
+                # congestion, so the limit is only cut once per round
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self._decreased_at = now
+            self._condition.notify()
+        for waiter in list(self._async_waiters):
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast while the recent failure rate is too high, probing to recover.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, error_rate=BREAKER_ERROR_RATE, min_calls=BREAKER_MIN_CALLS, window=BREAKER_WINDOW,
+                 cooldown=BREAKER_COOLDOWN, probes=BREAKER_PROBES, slow_call=BREAKER_SLOW_CALL):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.probes = probes
+        self.slow_call = slow_call
+        self.state = self.CLOSED
+        self._outcomes = deque()  # (finish time, failed) of the calls in the window
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Admits a call.
+
+        Returns:
+            bool: True if the call is a half-open probe, to pass to after_call()
+
+        Raises:
+            CircuitOpen: If the breaker is open, or half-open with every probe in flight
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                retry_after = self._opened_at + self.cooldown - now
+                if retry_after > 0:
+                    raise CircuitOpen("ARCA is failing, not sending new requests", retry_after)
+                self.state = self.HALF_OPEN
+                print(" [*] Circuit breaker half-open, probing ARCA")
+            if self._probing >= self.probes:
+                raise CircuitOpen("ARCA is failing, waiting for the probe request", self.cooldown)
+            self._probing += 1
+            return True
+
+    def after_call(self, probe, failed, duration):
+        """
+        Records the outcome of an admitted call.
+
+        Args:
+            probe (bool): Returned by before_call()
+            failed (bool): True if the call raised
+            duration (float): Seconds the call took
+        """
+        failed = failed or duration > self.slow_call
+        now = time.monotonic()
+        with self._lock:
+            if probe:
+                self._probing -= 1
+                if failed:
+                    self._open(now)
+                elif self.state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                    self._failures = 0
+                    print(" [*] Circuit breaker closed")
+                return
+            if self.state != self.CLOSED:
+                # Sent before the breaker opened
+                return
+
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._failures -= self._outcomes.popleft()[1]
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures >= self.error_rate * calls:
+                self._open(now)
+
+    def cancel(self, probe):
+        """Forgets an admitted call that was not sent after all, so it tells nothing about ARCA."""
+        if probe:
+            with self._lock:
+                self._probing -= 1
+
+    def _open(self, now):
+        if self.state != self.OPEN:
+            print(f" [*] Circuit breaker open for {self.cooldown}s")
+        self.state = self.OPEN
+        self._opened_at = now
+
+
+limiter = AdaptiveLimiter() if LIMIT_MAX > 0 else None
+breaker = CircuitBreaker() if BREAKER_ERROR_RATE > 0 else None
+
+if limiter is not None:
+    metrics.UPSTREAM_LIMIT.set_function(lambda: int(limiter.limit))
+if breaker is not None:
+    metrics.CIRCUIT_STATE.set_function(lambda: breaker.state)
+
+
+def guarded(func):
+    """
+    Decorator running every call of a WSFEv1 function (or coroutine function) through the
+    circuit breaker and the concurrency limiter of the process.
+    """
+    def admit():
+        try:
+            return breaker.before_call() if breaker is not None else False
+        except CircuitOpen as e:
+            metrics.REJECTED.labels(e.code).inc()
+            raise
+
+    def abort(probe):
+        if breaker is not None:
+            breaker.cancel(probe)
+
+    def finish(probe, start, failed):
+        duration = time.monotonic() - start
+        if limiter is not None:
+            limiter.release(start, failed)
+        if breaker is not None:
+            breaker.after_call(probe, failed, duration)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            probe = admit()
+            try:
+                start = await limiter.acquire_async() if limiter is not None else time.monotonic()
+            except BaseException as e:
+                # Cancelled or rejected while queued: the probe, if any, was never sent
+                abort(probe)
+                if isinstance(e, Overloaded):
+                    metrics.REJECTED.labels(e.code).inc()
+                raise
+            failed = True
+            try:
+                result = await func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                finish(probe, start, failed)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        probe = admit()
+        try:
+            start = limiter.acquire() if limiter is not None else time.monotonic()
+        except BaseException as e:
+            abort(probe)
+            if isinstance(e, Overloaded):
+                metrics.REJECTED.labels(e.code).inc()
+            raise
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            finish(probe, start, failed)
+    return wrapper